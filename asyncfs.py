@@ -0,0 +1,350 @@
+import errno
+import itertools
+import os
+import stat
+
+from collections import Counter
+
+import pyfuse3
+import trio
+
+from fuse import FuseOSError
+
+from freyafs import FreyaFS, ATTR_TIMEOUT
+
+MAX_TASKS = 1024  # kernel requests served at the same time
+MAX_THREADS = 64  # of them, mixing or blocked on the cache
+FETCH_AHEAD = 64  # blocks of a file fetched on the event loop when opened
+
+
+def _ns(seconds):
+    return int(seconds * 1e9)
+
+
+class _OpenFile:
+    """What FreyaFS is given of an open, as fusepy gives it."""
+
+    def __init__(self, flags, blocks=None):
+        self.flags = flags
+        self.keep_cache = 0
+        self.direct_io = 0
+        self.fh = 0
+        self.blocks = blocks
+
+
+class AsyncFreyaFS(pyfuse3.Operations):
+    """pyfuse3 front end of FreyaFS.
+
+    Requests are served by trio tasks, so thousands of them can be waiting
+    at the same time. The blocks of a file being opened are fetched from the
+    block store by the event loop, then handed to a worker thread which
+    un-mixes them; reads of files in memory are served by the loop itself.
+    Other operations of FreyaFS run on worker threads, as they may wait for
+    the cache or for the coordinator of a cluster.
+
+    Inodes are given to paths as the kernel looks them up, one per path id,
+    so hard links share their inode. They are forgotten along with the
+    kernel.
+    """
+
+    enable_writeback_cache = False
+
+    def __init__(self, fs: FreyaFS, attr_timeout=ATTR_TIMEOUT, threads=MAX_THREADS):
+        super().__init__()
+        self.fs = fs
+        self.attr_timeout = attr_timeout
+        self.limiter = trio.CapacityLimiter(threads)
+
+        root = self.fs.structure['/'].path_id
+        self._inodes = {root: pyfuse3.ROOT_INODE}
+        self._ids = {pyfuse3.ROOT_INODE: root}
+        self._paths = {pyfuse3.ROOT_INODE: '/'}
+        self._lookups = Counter()  # of each inode, by the kernel
+        self._next_inode = itertools.count(pyfuse3.ROOT_INODE + 1)
+        self._handles = {}
+        self._next_handle = itertools.count(1)
+
+    # --------------------------------------------------------------------- Helpers
+
+    def _call(self, op, *args):
+        try:
+            return self.fs(op, *args)
+        except FuseOSError as e:
+            raise pyfuse3.FUSEError(e.errno)
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        except OSError as e:
+            raise pyfuse3.FUSEError(e.errno if e.errno is not None else errno.EIO)
+
+    async def _call_in_thread(self, op, *args):
+        return await trio.to_thread.run_sync(self._call, op, *args, limiter=self.limiter)
+
+    @staticmethod
+    async def _result(future):
+        # Futures of the block store complete on the event loop of its client
+        token = trio.lowlevel.current_trio_token()
+        done = trio.Event()
+        future.add_done_callback(lambda _: token.run_sync_soon(done.set))
+        await done.wait()
+        return future.result()
+
+    async def _fetch(self, path):
+        """Fetches the first blocks of a file about to be loaded."""
+        if path not in self.fs.structure:
+            # Reported by the open itself
+            return None
+        path_info = self.fs.structure[path]
+        cids = self.fs.cids.get(path_info.path_id)
+        if path_info in self.fs.cache or not cids:
+            return None
+
+        # Reads come first anyway: they go to the client straight away,
+        # which bounds the transfers on its own
+        store = self.fs.block_store.store
+        wanted = list(dict.fromkeys(cid for cid in cids if cid is not None))[:FETCH_AHEAD]
+        futures = {cid: store.submit_get(cid) for cid in wanted}
+        blocks = {}
+        for cid, future in futures.items():
+            try:
+                blocks[cid] = await self._result(future)
+            except Exception:
+                # Fetched again by the load, which reports the error
+                pass
+        return blocks
+
+    def _path(self, inode):
+        try:
+            return self._paths[inode]
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+    def _child(self, parent_inode, name):
+        parent = self._path(parent_inode)
+        return os.path.join(parent, os.fsdecode(name))
+
+    def _inode(self, path):
+        path_id = self.fs.structure.get(path, follow_symlinks=False).path_id
+        inode = self._inodes.get(path_id)
+        if inode is None:
+            inode = self._inodes[path_id] = next(self._next_inode)
+            self._ids[inode] = path_id
+        # The last path an inode was looked up with (hard links have several)
+        self._paths[inode] = path
+        return inode
+
+    async def _attr(self, path):
+        stats = await self._call_in_thread('getattr', path)
+        attr = pyfuse3.EntryAttributes()
+        attr.st_ino = self._inode(path)
+        attr.st_mode = stats['st_mode']
+        attr.st_nlink = stats['st_nlink']
+        attr.st_uid = stats['st_uid']
+        attr.st_gid = stats['st_gid']
+        attr.st_size = stats['st_size']
+        attr.st_blocks = stats.get('st_blocks', 0)
+        attr.st_blksize = 4096
+        attr.st_atime_ns = _ns(stats['st_atime'])
+        attr.st_mtime_ns = _ns(stats['st_mtime'])
+        attr.st_ctime_ns = _ns(stats['st_ctime'])
+        attr.attr_timeout = self.attr_timeout
+        attr.entry_timeout = self.attr_timeout
+        return attr
+
+    async def _entry(self, path):
+        # Replied to a lookup: the kernel keeps the inode until it forgets it
+        attr = await self._attr(path)
+        self._lookups[attr.st_ino] += 1
+        return attr
+
+    def _moved(self, old, new):
+        # Paths below a renamed directory move along with it
+        def rebase(path):
+            if path == old or path.startswith(old + '/'):
+                return new + path[len(old):]
+            return path
+
+        self._paths = {inode: rebase(path) for inode, path in self._paths.items()}
+        self._handles = {fh: (rebase(path), fi) for fh, (path, fi) in self._handles.items()}
+
+    def _open_handle(self, path, of: _OpenFile):
+        of.fh = next(self._next_handle)
+        self._handles[of.fh] = (path, of)
+        fi = pyfuse3.FileInfo()
+        fi.fh = of.fh
+        fi.keep_cache = bool(of.keep_cache)
+        fi.direct_io = bool(of.direct_io)
+        return fi
+
+    def _handle(self, fh):
+        try:
+            return self._handles[fh]
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.EBADF)
+
+    # --------------------------------------------------------------------- Filesystem methods
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        if name == b'.':
+            return await self._entry(self._path(parent_inode))
+        if name == b'..':
+            return await self._entry(os.path.dirname(self._path(parent_inode)))
+
+        path = self._child(parent_inode, name)
+        if path not in self.fs.structure:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        return await self._entry(path)
+
+    async def forget(self, inode_list):
+        for inode, nlookup in inode_list:
+            self._lookups[inode] -= nlookup
+            if self._lookups[inode] > 0:
+                continue
+            del self._lookups[inode]
+            if inode == pyfuse3.ROOT_INODE:
+                continue
+            self._paths.pop(inode, None)
+            path_id = self._ids.pop(inode, None)
+            if self._inodes.get(path_id) == inode:
+                del self._inodes[path_id]
+
+    async def getattr(self, inode, ctx=None):
+        return await self._attr(self._path(inode))
+
+    async def setattr(self, inode, attr, fields, fh, ctx):
+        path = self._path(inode)
+        stats = await self._call_in_thread('getattr', path)
+
+        if fields.update_size:
+            await self._call_in_thread('truncate', path, attr.st_size)
+        if fields.update_mode:
+            # Keep the file type, which chmod does not carry
+            await self._call_in_thread('chmod', path, stat.S_IFMT(stats['st_mode']) | stat.S_IMODE(attr.st_mode))
+        if fields.update_uid or fields.update_gid:
+            uid = attr.st_uid if fields.update_uid else stats['st_uid']
+            gid = attr.st_gid if fields.update_gid else stats['st_gid']
+            await self._call_in_thread('chown', path, uid, gid)
+        if fields.update_atime or fields.update_mtime:
+            atime = attr.st_atime_ns / 1e9 if fields.update_atime else stats['st_atime']
+            mtime = attr.st_mtime_ns / 1e9 if fields.update_mtime else stats['st_mtime']
+            await self._call_in_thread('utimens', path, (atime, mtime))
+
+        return await self._attr(path)
+
+    async def access(self, inode, mode, ctx):
+        return self._path(inode) in self.fs.structure
+
+    async def readlink(self, inode, ctx):
+        return os.fsencode(await self._call_in_thread('readlink', self._path(inode)))
+
+    async def opendir(self, inode, ctx):
+        self._path(inode)
+        return inode
+
+    async def readdir(self, fh, start_id, token):
+        path = self._path(fh)
+        entries = [name for name in await self._call_in_thread('readdir', path, None) if name not in ('.', '..')]
+        for i, name in enumerate(entries[start_id:], start_id):
+            attr = await self._attr(os.path.join(path, name))
+            if not pyfuse3.readdir_reply(token, os.fsencode(name), attr, i + 1):
+                break
+            self._lookups[attr.st_ino] += 1
+
+    async def mkdir(self, parent_inode, name, mode, ctx):
+        path = self._child(parent_inode, name)
+        await self._call_in_thread('mkdir', path, mode)
+        return await self._entry(path)
+
+    async def rmdir(self, parent_inode, name, ctx):
+        await self._call_in_thread('rmdir', self._child(parent_inode, name))
+
+    async def unlink(self, parent_inode, name, ctx):
+        # Dropping the content of the last link may have to reach the block store
+        await self._call_in_thread('unlink', self._child(parent_inode, name))
+
+    async def symlink(self, parent_inode, name, target, ctx):
+        path = self._child(parent_inode, name)
+        await self._call_in_thread('symlink', path, os.fsdecode(target))
+        return await self._entry(path)
+
+    async def rename(self, parent_inode_old, name_old, parent_inode_new, name_new, flags, ctx):
+        if flags:
+            # Neither RENAME_NOREPLACE nor RENAME_EXCHANGE are supported
+            raise pyfuse3.FUSEError(errno.EINVAL)
+        old = self._child(parent_inode_old, name_old)
+        new = self._child(parent_inode_new, name_new)
+        await self._call_in_thread('rename', old, new)
+        self._moved(old, new)
+
+    async def link(self, inode, new_parent_inode, new_name, ctx):
+        path = self._child(new_parent_inode, new_name)
+        await self._call_in_thread('link', path, self._path(inode))
+        return await self._entry(path)
+
+    async def statfs(self, ctx):
+        stv = await self._call_in_thread('statfs', '/')
+        data = pyfuse3.StatvfsData()
+        for key in ('f_bsize', 'f_frsize', 'f_blocks', 'f_bfree', 'f_bavail',
+                    'f_files', 'f_ffree', 'f_favail', 'f_namemax'):
+            setattr(data, key, stv[key])
+        return data
+
+    # --------------------------------------------------------------------- File methods
+
+    async def open(self, inode, flags, ctx):
+        path = self._path(inode)
+        of = _OpenFile(flags, blocks=await self._fetch(path))
+        try:
+            # Only the un-mixing is left to the thread
+            await self._call_in_thread('open', path, of)
+        finally:
+            of.blocks = None
+        return self._open_handle(path, of)
+
+    async def create(self, parent_inode, name, mode, flags, ctx):
+        path = self._child(parent_inode, name)
+        of = _OpenFile(flags)
+        await self._call_in_thread('create', path, mode, of)
+        return self._open_handle(path, of), await self._entry(path)
+
+    async def read(self, fh, off, size):
+        path, fi = self._handle(fh)
+        data = self._call('read_resident', path, size, off)
+        if data is not None:
+            return data
+        return await self._call_in_thread('read', path, size, off, fi)
+
+    async def write(self, fh, off, buf):
+        path, fi = self._handle(fh)
+        return await self._call_in_thread('write', path, buf, off, fi)
+
+    async def flush(self, fh):
+        path, fi = self._handle(fh)
+        await self._call_in_thread('flush', path, fi)
+
+    async def release(self, fh):
+        handle = self._handles.pop(fh, None)
+        if handle is None:
+            return
+        path, fi = handle
+        await self._call_in_thread('release', path, fi)
+
+    async def fsync(self, fh, datasync):
+        path, fi = self._handle(fh)
+        await self._call_in_thread('fsync', path, datasync, fi)
+
+
+def mount(fs: FreyaFS, mountpoint, debug=False, attr_timeout=ATTR_TIMEOUT, max_tasks=MAX_TASKS):
+    """Serves FreyaFS at mountpoint until it is unmounted (or interrupted)."""
+    operations = AsyncFreyaFS(fs, attr_timeout=attr_timeout)
+    options = set(pyfuse3.default_options)
+    options.add('fsname=freyafs')
+    if debug:
+        options.add('debug')
+
+    pyfuse3.init(operations, mountpoint, options)
+    try:
+        trio.run(pyfuse3.main, 1, max_tasks)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pyfuse3.close(unmount=True)
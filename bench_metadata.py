@@ -0,0 +1,214 @@
+import gc
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+
+import nacl.secret
+import nacl.utils
+
+from cache.eviction import EvictionTechnique
+from freyafs import FreyaFS
+from storage.blockstore import MemoryBlockStore
+from structure import PathInfo
+
+# Metadata operations of FreyaFS, measured on an unmounted instance with
+# synthetic trees. Each result is printed as a JSON line.
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 10000000]  # 10M entries take about 10 GB of memory
+DEFAULT_FANOUT = 32
+DEFAULT_OPS = 10000
+TRACED_OPS = 1000  # tracemalloc slows everything down, fewer operations are enough
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak only, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _instance(root, key):
+    # FreyaFS talks a lot while mounting
+    with redirect_stdout(sys.stderr):
+        return FreyaFS(root, root, memory_cap=float('inf'), eviction_technique=EvictionTechnique.LRU,
+                       dump_metadata=False, gc_rate=0, block_store=MemoryBlockStore(),
+                       prefetch_fraction=0, key=key)
+
+
+def build_tree(fs: FreyaFS, size, fanout):
+    """Adds `size` entries, `fanout` per directory, straight to the structure.
+
+    Returns the directories and the files, and the depth of the tree.
+    """
+    dirs, files = ['/'], []
+    next_dir, depth = 0, 0
+    while len(dirs) + len(files) - 1 < size:
+        parent = dirs[next_dir]
+        next_dir += 1
+        for i in range(fanout):
+            if len(dirs) + len(files) - 1 == size:
+                break
+            path = f'{parent.rstrip("/")}/e{i}'
+            # One entry out of four is a directory, so the tree keeps growing
+            if i % 4 == 0:
+                info = PathInfo.make_only_id()
+                fs.structure.add(path, info)
+                fs.metadata.add_dir(info)
+                dirs.append(path)
+            else:
+                info = PathInfo.make()
+                fs.structure.add(path, info)
+                fs.metadata.add_file(info)
+                files.append(path)
+            depth = max(depth, path.count('/'))
+    return dirs, files, depth
+
+
+def phases(fs: FreyaFS, dirs, files, n, tag):
+    """Returns the runs of n operations of each kind, to be called in order."""
+    rng = random.Random(n)
+    new_dirs = [f'{rng.choice(dirs).rstrip("/")}/{tag}d{i}' for i in range(n)]
+    new_files = [f'{rng.choice(dirs).rstrip("/")}/{tag}f{i}' for i in range(n)]
+    renamed = [f'{rng.choice(dirs).rstrip("/")}/{tag}r{i}' for i in range(n)]
+    to_stat = [rng.choice(files) for _ in range(n)]
+    to_list = [rng.choice(dirs) for _ in range(n)]
+
+    def mkdir():
+        for path in new_dirs:
+            fs('mkdir', path, 0o755)
+
+    def create():
+        for path in new_files:
+            fs('create', path, 0o644)
+            fs('release', path, None)
+
+    def stat():
+        for path in to_stat:
+            fs('getattr', path)
+
+    def readdir():
+        for path in to_list:
+            for _ in fs('readdir', path, None):
+                pass
+
+    def rename():
+        for old, new in zip(new_files, renamed):
+            fs('rename', old, new)
+
+    def unlink():
+        for path in renamed:
+            fs('unlink', path)
+        # Not measured on its own: leave the tree as it was
+        for path in reversed(new_dirs):
+            fs('rmdir', path)
+
+    return [('mkdir', mkdir), ('create', create), ('getattr', stat),
+            ('readdir', readdir), ('rename', rename), ('unlink', unlink)]
+
+
+def measure(fs: FreyaFS, dirs, files, n, tag):
+    results = {}
+    for op, run in phases(fs, dirs, files, n, f'{tag}t'):
+        gc.collect()
+        rss = _rss()
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        results[op] = {
+            'op': op,
+            'ops': n,
+            'seconds': seconds,
+            'ops_per_sec': n / seconds if seconds else None,
+            'rss_bytes_per_op': (_rss() - rss) / n,
+        }
+
+    # Allocations, in a second pass
+    traced = min(n, TRACED_OPS)
+    tracemalloc.start()
+    for op, run in phases(fs, dirs, files, traced, f'{tag}m'):
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().compare_to(before, 'filename')
+        results[op].update({
+            'retained_bytes_per_op': sum(stat.size_diff for stat in stats) / traced,
+            'retained_blocks_per_op': sum(stat.count_diff for stat in stats) / traced,
+            'peak_bytes': peak - current,
+        })
+    tracemalloc.stop()
+
+    return results.values()
+
+
+def bench(size, fanout, n):
+    key = nacl.utils.random(nacl.secret.SecretBox.KEY_SIZE)
+    with tempfile.TemporaryDirectory(prefix='freyafs-bench-') as root:
+        fs = _instance(root, key)
+        rss = _rss()
+        start = time.perf_counter()
+        dirs, files, depth = build_tree(fs, size, fanout)
+        common = {'size': size, 'fanout': fanout, 'depth': depth}
+        yield {**common, 'op': 'build', 'seconds': time.perf_counter() - start, 'rss_bytes': _rss() - rss}
+
+        for result in measure(fs, dirs, files, n, 'x'):
+            yield {**common, **result}
+
+        start = time.perf_counter()
+        fs.dump()
+        yield {**common, 'op': 'dump', 'seconds': time.perf_counter() - start,
+               'bytes': os.path.getsize(fs.filename)}
+        fs.close()
+        del fs
+        gc.collect()
+
+        rss = _rss()
+        start = time.perf_counter()
+        fs = _instance(root, key)
+        yield {**common, 'op': 'mount', 'seconds': time.perf_counter() - start, 'rss_bytes': _rss() - rss}
+        fs.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Benchmark of the metadata operations of FreyaFS, without mounting it'
+    )
+    parser.add_argument('--sizes',
+                        metavar='N',
+                        help=f'numbers of entries of the synthetic trees (default: {DEFAULT_SIZES})',
+                        type=int,
+                        nargs='+',
+                        default=DEFAULT_SIZES)
+    parser.add_argument('--fanout',
+                        help='entries per directory, the lower the deeper the trees',
+                        type=int,
+                        default=DEFAULT_FANOUT)
+    parser.add_argument('--ops',
+                        help='operations of each kind per tree',
+                        type=int,
+                        default=DEFAULT_OPS)
+    parser.add_argument('-o', '--output',
+                        metavar='FILE',
+                        help='append the JSON lines to FILE instead of printing them',
+                        default=None)
+    args = parser.parse_args()
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for size in args.sizes:
+            for result in bench(size, args.fanout, args.ops):
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
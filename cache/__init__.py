@@ -1 +1,3 @@
-from .cache import *
\ No newline at end of file
+from .cache import *
+from .commit import *
+from .prefetch import *
@@ -0,0 +1,58 @@
+import threading
+
+from contextlib import contextmanager
+from typing import Callable
+
+
+class MemoryBudget:
+    """Admission control keeping the memory of the cache under a hard limit.
+
+    The resident memory (the content of the cached files) is reported by
+    `resident`, while loads and flushes reserve the working memory they need
+    before starting. A reservation waits until it fits under the limit,
+    unless nothing else is reserved: an operation larger than the limit still
+    runs, but alone. Reservations are reentrant within a thread, as the
+    eviction made room for a load may have to flush other files.
+    """
+
+    def __init__(self, limit, resident: Callable[[], int]):
+        self.limit = limit
+        self.resident = resident
+        self.reserved = 0
+        self.peak = 0
+        self._holders = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    def _fits(self, size):
+        return self.reserved == 0 or self.resident() + self.reserved + size <= self.limit
+
+    @contextmanager
+    def reserve(self, size):
+        if self.limit is None:
+            yield
+            return
+
+        me = threading.get_ident()
+        with self._cond:
+            if me not in self._holders:
+                self._cond.wait_for(lambda: self._fits(size))
+            self._holders[me] = self._holders.get(me, 0) + 1
+            self.reserved += size
+            self.peak = max(self.peak, self.resident() + self.reserved)
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved -= size
+                self._holders[me] -= 1
+                if not self._holders[me]:
+                    del self._holders[me]
+                self._cond.notify_all()
+
+    def changed(self):
+        """To be called when the resident memory shrinks."""
+        if self.limit is None:
+            return
+        with self._cond:
+            self._cond.notify_all()
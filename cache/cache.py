@@ -1,22 +1,35 @@
 import math
-import os
 import threading
 import errno
 
+from collections import Counter
+from contextlib import nullcontext
 from time import time
 from fuse import FuseOSError
 from typing import Callable, Any
 from pathlib import Path
 
 import utils.mixslice as MixSlice
+from aesmix256k import MACRO_SIZE
+from storage.blockstore import FetchedBlockStore
+from storage.dedup import DedupIndex
+from storage.fragments import FileFragmentStore
 from structure.pathinfo import PathInfo
-from utils.filebytecontent import FileByteContent
-
+from utils.chunking import chunk_pages, unchunk
+from utils.compression import Codec, compress_pages, split_stream
+from utils import scheduler
+from utils.filebytecontent import FileByteContent, join_pages
+from utils.scheduler import Priority
+from utils.trace import span
+
+from .budget import MemoryBudget
 from .entry import CacheEntry
 from .eviction import EvictionTechnique
 
 
 LOCK = threading.Lock()
+# Flushes run one at a time, but without LOCK while encrypting
+FLUSH_LOCK = threading.Lock()
 
 
 class Cache:
@@ -24,16 +37,64 @@ class Cache:
                  root: Path,
                  eviction_technique=EvictionTechnique.LRU,
                  ipfs_cids=None,
-                 memory_cap=math.inf):
+                 memory_cap=math.inf,
+                 block_store=None,
+                 collector=None,
+                 packer=None,
+                 inline=None,
+                 hard_limit=None,
+                 compression: Codec = None,
+                 chunking=False,
+                 layouts=None,
+                 fragment_keys=None,
+                 fragments=None,
+                 committer=None,
+                 digests=None,
+                 convergent_secret=None,
+                 clock=time):
         self.root = root
         self.files = {}
         self.evicted = {}
+        # Files being decrypted, without LOCK, to be waited for
+        self.loading = {}
 
         self.ipfs_cids = ipfs_cids
+        self.block_store = block_store
+        self.collector = collector
+        self.packer = packer
+        self.inline = inline
+        # Compressed and chunked files map their content to the blocks
+        # actually stored
+        self.compression = compression
+        self.chunking = chunking
+        self.layouts = layouts if layouts is not None else {}
+        # Keys wrapping the kept fragments, changed to revoke access
+        self.fragment_keys = fragment_keys if fragment_keys is not None else {}
+        self.fragments = fragments if fragments is not None else FileFragmentStore(root)
+        # Flushes of small files committed in groups, in background
+        self.committer = committer
+        # Files whose key material comes from their content, by macroblock,
+        # and the blocks they share
+        self.digests = digests if digests is not None else {}
+        self.convergent_secret = convergent_secret
+        self.converging = set()  # files made convergent from their next flush
+        self.dedup = DedupIndex()
+        for path_id, file_digests in self.digests.items():
+            self.dedup.add(file_digests, self.ipfs_cids.get(path_id, []))
 
         self.memory_cap = memory_cap
         self.total_size = 0
         self.eviction_technique = eviction_technique
+        # Replays of recorded operations run on their own time
+        self.clock = clock
+        # Resident memory plus the working memory of loads and flushes
+        self.budget = MemoryBudget(hard_limit, resident=lambda: self.total_size)
+
+        # Number of opens of each file, to find the hot set
+        self.hits = Counter()
+        # Modification time of each file when the kernel last had it open,
+        # telling whether the pages cached by the kernel are still valid
+        self.kernel_mtimes = {}
 
     @property
     def free_space(self):
@@ -44,128 +105,428 @@ class Cache:
 
     # ------------------------------------------------------ Helpers
 
-    def _decrypt(self, path: PathInfo):
-        actual_path = self.root / path.path_id
+    def _decrypt(self, path: PathInfo, blocks=None):
+        with scheduler.job(file=path.path_id):
+            return self._decrypt_file(path, blocks)
+
+    def _decrypt_file(self, path: PathInfo, blocks=None):
+        if self.inline is not None and path.path_id in self.inline:
+            return FileByteContent(self.inline.load(path.path_id))
+
+        if self.packer is not None and path.path_id in self.packer:
+            with span('cache.decrypt', cat='cache', path_id=path.path_id, packed=True):
+                return FileByteContent(self.packer.load(path.path_id))
+
+        fragment = self.fragments.fragment(path.path_id)
         cids = self.ipfs_cids[path.path_id]
-        return MixSlice.decrypt(actual_path, path.key, path.iv, cids=cids)
+        layout = self.layouts.get(path.path_id)
+        fragment_key = self.fragment_keys.get(path.path_id)
+        # Blocks may have been fetched already, by the event loop of asyncfs
+        store = FetchedBlockStore(self.block_store, blocks) if blocks else self.block_store
+        with span('cache.decrypt', cat='cache', path_id=path.path_id, blocks=len(cids)):
+            if layout is not None and 'chunks' in layout:
+                chunks = MixSlice.decrypt_chunks(fragment, path.key, path.iv, store, cids=cids,
+                                                 fragment_key=fragment_key)
+                pages, size = unchunk(chunks, layout)
+            else:
+                pages, size = MixSlice.decrypt_pages(fragment, path.key, path.iv, store, cids=cids,
+                                                     fragment_key=fragment_key,
+                                                     digests=self.digests.get(path.path_id))
+        if layout is not None and 'codec' in layout:
+            # Macroblocks are decompressed as they are read
+            pages, size, stored = split_stream(pages, size, layout)
+            return FileByteContent(pages=pages, size=size, stored=stored, unpack=Codec(layout['codec']).decompress)
+        return FileByteContent(pages=pages, size=size)
 
     def _encrypt(self, path: PathInfo):
-        entry = self.files[path]
-        plaintext = entry.content.read_all()
-        dest = (self.root / path.path_id).absolute()
+        with scheduler.job(file=path.path_id):
+            self._encrypt_file(path)
 
-        cids = MixSlice.encrypt(
-            data=plaintext,
-            path=dest,
-            key=path.key,
-            iv=path.iv)
+    def _encrypt_file(self, path: PathInfo):
+        # Writers go on while the snapshot is encrypted, without LOCK
+        with LOCK:
+            entry = self.files[path]
+            pages, size, dirty, stored = entry.content.snapshot(packed=True)
+        try:
+            if self.committer is not None:
+                # The version queued before is stored first, unless this one
+                # takes its place
+                self.committer.settle(path.path_id, queued=not self._grouped(size))
+        except BaseException:
+            entry.content.restore_dirty(dirty)
+            raise
+        dest = self.fragments.fragment(path.path_id)
+
+        guard = self.collector.guard() if self.collector is not None else nullcontext()
+        with guard, span('cache.encrypt', cat='cache', path_id=path.path_id, size=size):
+            # Files move between storage tiers as their size changes
+            if self.inline is not None:
+                if self.inline.accepts(size):
+                    self.inline.store(path.path_id, bytes(join_pages(entry.content.unpacked(pages, stored), size)))
+                    self._drop_packed(path)
+                    self._drop_blocks(path)
+                    return
+                self.inline.remove(path.path_id)
+
+            if self.packer is not None:
+                if self.packer.accepts(size):
+                    self.packer.store(path.path_id, bytes(join_pages(entry.content.unpacked(pages, stored), size)))
+                    self._drop_blocks(path)
+                    return
+                self._drop_packed(path)
 
-        self.ipfs_cids[path.path_id] = cids
+            with LOCK:
+                old_cids = self.ipfs_cids.get(path.path_id)
+            try:
+                if self.chunking:
+                    cids, layout, digests = self._mix_chunks(path, dest, entry.content.unpacked(pages, stored), size)
+                else:
+                    cids, layout, digests = self._mix_pages(path, entry, dest, pages, size, dirty, stored)
+            except BaseException:
+                entry.content.restore_dirty(dirty)
+                raise
+
+            if cids is None:
+                # Queued for the group commit
+                return
+            self._stored(path, entry, old_cids, cids, layout, size, digests)
+
+    def _stored(self, path: PathInfo, entry: CacheEntry, old_cids, cids, layout, size, digests=None):
+        with LOCK:
+            self.set_digests(path.path_id, cids, digests)
+            self.ipfs_cids[path.path_id] = cids
+            if layout is not None:
+                self.layouts[path.path_id] = layout
+            else:
+                self.layouts.pop(path.path_id, None)
+            entry.stored_size = size
+        if old_cids and self.collector is not None:
+            self.collector.supersede(set(old_cids) - set(cids))
+
+    def _mix_pages(self, path: PathInfo, entry: CacheEntry, dest, pages, size, dirty, stored):
+        old_cids = self.ipfs_cids.get(path.path_id)
+        old_layout = self.layouts.get(path.path_id)
+        # Macroblocks stored with the same codec keep their compressed form
+        same_codec = self.compression is not None and old_layout is not None \
+            and old_layout.get('codec') == self.compression.value
+        if not same_codec:
+            pages, stored = entry.content.unpacked(pages, stored), None
+        compressed = None
+        if self.compression is not None:
+            with span('cache.compress', cat='cache', path_id=path.path_id, codec=self.compression.value):
+                compressed = compress_pages(pages, size, self.compression,
+                                            old_layout if old_layout is not None and 'codec' in old_layout else None,
+                                            dirty, stored)
+
+        # Only the macroblocks written since the last time are mixed again,
+        # as long as the stored blocks are laid out the same way
+        previous = None
+        if compressed is not None:
+            to_mix, to_mix_size, layout, to_mix_dirty, forms = compressed
+            if old_cids is not None and old_layout is not None and 'codec' in old_layout:
+                previous = (old_layout['stream'], old_cids)
+        else:
+            to_mix, to_mix_size, layout, to_mix_dirty = pages, size, None, dirty
+            if old_cids is not None and old_layout is None and entry.stored_size is not None:
+                previous = (entry.stored_size, old_cids)
+
+        convergent = None
+        if self.convergent_secret is not None and \
+                (path.path_id in self.converging or path.path_id in self.digests):
+            old_digests = self.digests.get(path.path_id)
+            if old_digests is None:
+                # Blocks mixed with the key of the file cannot be kept
+                previous = None
+            convergent = MixSlice.Convergent(self.convergent_secret, old_digests, self.dedup)
+
+        args = {
+            'pages': to_mix,
+            'size': to_mix_size,
+            'fragment': dest,
+            'key': path.key,
+            'iv': path.iv,
+            'previous': previous,
+            'dirty': to_mix_dirty,
+            'fragment_key': self._fragment_key(path.path_id),
+            'convergent': convergent,
+        }
+        if self._grouped(size):
+            # Copied, writers change the pages in place once the flush returns
+            args['pages'] = {i: bytes(page) for i, page in to_mix.items()}
+
+            def apply(cids):
+                self._stored(path, entry, old_cids, cids, None, size,
+                             convergent.digests if convergent is not None else None)
+
+            if self.committer.submit(path.path_id, args, size, apply):
+                return None, None, None
+        cids = MixSlice.encrypt_pages(store=self.block_store, **args)
+        if compressed is not None:
+            entry.content.stored_as(forms, self.compression.decompress)
+        return cids, layout, convergent.digests if convergent is not None else None
+
+    def _mix_chunks(self, path: PathInfo, dest, pages, size):
+        old_cids = self.ipfs_cids.get(path.path_id)
+        old_layout = self.layouts.get(path.path_id)
+        with span('cache.chunk', cat='cache', path_id=path.path_id, size=size):
+            chunks, layout = chunk_pages(pages, size, path.key)
+
+        # Chunks stored before, wherever they were, are found by their digest
+        previous = None
+        if old_cids is not None and old_layout is not None and 'chunks' in old_layout:
+            previous = ([digest for _, _, digest in old_layout['chunks']], old_cids)
+
+        cids = MixSlice.encrypt_chunks(chunks, dest, path.key, path.iv, self.block_store, previous=previous,
+                                       fragment_key=self._fragment_key(path.path_id))
+        return cids, layout, None
+
+    def _grouped(self, size):
+        """Whether a flush of this size goes to the group commit."""
+        return (self.committer is not None and self.committer.accepts(size)
+                and not self.chunking and self.compression is None
+                and not (self.inline is not None and self.inline.accepts(size))
+                and not (self.packer is not None and self.packer.accepts(size)))
+
+    def _settle(self, path: PathInfo):
+        if self.committer is not None:
+            self.committer.settle(path.path_id)
+
+    def _fragment_key(self, path_id):
+        # Fragments written before fragment keys existed stay as they are
+        # until revoked
+        if path_id not in self.fragment_keys and path_id not in self.ipfs_cids:
+            self.fragment_keys[path_id] = MixSlice.new_fragment_key()
+        return self.fragment_keys.get(path_id)
+
+    def _drop_packed(self, path: PathInfo):
+        if self.packer is not None:
+            self.packer.remove(path.path_id)
+
+    def set_digests(self, path_id, cids, digests):
+        """Records the digests of the version of a file about to be stored,
+        None if not convergent, keeping the dedup index in step."""
+        old = self.digests.pop(path_id, None)
+        if digests is not None:
+            self.digests[path_id] = digests
+            self.dedup.add(digests, cids)
+        if old is not None:
+            self.dedup.remove(old, self.ipfs_cids.get(path_id, []))
+
+    def _drop_blocks(self, path: PathInfo):
+        with LOCK:
+            self.set_digests(path.path_id, None, None)
+            self.layouts.pop(path.path_id, None)
+            self.fragment_keys.pop(path.path_id, None)
+            old_cids = self.ipfs_cids.pop(path.path_id, None)
+        if old_cids is None:
+            return
+
+        if self.collector is not None:
+            self.collector.supersede(old_cids)
+        self.fragments.delete(path.path_id)
 
     def _apply_to_file(self, path: PathInfo, f: Callable[[CacheEntry], Any]):
         file = self.files[path]
 
-        prev_size = len(file.content)
+        prev_size = file.footprint
         res, new_content = f(file)
-        new_size = len(new_content)
+        new_size = new_content.footprint()
 
         if prev_size != new_size:
             with LOCK:
                 self.total_size = self.total_size - prev_size + new_size
+            if new_size < prev_size:
+                self.budget.changed()
 
         return res
 
-    def _free_space(self, target=0):
-        if self.free_space >= target:
+    def _load_need(self, path: PathInfo):
+        """Estimates the memory needed to load a file."""
+        cids = self.ipfs_cids.get(path.path_id)
+        if cids is None:
+            # Inline or packed: at most a pack has to be decrypted
+            return 2 * MACRO_SIZE
+        stored = sum(1 for cid in cids if cid is not None)
+        layout = self.layouts.get(path.path_id)
+        if layout is not None:
+            # The stored blocks, then the content put back together
+            stored += layout['size'] // MACRO_SIZE + 1
+        return stored * MACRO_SIZE + MixSlice.working_memory(stored)
+
+    def _flush_need(self, entry: CacheEntry):
+        """Estimates the memory needed to flush a file, besides its content."""
+        return MixSlice.working_memory(entry.size // MACRO_SIZE + 1)
+
+    def _free_space(self, target=0, cap=None, keep=None):
+        cap = self.memory_cap if cap is None else cap
+        if cap - self.total_size >= target:
             return
 
         with LOCK:
-            items = self.files.items()
+            items = [(path, entry) for path, entry in self.files.items() if path != keep]
 
         items = sorted(
             items, key=lambda pair: self.eviction_technique(pair[1]))
 
-        while self.free_space < target and len(items) > 0:
+        while cap - self.total_size < target and len(items) > 0:
             (path, entry) = items.pop(0)
             self._evict(path, entry)
 
     def _evict(self, path: PathInfo, entry: CacheEntry):
-        self.flush(path)
-        self.release(path, force=True)
-        with LOCK:
-            entry.content = None
-            self.evicted[path] = entry
+        with span('cache.evict', cat='cache', path_id=path.path_id, size=entry.size), \
+                scheduler.job(Priority.EVICTION):
+            # Entries that were not modified (e.g. prefetched ones) are already stored
+            self.flush(path, force=False)
+            self.release(path, force=True)
+            with LOCK:
+                entry.content = None
+                self.evicted[path] = entry
 
-    def _unevict(self, path: PathInfo):
+    def _unevict(self, path: PathInfo, plaintext=None):
         entry = self.evicted[path]
         del self.evicted[path]
 
-        plaintext = FileByteContent(self._decrypt(path))
+        if plaintext is None:
+            plaintext = self._decrypt(path)
         entry.content = plaintext
+        entry.stored_size = len(plaintext)
+        entry.loaded = self.clock()
         return entry
 
-    def _load(self, path: PathInfo, mtime=None):
-        with LOCK:
-            if path in self.files:
-                return False
+    def _load(self, path: PathInfo, mtime=None, blocks=None):
+        while True:
+            with LOCK:
+                if path in self.files:
+                    return False
+                loading = self.loading.get(path)
+                if loading is None:
+                    loading = self.loading[path] = threading.Event()
+                    break
+            # Decrypted once, by the first thread to open the file
+            loading.wait()
+
+        try:
+            return self._load_file(path, mtime, blocks)
+        finally:
+            with LOCK:
+                del self.loading[path]
+            loading.set()
 
-            freshly_created = False
-            if path in self.evicted:
-                entry = self._unevict(path)
-            else:
-                plaintext = FileByteContent(self._decrypt(path))
-                entry = CacheEntry(plaintext, mtime)
-                freshly_created = True
+    def _load_file(self, path: PathInfo, mtime, blocks):
+        # Waited for out of LOCK, which storing the flush takes
+        self._settle(path)
+
+        need = self._load_need(path)
+        if self.budget.limit is not None:
+            # Make room for the working memory as well
+            self._free_space(target=need, cap=self.budget.limit)
 
-        self._insert_entry(path, entry)
+        with self.budget.reserve(need):
+            # Decrypted without LOCK, which storing files takes after the
+            # locks of the collector and of the packer
+            with span('cache.load', cat='cache', path_id=path.path_id):
+                plaintext = self._decrypt(path, blocks)
+
+            with LOCK:
+                freshly_created = False
+                if path in self.evicted:
+                    entry = self._unevict(path, plaintext)
+                else:
+                    entry = CacheEntry(plaintext, mtime, now=self.clock())
+                    freshly_created = True
+
+            self._insert_entry(path, entry)
         return freshly_created
 
     def _insert_entry(self, path: PathInfo, entry: CacheEntry):
-        if entry.size > self.memory_cap:
+        limit = self.budget.limit if self.budget.limit is not None else math.inf
+        if entry.footprint > min(self.memory_cap, limit):
             raise FuseOSError(errno.ENOMEM)
-        self._free_space(target=entry.size)
+        self._free_space(target=entry.footprint)
         with LOCK:
             self.files[path] = entry
-            self.total_size += entry.size
+            self.total_size += entry.footprint
 
     # ------------------------------------------------------ Opening and creating
 
-    def open(self, path: PathInfo, mtime):
-        freshly_created = self._load(path, mtime)
+    def open(self, path: PathInfo, mtime, blocks=None):
+        self.hits[path.path_id] += 1
+        freshly_created = self._load(path, mtime, blocks)
         with LOCK:
+            if path in self.files:
+                self.files[path].touch(self.clock())
             if not freshly_created and path in self.files:
                 self.files[path].opens += 1
                 return
 
     def create(self, path: PathInfo):
+        self._settle(path)
         with LOCK:
             if path in self.files:
                 self.files[path].opens += 1
                 return
 
-            entry = self._unevict(path) if path in self.evicted else None
+            evicted = path in self.evicted
 
-        if entry:
-            self._insert_entry(entry)
+        if evicted:
+            self._load(path)
             return
 
         with LOCK:
             plaintext = FileByteContent(b'')
-            self.files[path] = CacheEntry(plaintext)
+            self.files[path] = CacheEntry(plaintext, now=self.clock())
             # Here self.files[path].size is obviously 0, so no need to free space
 
         self.flush(path)
 
+    def prefetch(self, path: PathInfo, mtime):
+        """Loads a file nobody has open yet, if it fits in the free space."""
+        with LOCK:
+            if path in self.files or path in self.evicted or path in self.loading:
+                return False
+
+        self._settle(path)
+        with self.budget.reserve(self._load_need(path)):
+            plaintext = self._decrypt(path)
+            entry = CacheEntry(plaintext, mtime, now=self.clock())
+            entry.opens = 0
+
+            with LOCK:
+                # Never evict anything to make room for it
+                if path in self.files or path in self.loading or entry.footprint > self.free_space:
+                    return False
+                self.files[path] = entry
+                self.total_size += entry.footprint
+        return True
+
+    def kernel_cache_valid(self, path: PathInfo, mtime):
+        with LOCK:
+            if path in self.files and self.files[path].mtime != mtime:
+                return False
+            return self.kernel_mtimes.get(path.path_id) == mtime
+
+    def mtime(self, path: PathInfo):
+        return self.files[path].mtime
+
+    def allocated(self, path: PathInfo):
+        return self.files[path].content.allocated()
+
     # ------------------------------------------------------ Reading and writing
 
     def read_bytes(self, path: PathInfo, offset, length):
         self._load(path)
+        return self.read_resident(path, offset, length, unpack=True)
 
+    def read_resident(self, path: PathInfo, offset, length, unpack=False):
+        """Reads from the content in memory, None if it is not, or if it is
+        still compressed unless unpack."""
         with LOCK:
             if path not in self.files:
                 return None
-        content = self.files[path].content
-        return content.read_bytes(offset, length)
+            entry = self.files[path]
+            entry.touch(self.clock())
+            content = entry.content
+        return content.read_bytes(offset, length, unpack)
 
     def write_bytes(self, path: PathInfo, buf, offset):
         self._load(path)
@@ -173,15 +534,25 @@ class Cache:
         with LOCK:
             if path not in self.files:
                 return 0
+            entry = self.files[path]
 
         def write(file):
             bytes_written = file.content.write_bytes(buf, offset)
             return bytes_written, file.content
 
-        bytes_written = self._apply_to_file(path, write)
+        need = entry.content.write_need(len(buf), offset)
+        if self.budget.limit is not None and need:
+            # Pages grow under the limit like loads do, other files make room
+            if entry.footprint + need > self.budget.limit:
+                raise FuseOSError(errno.ENOMEM)
+            self._free_space(target=need, cap=self.budget.limit, keep=path)
+
+        with self.budget.reserve(need):
+            bytes_written = self._apply_to_file(path, write)
 
         self.files[path].modified = True
-        self.files[path].mtime = int(time())
+        self.files[path].mtime = int(self.clock())
+        self.files[path].touch(self.clock())
 
         return bytes_written, self.files[path].size
 
@@ -199,7 +570,83 @@ class Cache:
         self._apply_to_file(path, truncate)
 
         self.files[path].modified = True
-        self.files[path].mtime = int(time())
+        self.files[path].mtime = int(self.clock())
+
+    # ------------------------------------------------------ Cloning and removing files
+
+    def clone(self, source: PathInfo, dest: PathInfo):
+        """Makes dest share the stored content of source.
+
+        The two files share the key material, so they also share every block:
+        only the macroblocks written afterwards get new ones.
+        """
+        self.flush(source, force=False)
+        self._settle(source)
+
+        guard = self.collector.guard() if self.collector is not None else nullcontext()
+        with guard, span('cache.clone', cat='cache', path_id=source.path_id, to=dest.path_id):
+            if self.inline is not None and source.path_id in self.inline:
+                self.inline.store(dest.path_id, self.inline.load(source.path_id))
+            elif self.packer is not None and source.path_id in self.packer:
+                self.packer.store(dest.path_id, self.packer.load(source.path_id))
+            elif source.path_id in self.ipfs_cids:
+                # The kept fragments are small (1KB per macroblock), copy them
+                self.fragments.copy(source.path_id, dest.path_id)
+                with LOCK:
+                    digests = self.digests.get(source.path_id)
+                    self.set_digests(dest.path_id, self.ipfs_cids[source.path_id],
+                                     list(digests) if digests is not None else None)
+                    self.ipfs_cids[dest.path_id] = list(self.ipfs_cids[source.path_id])
+                    if source.path_id in self.layouts:
+                        self.layouts[dest.path_id] = self.layouts[source.path_id]
+                    if source.path_id in self.fragment_keys:
+                        self.fragment_keys[dest.path_id] = self.fragment_keys[source.path_id]
+
+    def invalidate(self, path_id, mtime):
+        """Forgets the content of a file changed by someone else.
+
+        Files nobody has open are dropped, open ones are loaded again, unless
+        they were modified in the meantime. Evicted ones are loaded from the
+        new version anyway.
+        """
+        with LOCK:
+            self.kernel_mtimes.pop(path_id, None)
+            cached = [(path, entry) for path, entry in self.files.items() if path.path_id == path_id]
+
+        for path, entry in cached:
+            if entry.modified:
+                continue
+            if not entry.opens:
+                with LOCK:
+                    if self.files.get(path) is entry:
+                        del self.files[path]
+                        self.total_size -= entry.footprint
+                self.budget.changed()
+                continue
+
+            self._settle(path)
+            with self.budget.reserve(self._load_need(path)):
+                plaintext = self._decrypt(path)
+
+            def reload(file):
+                file.content = plaintext
+                file.stored_size = len(plaintext)
+                file.mtime = mtime
+                return None, plaintext
+
+            if self.files.get(path) is entry:
+                self._apply_to_file(path, reload)
+
+    def remove(self, path: PathInfo):
+        """Drops the stored content of a file from every storage tier."""
+        if self.committer is not None:
+            self.committer.cancel(path.path_id)
+        guard = self.collector.guard() if self.collector is not None else nullcontext()
+        with guard:
+            if self.inline is not None:
+                self.inline.remove(path.path_id)
+            self._drop_packed(path)
+            self._drop_blocks(path)
 
     # ------------------------------------------------------ Closing files
 
@@ -210,20 +657,38 @@ class Cache:
 
             entry = self.files[path]
 
-        disk_path = (self.root / path.path_id).absolute()
-        file_already_exists = os.path.exists(disk_path)
+        file_already_exists = self.fragments.exists(path.path_id)
         if file_already_exists:
-            os.utime(disk_path, (entry.atime, entry.mtime))
+            self.fragments.touch(path.path_id, entry.atime, entry.mtime)
 
-        with LOCK:
-            if entry.modified or force:
-                self._encrypt(path)
+        with self.budget.reserve(self._flush_need(entry)), FLUSH_LOCK:
+            with LOCK:
+                if not (entry.modified or force) or self.files.get(path) is not entry:
+                    return
+                # Cleared first, so that writes made during the encryption
+                # are not forgotten
                 entry.modified = False
-            else:
-                return
-
+            try:
+                with span('cache.flush', cat='cache', path_id=path.path_id, size=entry.size):
+                    self._encrypt(path)
+            except BaseException:
+                entry.modified = True
+                raise
+            finally:
+                # Pages copied by writers during the flush can be let go,
+                # before the next flush takes a snapshot
+                if self.files.get(path) is entry:
+                    self._apply_to_file(path, lambda file: (file.content.release_snapshot(), file.content))
+                else:
+                    entry.content.release_snapshot()
+
+        # Packed files have no fragments of their own
         if not file_already_exists:
-            os.utime(disk_path, (entry.atime, entry.mtime))
+            self.fragments.touch(path.path_id, entry.atime, entry.mtime)
+
+    def sync(self, path: PathInfo):
+        """Waits for the last flush of a file to be stored."""
+        self._settle(path)
 
     def release(self, path: PathInfo, force=False):
         def release_from(store):
@@ -237,6 +702,8 @@ class Cache:
             if path in self.evicted:
                 release_from(self.evicted)
             elif path in self.files:
+                self.kernel_mtimes[path.path_id] = self.files[path].mtime
                 file = release_from(self.files)
                 if not file.opens or force:
-                    self.total_size -= file.size
+                    self.total_size -= file.footprint
+                    self.budget.changed()
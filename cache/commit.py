@@ -0,0 +1,193 @@
+import threading
+import time
+
+from collections import Counter
+from contextlib import nullcontext
+
+import utils.mixslice as MixSlice
+from aesmix256k import MACRO_SIZE
+from utils import scheduler
+from utils.scheduler import Priority
+from utils.trace import span
+
+GROUP_WINDOW = 0.005  # seconds a queued flush waits for others to join it
+GROUP_FILE_LIMIT = 4 * MACRO_SIZE  # files up to this size are committed in groups
+GROUP_MAX_BYTES = 64 * 1024 * 1024  # data queued at most, then flushes encrypt right away
+RETRY_DELAY = 1  # seconds before committing again a group that failed
+
+
+class _Flush:
+    def __init__(self, path_id, args, size, apply):
+        self.path_id = path_id
+        self.args = args
+        self.size = size
+        self.apply = apply
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommit:
+    """Encrypts the flushes of small files together, in background.
+
+    Flushes queued within `window` of the first one are committed as a
+    group: their macroblocks are mixed in a single pass of the pool of
+    workers, their blocks uploaded concurrently, and then their kept
+    fragments written and their CIDs updated. A flush of a file already
+    queued takes the place of the previous one. Flushes return as soon as
+    they are queued: settle() waits for the commit of a file, as fsync does,
+    and drain() for every queued one, as dumps of the metadata do. Groups
+    that fail are committed again.
+    """
+
+    def __init__(self, store, collector=None, window=GROUP_WINDOW, max_bytes=GROUP_MAX_BYTES,
+                 file_limit=GROUP_FILE_LIMIT):
+        self.store = store
+        self.collector = collector
+        self.window = window
+        self.max_bytes = max_bytes
+        self.file_limit = file_limit
+
+        self.queued = {}  # path_id -> _Flush, in order of arrival
+        self.committing = {}
+        self.queued_bytes = 0
+        self.stats = Counter()
+        self._cond = threading.Condition()
+        self._urgent = False
+        self._stop = False
+        self._thread = None
+
+    def accepts(self, size):
+        return size <= self.file_limit
+
+    def submit(self, path_id, args, size, apply):
+        """Queues the encryption of a file, with the arguments of
+        MixSlice.encrypt_pages() but the store. apply(cids) is called once
+        it is stored. Returns False if the queue is full."""
+        with self._cond:
+            if self._stop or path_id in self.committing:
+                return False
+            flush = self.queued.get(path_id)
+            if flush is not None:
+                # Nothing stored in between: the macroblocks written since
+                # the stored version are the ones of both
+                args = dict(args, dirty=set(flush.args.get('dirty', ())) | set(args.get('dirty', ())))
+                self.queued_bytes += size - flush.size
+                flush.args, flush.size, flush.apply = args, size, apply
+                return True
+            if self.queued_bytes + size > self.max_bytes:
+                return False
+            self.queued[path_id] = _Flush(path_id, args, size, apply)
+            self.queued_bytes += size
+            self._cond.notify_all()
+            return True
+
+    def settle(self, path_id, queued=True):
+        """Waits for the flush of path_id being committed, if any, and for
+        the queued one unless told otherwise."""
+        with self._cond:
+            flush = self.committing.get(path_id)
+            if flush is None and queued:
+                flush = self.queued.get(path_id)
+            if flush is None:
+                return
+            self._urgent = True
+            self._cond.notify_all()
+        flush.done.wait()
+        if flush.error is not None:
+            raise flush.error
+
+    def cancel(self, path_id):
+        """Forgets the queued flush of path_id, for a file being removed."""
+        with self._cond:
+            flush = self.committing.get(path_id)
+        if flush is not None:
+            flush.done.wait()
+        with self._cond:
+            flush = self.queued.pop(path_id, None)
+            if flush is not None:
+                self.queued_bytes -= flush.size
+                flush.done.set()
+
+    def drain(self):
+        """Commits every queued flush, and waits for them."""
+        with self._cond:
+            flushes = list(self.committing.values()) + list(self.queued.values())
+            self._urgent = True
+            self._cond.notify_all()
+        for flush in flushes:
+            flush.done.wait()
+            if flush.error is not None:
+                raise flush.error
+
+    # ------------------------------------------------------ Committing
+
+    def _next_group(self):
+        with self._cond:
+            while not self.queued and not self._stop:
+                self._cond.wait()
+            if not self.queued:
+                return None
+            deadline = time.monotonic() + self.window
+            while not self._urgent and not self._stop:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._urgent = False
+            self.committing, self.queued = self.queued, {}
+            self.queued_bytes = 0
+            return list(self.committing.values())
+
+    def _commit(self, group):
+        guard = self.collector.guard() if self.collector is not None else nullcontext()
+        try:
+            with guard, span('commit.group', cat='cache', files=len(group), size=sum(f.size for f in group)):
+                results = MixSlice.encrypt_group([flush.args for flush in group], self.store)
+                for flush, cids in zip(group, results):
+                    flush.apply(cids)
+        except Exception as e:
+            with self._cond:
+                for flush in group:
+                    flush.error = e
+                    if not self._stop and flush.path_id not in self.queued:
+                        retry = _Flush(flush.path_id, flush.args, flush.size, flush.apply)
+                        self.queued[flush.path_id] = retry
+                        self.queued_bytes += flush.size
+                self.committing = {}
+                self.stats['failed'] += 1
+            for flush in group:
+                flush.done.set()
+            return False
+
+        with self._cond:
+            self.committing = {}
+            self.stats['groups'] += 1
+            self.stats['files'] += len(group)
+        for flush in group:
+            flush.done.set()
+        return True
+
+    def _run(self):
+        with scheduler.job(Priority.WRITEBACK):
+            while True:
+                group = self._next_group()
+                if group is None:
+                    return
+                if not self._commit(group):
+                    with self._cond:
+                        self._cond.wait_for(lambda: self._stop, RETRY_DELAY)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Commits what is queued, then stops."""
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
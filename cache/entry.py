@@ -2,13 +2,29 @@ from time import time
 
 
 class CacheEntry:
-    def __init__(self, content, mtime=None):
+    def __init__(self, content, mtime=None, now=None):
+        now = now if now is not None else time()
         self.content = content
         self.opens = 1  # number of concurrent apps with this file open
         self.modified = True if not mtime else False
-        self.atime = int(time())
+        self.atime = int(now)
         self.mtime = self.atime if not mtime else mtime
+        # Size of the version in storage, if the content was loaded from there
+        self.stored_size = len(content) if mtime else None
+        # When the entry was loaded and last used, and how many times
+        self.loaded = self.used = now
+        self.uses = 0
 
     @property
     def size(self):
         return len(self.content)
+
+    @property
+    def footprint(self):
+        # Holes of sparse files take no memory, while overallocation and
+        # pages kept for a running flush do
+        return self.content.footprint()
+
+    def touch(self, now):
+        self.used = now
+        self.uses += 1
@@ -4,10 +4,21 @@ from .entry import CacheEntry
 
 class EvictionTechnique(Enum):
     LRU = 'LRU'
+    LFU = 'LFU'
+    FIFO = 'FIFO'
+    SIZE = 'SIZE'
 
     def __call__(self, entry: CacheEntry):
+        # Entries with the lowest values are evicted first
         if self == EvictionTechnique.LRU:
-            return entry.mtime
+            return entry.used
+        if self == EvictionTechnique.LFU:
+            return entry.uses, entry.used
+        if self == EvictionTechnique.FIFO:
+            return entry.loaded
+        if self == EvictionTechnique.SIZE:
+            # Largest first, they free the most room
+            return -entry.footprint, entry.used
 
 
 def values():
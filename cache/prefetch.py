@@ -0,0 +1,59 @@
+import threading
+
+from utils import scheduler
+from utils.scheduler import Priority
+from utils.trace import span
+
+IDLE_POLL = 0.01  # seconds between two checks for foreground activity
+
+
+class Prefetcher:
+    """Loads the hottest files of the previous sessions in background.
+
+    Candidates are (path, mtime, size) tuples, hottest first. Files are loaded
+    only while FreyaFS is idle, so that foreground requests keep priority, and
+    until `budget` bytes have been loaded.
+    """
+
+    def __init__(self, cache, candidates, budget, is_idle):
+        self.cache = cache
+        self.candidates = candidates
+        self.budget = budget
+        self.is_idle = is_idle
+        self.loaded = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        with scheduler.job(Priority.PREFETCH):
+            self._prefetch()
+
+    def _prefetch(self):
+        for path, mtime, size in self.candidates:
+            if self.loaded + size > self.budget:
+                continue
+
+            while not self.is_idle():
+                if self._stop.wait(IDLE_POLL):
+                    return
+            if self._stop.is_set():
+                return
+
+            with span('prefetch', cat='cache', path_id=path.path_id, size=size):
+                if self.cache.prefetch(path, mtime):
+                    self.loaded += size
+
+        print(f'[i] Prefetched {self.loaded} B of recently used files.')
+
+    def start(self):
+        if not self.candidates or self.budget <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name='prefetcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,28 @@
+import fcntl
+import os
+from argparse import ArgumentParser
+
+from utils.ioctl import CLONE_PATH_MAX, FREYAFS_IOC_CLONE
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Copy-on-write copy of a file within a mounted FreyaFS'
+    )
+    parser.add_argument('source',
+                        metavar='SRC',
+                        help='file to clone')
+    parser.add_argument('dest',
+                        metavar='DEST',
+                        help='path of the clone, on the same mount')
+    args = parser.parse_args()
+
+    dest = os.path.abspath(args.dest).encode('utf-8')
+    if len(dest) >= CLONE_PATH_MAX:
+        parser.error('destination path too long')
+
+    fd = os.open(args.source, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, FREYAFS_IOC_CLONE, dest.ljust(CLONE_PATH_MAX, b'\0'))
+    finally:
+        os.close(fd)
@@ -0,0 +1,41 @@
+import signal
+from argparse import ArgumentParser
+from pathlib import Path
+
+from utils import coordinator
+from utils.persist import generate_key, key_opens
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Coordinator of the FreyaFS nodes sharing a file system: leases, versions and changes'
+    )
+    parser.add_argument('--listen',
+                        metavar='HOST:PORT',
+                        help=f'address to listen at (default: 127.0.0.1:{coordinator.DEFAULT_PORT})',
+                        default=f'127.0.0.1:{coordinator.DEFAULT_PORT}')
+    auth = parser.add_mutually_exclusive_group(required=True)
+    auth.add_argument('--verify-key',
+                      metavar='KEY',
+                      help='key checking the requests of the nodes, as printed by the nodes when mounting')
+    auth.add_argument('--verify-key-of',
+                      metavar='DATA',
+                      help='ask for the password of the file system in DATA, and derive the key checking '
+                           'the requests of the nodes from it')
+    args = parser.parse_args()
+
+    verify_key = args.verify_key
+    if args.verify_key_of is not None:
+        key = generate_key(ask_confirm=False)
+        if not key_opens(key, Path(args.verify_key_of) / '.freyafs'):
+            parser.error('wrong password')
+        verify_key = coordinator.verify_key(key)
+        print(f'[i] Verify key: {verify_key}')
+
+    print(f'[*] FreyaFS coordinator listening at {args.listen}')
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        coordinator.serve(args.listen, verify_key=verify_key)
+    except KeyboardInterrupt:
+        pass
+    print('[*] FreyaFS coordinator stopped')
@@ -1,85 +1,632 @@
+import ctypes
 import errno
+import hashlib
 import math
 import os
 import json
+import threading
+import time
+from base64 import b64decode, b64encode
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 from fuse import FuseOSError, Operations
 
-from cache import Cache
-from metadata import Metadata
+import utils.mixslice as MixSlice
+from cache import Cache, GroupCommit, Prefetcher
+from metadata import Metadata, PathMetadata
+from storage import INLINE_THRESHOLD, InlineStore, Packer
+from storage.blockstore import IpfsBlockStore, ScheduledBlockStore
+from storage.fragments import FileFragmentStore, SegmentFragmentStore
 from structure import PathInfo, PathStructure
-from utils.persist import generate_key, load_from_file, save_to_file
+from utils.aioipfs import DEFAULT_CONCURRENCY
+from utils.collector import BlockCollector, DEFAULT_RATE
+from utils import coordinator
+from utils.coordinator import ClusterClient
+from utils.ioctl import CLONE_PATH_MAX, FREYAFS_IOC_CLONE
+from utils import keyagent
+from utils.persist import generate_key, load_from_file, save_to_file, try_load
+from utils import scheduler
+from utils.scheduler import Priority, Scheduler
+from utils.trace import span
+
+ATTR_TIMEOUT = 1.0  # seconds the kernel caches attributes and lookups
+
+PREFETCH_FRACTION = 0.25  # of the cache memory cap, used to prefetch hot files
+PREFETCH_TOP = 64  # hot files considered for prefetching
+IDLE_GAP = 0.05  # seconds without requests after which FreyaFS is idle
+
+REVOKE_WORKERS = 8  # files rewrapped at the same time
+REKEY_SUFFIX = '.rekey'  # fragments rewrapped, waiting to replace the old ones
+CONVERGENT_SECRET_SIZE = 32
+
+# Class of the jobs started by each operation, the others are reads
+OP_PRIORITIES = {'flush': Priority.WRITEBACK, 'truncate': Priority.WRITEBACK, 'fsync': Priority.FSYNC}
+
+# Operations changing the structure, kept apart from the changes of other nodes
+NAMESPACE_OPS = {'chmod', 'chown', 'create', 'link', 'mkdir', 'rename', 'rmdir', 'symlink', 'unlink', 'utimens'}
+
+
+def _fd(fh):
+    # With raw_fi, FUSE hands over the whole fuse_file_info structure
+    return fh.fh if hasattr(fh, 'fh') else fh
 
 
 class FreyaFS(Operations):
-    def __init__(self, root, mountpoint, memory_cap, eviction_technique, dump_metadata):
+    def __init__(self, root, mountpoint, memory_cap, eviction_technique, dump_metadata,
+                 ipfs_concurrency=DEFAULT_CONCURRENCY, gc_rate=DEFAULT_RATE, pack_threshold=None,
+                 inline_threshold=INLINE_THRESHOLD, block_store=None,
+                 prefetch_fraction=PREFETCH_FRACTION, prefetch_top=PREFETCH_TOP, memory_limit=None,
+                 key=None, key_agent=None, cluster=None, node=None, compression=None, chunking=False,
+                 recorder=None, bandwidth_caps=None, fragment_segments=False, group_commit=None,
+                 convergent_dirs=None):
         self.root = Path(root)
+        self.mountpoint = os.path.abspath(mountpoint)
         self.filename = self.root / '.freyafs'
+        self.hot_filename = self.root / '.freyafs-hot'
         self.cids = {}
-        self.key = generate_key(ask_confirm=not os.path.exists(self.filename))
-
-        data = load_from_file(self.key, self.filename)
+        self.versions = {}
+        # Anonymized log of the file operations, to size the cache offline
+        self.recorder = recorder
+        layouts = {}
+        fragment_keys = {}
+        self.revocation = {}
+        cluster_seq = 0
+        garbage = []
+        packs = None
+        inline = None
+        segments = None
+        convergent = {}
+        ident = str(self.root.resolve())
+        data = False
+        if key is None and key_agent is not None:
+            key = keyagent.get_key(ident, key_agent)
+            if key is not None:
+                # Decrypted once, which tells whether the key is right
+                data = try_load(key, self.filename)
+                if data is False:
+                    # Handed over after a mistyped password: ask again
+                    print('[i] The key held by the agent does not open this file system.')
+                    key = None
+        from_agent = key is not None
+        self.key = key if key is not None else generate_key(ask_confirm=not os.path.exists(self.filename))
+
+        if data is False:
+            data = load_from_file(self.key, self.filename)
+        if key_agent is not None and not from_agent:
+            # The password was right, the next mounts can skip it
+            keyagent.add_key(ident, self.key, key_agent)
         if data is not None:
             self.structure = PathStructure.from_dict(data['structure'])
             self.metadata = Metadata.from_dict(root=self.root, data=data['metadata'])
             self.cids = data['cids']
+            garbage = data.get('garbage', [])
+            packs = data.get('packs')
+            inline = data.get('inline')
+            self.versions = data.get('versions', {})
+            layouts = data.get('layouts', {})
+            fragment_keys = {path_id: b64decode(k) for path_id, k in data.get('fragment_keys', {}).items()}
+            # Fragment id -> digest of the fragment rewrapped (a list, before)
+            revocation = data.get('revocation', {})
+            self.revocation = revocation if isinstance(revocation, dict) else dict.fromkeys(revocation)
+            cluster_seq = data.get('cluster_seq', 0)
+            segments = data.get('fragments')
+            convergent = data.get('convergent', {})
         else:
             self.structure = PathStructure()
             self.metadata = Metadata(root=self.root)
             self.metadata.add_dir(path=self.structure['/'])
 
+        # Other nodes see the files through their fragments and CIDs only, so
+        # nothing is kept within the metadata nor packed
+        self.cluster = None
+        self._ns_lock = threading.RLock()
+        if cluster is not None:
+            self.cluster = ClusterClient(cluster, self.key, node=node)
+            self.cluster.seq = cluster_seq
+            inline_threshold = pack_threshold = group_commit = None
+        # Last version of each file known to the coordinator
+        self._committed = {path_id: list(cids) for path_id, cids in self.cids.items()}
+
+        # By default blocks go to the local IPFS node, whose transfers are
+        # bounded by their own limit, independently of the mixing processes
+        block_store = block_store if block_store is not None else IpfsBlockStore(concurrency=ipfs_concurrency)
+
+        # Reads go first, for the mixing workers and for the transfers
+        self.scheduler = Scheduler(net=ipfs_concurrency, rates=bandwidth_caps)
+        scheduler.install(self.scheduler)
+        self.block_store = ScheduledBlockStore(block_store, self.scheduler)
+
+        # Blocks replaced by newer versions of a file are removed in background
+        self.collector = BlockCollector(self.cids, self.block_store, garbage=garbage, rate=gc_rate)
+
+        # Files created or written under these directories are encrypted with
+        # key material derived from their content, so that identical
+        # macroblocks are stored once. The secret keeps it from being guessed
+        # from the content alone.
+        self.convergent_dirs = sorted(set(convergent.get('dirs', [])) | set(
+            '/' + d.strip('/') for d in (convergent_dirs or [])))
+        self.convergent_secret = None
+        if convergent.get('secret') is not None:
+            self.convergent_secret = b64decode(convergent['secret'])
+        elif self.convergent_dirs:
+            self.convergent_secret = os.urandom(CONVERGENT_SECRET_SIZE)
+        digests = {path_id: [b64decode(d) if d is not None else None for d in file_digests]
+                   for path_id, file_digests in convergent.get('digests', {}).items()}
+
+        # Kept fragments go to their own host file, or once segments are in
+        # use, appended to a few large ones
+        if fragment_segments or segments is not None:
+            self.fragments = SegmentFragmentStore(self.root, data=segments)
+        else:
+            self.fragments = FileFragmentStore(self.root)
+
+        # Tiny files are stored within the metadata, small ones together in
+        # per-directory packs
+        self.inline = InlineStore(threshold=inline_threshold, data=inline)
+        self.packer = Packer(
+            root=self.root,
+            cids=self.cids,
+            store=self.block_store,
+            collector=self.collector,
+            threshold=pack_threshold,
+            data=packs,
+            fragment_keys=fragment_keys,
+            fragments=self.fragments)
+
+        # Flushes of small files on close are queued, and stored in groups
+        self.committer = None
+        if group_commit is not None:
+            self.committer = GroupCommit(self.block_store, self.collector, window=group_commit)
+
         # Keep track of open files
         self.cache: Cache = Cache(
             root=self.root,
             memory_cap=memory_cap,
             eviction_technique=eviction_technique,
-            ipfs_cids=self.cids)
+            ipfs_cids=self.cids,
+            block_store=self.block_store,
+            collector=self.collector,
+            packer=self.packer,
+            inline=self.inline,
+            hard_limit=memory_limit,
+            compression=compression,
+            chunking=chunking,
+            layouts=layouts,
+            fragment_keys=fragment_keys,
+            fragments=self.fragments,
+            committer=self.committer,
+            digests=digests,
+            convergent_secret=self.convergent_secret)
+        self.fragments.start()
+        if self.committer is not None:
+            self.committer.start()
+        self.collector.start()
+
+        if self.cluster is not None:
+            # Catch up with the other nodes before serving anything
+            self._reset(self.cluster.load())
+            self.cluster.poll(self._apply_remote, self._reset)
+            self.cluster.start(self._apply_remote, self._reset)
+
+        # Bring back the files used the most in the previous sessions
+        self._ops_in_flight = 0
+        self._last_op = 0
+        self._ops_lock = threading.Lock()
+        self.hits = Counter()
+        hot = load_from_file(self.key, self.hot_filename)
+        if hot is not None:
+            # Halve older counts, so the hot set follows changes of habits
+            self.hits = Counter({path_id: hits / 2 for path_id, hits in hot['hits'].items()})
+
+        # A revocation interrupted after saving the new keys
+        self._finish_revocation()
+
+        # Without a cap nothing would ever evict the files prefetched
+        capped = memory_cap is not None and math.isfinite(memory_cap)
+        budget = memory_cap * prefetch_fraction if capped else 0
+        self.prefetcher = Prefetcher(
+            self.cache,
+            self._prefetch_candidates(prefetch_top) if budget > 0 else [],
+            budget,
+            is_idle=self._is_idle)
+        self.prefetcher.start()
 
         print(f'[*] FreyaFS mounted at {mountpoint}')
         print(f'FreyaFS will persist your encrypted data at {root}.')
-        if memory_cap is not None and memory_cap is not math.inf:
+        if capped:
             print(f'[i] Cache memory cap set at {memory_cap} B (eviction with {eviction_technique.value}).')
+        if memory_limit is not None:
+            print(f'[i] Cache memory, flushes and loads included, limited to {memory_limit} B.')
+        if self.cluster is not None:
+            print(f'[i] Shared with other nodes through {cluster}, as node {self.cluster.node}.')
+            print(f'[i] Coordinator verify key: {coordinator.verify_key(self.key)}')
+        if compression is not None:
+            print(f'[i] Files are compressed with {compression.value} before being mixed.')
+        if chunking:
+            print('[i] Files are cut in content-defined chunks before being mixed.')
+        if self.committer is not None:
+            print(f'[i] Flushes of files up to {self.committer.file_limit} B are stored in groups, '
+                  f'within {group_commit * 1000:g} ms.')
+        if isinstance(self.fragments, SegmentFragmentStore):
+            print('[i] Kept fragments are appended to segment files.')
+        if self.convergent_dirs:
+            print(f'[i] Files under {", ".join(self.convergent_dirs)} are deduplicated (convergent encryption).')
+        if inline_threshold is not None:
+            print(f'[i] Files up to {inline_threshold} B are kept within the metadata.')
+        if pack_threshold is not None:
+            print(f'[i] Files up to {self.packer.threshold} B are packed together.')
 
         if dump_metadata:
             print('[i] Some information about the file system')
             print('[i] Files')
             for path_id, cids in self.cids.items():
+                if path_id in self.packer.packs:
+                    continue
                 info = self.metadata[PathInfo.make(path_id)]
                 print(f'> ID:                       {path_id}')
                 print(f'  Size:                     {info.stats["st_size"]}')
-                print(f'  On disk size (encrypted): {os.path.getsize((self.root / path_id).absolute())}')
+                print(f'  On disk size (encrypted): {self.fragments.size(path_id)}')
                 print(f'  Number of CIDs:           {len(cids)}')
 
+            if self.convergent_dirs:
+                dedup = self.cache.dedup.report()
+                print('[i] Deduplication')
+                print(f'> Distinct blocks (references): {dedup["blocks"]} ({dedup["references"]})')
+                print(f'> Storage saved:                {dedup["stored_bytes_saved"]} B')
+
+            print('[i] Packs')
+            for pack_id, pack in self.packer.packs.items():
+                print(f'> ID:                       {pack_id}')
+                print(f'  Size (live):              {pack.size} ({pack.live})')
+                print(f'  Number of files:          {len(pack.members)}')
+
             print('[i] FreyaFS metadata')
             to_write = {
                 'structure': self.structure.to_dict(),
                 'metadata': self.metadata.to_dict(),
                 'cids': self.cids,
+                'packs': self.packer.to_dict(),
+                'inline': self.inline.to_dict(),
             }
             print(f'> In memory size (JSON):    {len(json.dumps(to_write))}')
             print(f'> On disk size (encrypted): {os.path.getsize(self.filename)}')
 
     def dump(self):
+        if self.committer is not None:
+            self.committer.drain()
+        self.packer.flush()
+        garbage = self.collector.candidates()
+        # The index may only point to fragments already on disk
+        self.fragments.sync()
         to_write = {
             'structure': self.structure.to_dict(),
             'metadata': self.metadata.to_dict(),
             'cids': self.cids,
+            'packs': self.packer.to_dict(),
+            'inline': self.inline.to_dict(),
+            'garbage': list(garbage),
+            'layouts': self.cache.layouts,
+            'fragment_keys': {path_id: b64encode(key).decode('ascii')
+                              for path_id, key in self.cache.fragment_keys.items()},
+            'revocation': self.revocation,
+            'convergent': self._convergent_to_dict(),
+            'versions': self.versions,
+            'cluster_seq': self.cluster.seq if self.cluster is not None else 0,
         }
+        fragments = self.fragments.to_dict()
+        if fragments is not None:
+            to_write['fragments'] = fragments
 
         save_to_file(self.key, self.filename, to_write)
+        self.collector.checkpoint(garbage)
+        self.fragments.checkpoint()
+        if self.cluster is not None:
+            # Nodes mounting afterwards start from here
+            self.cluster.checkpoint({'structure': to_write['structure'], 'metadata': to_write['metadata']})
+
+        hits = self.hits + self.cache.hits
+        save_to_file(self.key, self.hot_filename, {'hits': dict(hits)})
+
+    def _convergent_to_dict(self):
+        if self.convergent_secret is None:
+            return {}
+        return {
+            'secret': b64encode(self.convergent_secret).decode('ascii'),
+            'dirs': self.convergent_dirs,
+            'digests': {path_id: [b64encode(d).decode('ascii') if d is not None else None for d in file_digests]
+                        for path_id, file_digests in self.cache.digests.items()},
+        }
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.cluster is not None:
+            self.cluster.stop()
+        self.prefetcher.stop()
+        if self.committer is not None:
+            self.committer.stop()
+        self.collector.stop()
+        self.fragments.close()
+        self.block_store.close()
+
+    def __call__(self, op, *args):
+        path = args[0] if args and isinstance(args[0], str) else None
+        with self._ops_lock:
+            self._ops_in_flight += 1
+        try:
+            with span(op, cat='fuse', path=path), scheduler.job(OP_PRIORITIES.get(op, Priority.READ)):
+                if self.cluster is not None and op in NAMESPACE_OPS:
+                    with self._ns_lock:
+                        return super().__call__(op, *args)
+                return super().__call__(op, *args)
+        finally:
+            with self._ops_lock:
+                self._ops_in_flight -= 1
+                self._last_op = time.monotonic()
 
     # --------------------------------------------------------------------- Helpers
 
+    def _is_idle(self):
+        return self._ops_in_flight == 0 and time.monotonic() - self._last_op >= IDLE_GAP
+
+    def _prefetch_candidates(self, top):
+        infos = self.structure.by_id()
+        candidates = []
+        for path_id, _ in self.hits.most_common():
+            if len(candidates) == top:
+                break
+            if path_id not in infos or infos[path_id] not in self.metadata:
+                continue
+
+            path_info = infos[path_id]
+            stats = self.metadata[path_info].stats
+            if not self.metadata[path_info].is_file() or path_info.link_to_path is not None:
+                continue
+            candidates.append((path_info, stats['st_mtime'], stats['st_size']))
+
+        return candidates
+
     def _actual_path(self, path: str):
         path_info = self.structure[path]
         actual_path = (self.root / path_info.path_id).absolute()
         return actual_path
 
+    def _converge(self, path, path_info):
+        if any(path == d or path.startswith(d.rstrip('/') + '/') for d in self.convergent_dirs):
+            self.cache.converging.add(path_info.path_id)
+
+    def _record(self, op, path_info, offset=0, length=0):
+        if self.recorder is not None:
+            self.recorder.record(op, path_info.path_id, offset, length, self.metadata[path_info].stats['st_size'])
+
     def _cids(self, path: str):
         path_info = self.structure[path]
         return self.cids[path_info.path_id]
 
+    # --------------------------------------------------------------------- Cluster
+
+    @contextmanager
+    def _coordinated(self, error=errno.EIO):
+        # Requests refused by the coordinator fail the operation, cleanly
+        try:
+            yield
+        except ValueError as e:
+            print(f'[i] Refused by the coordinator: {e}')
+            raise FuseOSError(error)
+
+    def _publish(self, **record):
+        if self.cluster is not None:
+            with self._coordinated():
+                self.cluster.publish(record)
+
+    def _publish_add(self, path, path_info):
+        self._publish(op='add', path=path, info=path_info.to_dict(), stats=self.metadata[path_info].to_dict())
+
+    def _publish_stats(self, path_info):
+        self._publish(op='stats', id=path_info.path_id, stats=self.metadata[path_info].to_dict())
+
+    def _lease(self, path_info, write=False):
+        if self.cluster is None:
+            return
+        with self._coordinated():
+            if write and self.cluster.held(path_info.path_id) is not None:
+                version = self.cluster.upgrade(path_info.path_id)
+            else:
+                version = self.cluster.acquire(path_info.path_id, 'write' if write else 'read')
+
+            if version is not None and version > self.versions.get(path_info.path_id, 0):
+                # Someone else stored a newer version in the meantime
+                version, record = self.cluster.fetch(path_info.path_id)
+                with self._ns_lock:
+                    self._apply_commit(path_info.path_id, version, record)
+
+    def _unlease(self, path_info):
+        if self.cluster is not None:
+            with self._coordinated():
+                self.cluster.release(path_info.path_id)
+
+    def _commit(self, path_info):
+        """Hands the stored version of a file over to the other nodes."""
+        path_id = path_info.path_id
+        cids = self.cids.get(path_id)
+        if self.cluster is None or cids is None or self._committed.get(path_id) == cids:
+            return
+
+        stats = self.metadata[path_info].stats
+        record = {
+            'cids': cids,
+            'fragments': b64encode(self.fragments.read(path_id)).decode('ascii'),
+            'size': stats['st_size'],
+            'mtime': stats['st_mtime'],
+            'blocks': stats.get('st_blocks', 0),
+            'layout': self.cache.layouts.get(path_id),
+            'fragment_key': b64encode(self.cache.fragment_keys[path_id]).decode('ascii')
+            if path_id in self.cache.fragment_keys else None,
+            'digests': [b64encode(d).decode('ascii') if d is not None else None
+                        for d in self.cache.digests[path_id]] if path_id in self.cache.digests else None,
+        }
+        # Refused once the write lease is lost, e.g. expired
+        with self._coordinated(errno.ESTALE):
+            version = self.cluster.commit(path_id, self.versions.get(path_id, 0), record)
+        if version is None:
+            raise FuseOSError(errno.ESTALE)
+        self.versions[path_id] = version
+        self._committed[path_id] = list(cids)
+
+    def _apply_commit(self, path_id, version, record):
+        if record is None or version <= self.versions.get(path_id, 0):
+            return
+
+        self.fragments.write(path_id, b64decode(record['fragments'].encode('ascii')))
+        digests = record.get('digests')
+        if digests is not None:
+            digests = [b64decode(d) if d is not None else None for d in digests]
+        self.cache.set_digests(path_id, record['cids'], digests)
+        self.cids[path_id] = record['cids']
+        if record.get('layout') is not None:
+            self.cache.layouts[path_id] = record['layout']
+        else:
+            self.cache.layouts.pop(path_id, None)
+        if record.get('fragment_key') is not None:
+            self.cache.fragment_keys[path_id] = b64decode(record['fragment_key'])
+        else:
+            self.cache.fragment_keys.pop(path_id, None)
+        self.versions[path_id] = version
+        self._committed[path_id] = list(record['cids'])
+
+        meta = self.metadata.data.get(path_id)
+        if meta is not None:
+            meta.set_size(record['size'])
+            meta.set_mtime(record['mtime'])
+            meta.stats['st_blocks'] = record['blocks']
+        self.cache.invalidate(path_id, record['mtime'])
+
+    def _forget_content(self, path_id):
+        # The node removing the file takes care of its blocks
+        self.cache.set_digests(path_id, None, None)
+        self.cids.pop(path_id, None)
+        self.cache.layouts.pop(path_id, None)
+        self.cache.fragment_keys.pop(path_id, None)
+        self.versions.pop(path_id, None)
+        self._committed.pop(path_id, None)
+        self.fragments.delete(path_id)
+
+    def _apply_remote(self, entry):
+        with self._ns_lock:
+            if entry['kind'] == 'commit':
+                self._apply_commit(entry['id'], entry['version'], entry['record'])
+                return
+
+            record = entry['record']
+            op = record['op']
+            try:
+                if op == 'add':
+                    path_info = PathInfo.from_dict(record['info'])
+                    self.structure.add(record['path'], path_info)
+                    self.metadata[path_info] = PathMetadata.from_dict(record['stats'])
+                elif op == 'link':
+                    path_info = self.structure.add_hard_link(record['path'], record['target'])
+                    self.metadata[path_info].inc_nlink()
+                elif op == 'remove':
+                    path_info = self.structure.get(record['path'], follow_symlinks=False)
+                    del self.structure[record['path']]
+                    meta = self.metadata[path_info]
+                    if not meta.is_dir():
+                        meta.dec_nlink()
+                    if meta.is_dir() or meta.nlink == 0:
+                        del self.metadata[path_info]
+                        self._forget_content(path_info.path_id)
+                elif op == 'rename':
+                    self.structure.rename(record['old'], record['new'])
+                elif op == 'stats':
+                    self.metadata.data[record['id']].stats.update(record['stats'])
+            except KeyError:
+                # Already gone here: the last change wins
+                pass
+
+    def _reset(self, data):
+        if data is None:
+            return
+        with self._ns_lock:
+            self.structure = PathStructure.from_dict(data['structure'])
+            self.metadata = Metadata.from_dict(root=self.root, data=data['metadata'])
+            # Packs are not files, but their blocks are in the map as well
+            for path_id in [path_id for path_id in self.cids
+                            if path_id not in self.metadata.data and path_id not in self.packer.packs]:
+                self._forget_content(path_id)
+
+    # --------------------------------------------------------------------- Revocation
+
+    def revoke(self, paths=('/',), workers=REVOKE_WORKERS, progress=None):
+        """Wraps the kept fragments of the files under paths with new keys.
+
+        Without the fragments the blocks are useless, so changing their keys
+        is enough to cut off anyone who had the old ones: the blocks stay as
+        they are, and nothing is transferred. Packed files have their whole
+        pack rewrapped. Returns the number of files and of bytes rewritten.
+        """
+        # Packs are sealed first, their fragments would be rewrapped stale
+        if self.committer is not None:
+            self.committer.drain()
+        self.packer.flush()
+        targets = set()
+        for path in paths:
+            for info in self.structure.under(path):
+                if info.path_id in self.packer.extents:
+                    targets.add(self.packer.extents[info.path_id][0])
+                elif info.path_id in self.cids:
+                    targets.add(info.path_id)
+        targets = sorted(path_id for path_id in targets if self.fragments.exists(path_id))
+        keys = {path_id: MixSlice.new_fragment_key() for path_id in targets}
+
+        def rewrap(path_id):
+            return MixSlice.rewrap(self.fragments.fragment(path_id), self.cache.fragment_keys.get(path_id),
+                                   keys[path_id], self.fragments.fragment(path_id + REKEY_SUFFIX))
+
+        written = 0
+        digests = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for done, (path_id, (old, size)) in enumerate(zip(targets, executor.map(rewrap, targets)), 1):
+                digests[path_id] = hashlib.sha256(old).hexdigest()
+                written += size
+                if progress is not None:
+                    progress(done, len(targets), written)
+
+        # Fragments written in the meantime are still wrapped with the old key
+        for path_id in targets:
+            if not self._unchanged(path_id, digests[path_id]):
+                del keys[path_id], digests[path_id]
+                self.fragments.delete(path_id + REKEY_SUFFIX)
+
+        # Once the new keys are saved the new fragments must replace the old
+        # ones, even if interrupted in between
+        self.revocation = digests
+        self.cache.fragment_keys.update(keys)
+        self.dump()
+        self._finish_revocation()
+        return len(keys), written
+
+    def _unchanged(self, path_id, digest):
+        return self.fragments.exists(path_id) and hashlib.sha256(self.fragments.read(path_id)).hexdigest() == digest
+
+    def _finish_revocation(self):
+        if not self.revocation:
+            return
+        for path_id, digest in self.revocation.items():
+            rekey = path_id + REKEY_SUFFIX
+            if not self.fragments.exists(rekey):
+                continue
+            # Fragments written since they were read already use the new key
+            if digest is None or self._unchanged(path_id, digest):
+                self.fragments.replace(rekey, path_id)
+            else:
+                self.fragments.delete(rekey)
+        self.revocation = {}
+        self.dump()
+
     # --------------------------------------------------------------------- Filesystem methods
 
     def access(self, path, mode):
@@ -89,10 +636,12 @@ class FreyaFS(Operations):
     def chmod(self, path, mode):
         path_info = self.structure[path]
         self.metadata[path_info].chmod(mode)
+        self._publish_stats(path_info)
 
     def chown(self, path, uid, gid):
         path_info = self.structure[path]
         self.metadata[path_info].chown(uid, gid)
+        self._publish_stats(path_info)
 
     # Attributi di path (file o cartella)
     def getattr(self, path, fh=None):
@@ -126,11 +675,13 @@ class FreyaFS(Operations):
         path_info = self.structure[path]
         del self.structure[path]
         del self.metadata[path_info]
+        self._publish(op='remove', path=path)
 
     def mkdir(self, path, mode):
         path_info = PathInfo.make_only_id()
         self.structure.add(path, path_info)
         self.metadata.add_dir(path_info, mode)
+        self._publish_add(path, path_info)
 
     def statfs(self, path):
         actual_path = self._actual_path(path)
@@ -143,7 +694,7 @@ class FreyaFS(Operations):
     def unlink(self, path):
         path_info = self.structure.get(path, follow_symlinks=False)
         del self.structure[path]
-        del self.cids[path_info.path_id]
+        self._publish(op='remove', path=path)
 
         meta = self.metadata[path_info]
         if meta.is_dir():
@@ -151,10 +702,12 @@ class FreyaFS(Operations):
             return
 
         # Meta is file: decrement st_nlink and remove on 0
+        self._record('unlink', path_info)
         meta.dec_nlink()
         if meta.nlink == 0:
             del self.metadata[path_info]
-            os.remove(self.root / path_info.path_id)
+            # Other hard links share the same content, so only now it becomes garbage
+            self.cache.remove(path_info)
 
     # Used for SOFT links
     def symlink(self, name, target):
@@ -162,89 +715,183 @@ class FreyaFS(Operations):
         self.structure.add(name, path_info)
         self.metadata.add_soft_link(path_info, mode=0o777)
 
-        # The pointed path is kept in memory at all times for speed,
-        # but the symlink files contain also the path as their content
-        self.cache.create(path_info)
-        bytes_written, size = self.cache.write_bytes(path_info, target.encode('utf-8'), 0)
-        self.metadata[path_info].set_size(size)
-
-        self.cache.flush(path_info)
-        self.cache.release(path_info)
+        # The pointed path is kept in the (encrypted) structure, so there is
+        # no content to store
+        self.metadata[path_info].set_size(len(target.encode('utf-8')))
+        self._publish_add(name, path_info)
 
     def rename(self, old, new):
         # Renaming only moves around stuff, but does not rename actual files
         # on disk, nor fake names. So there is no need to update the cache.
         self.structure.rename(old, new)
+        self._publish(op='rename', old=old, new=new)
 
     # Used for HARD links
     def link(self, name, target):
         info = self.structure.add_hard_link(name, target)
         self.metadata[info].inc_nlink()
+        self._publish(op='link', path=name, target=target)
 
     def utimens(self, path, times=None):
         path_info = self.structure[path]
         self.metadata[path_info].utimens(times)
+        self._publish_stats(path_info)
 
     # --------------------------------------------------------------------- File methods
 
-    def open(self, path, flags):
+    def open(self, path, fi):
         if path not in self.structure:
             raise FuseOSError(errno.ENOENT)
         path_info = self.structure[path]
-        self.cache.open(path_info, self.metadata[path_info].stats['st_mtime'])
+        # Many nodes may read a file, while only one writes it
+        write = getattr(fi, 'flags', os.O_RDONLY) & os.O_ACCMODE != os.O_RDONLY
+        self._lease(path_info, write=write)
+        if write:
+            self._converge(path, path_info)
+        mtime = self.metadata[path_info].stats['st_mtime']
+        try:
+            # Front ends fetching blocks on their own hand them over with fi
+            self.cache.open(path_info, mtime, blocks=getattr(fi, 'blocks', None))
+        except BaseException:
+            self._unlease(path_info)
+            raise
+
+        # Let the kernel serve reads from its page cache, unless the file
+        # changed since the kernel last saw it
+        fi.keep_cache = 1 if self.cache.kernel_cache_valid(path_info, mtime) else 0
+        self._record('open', path_info)
         return 0
 
     def create(self, path, mode, fi=None):
         path_info = PathInfo.make()
         self.structure.add(path, path_info)
+        self.packer.assign(path_info.path_id, self.structure[str(Path(path).parent)].path_id)
         self.metadata.add_file(path_info, mode)
+        self._converge(path, path_info)
+        self._lease(path_info, write=True)
+        self._publish_add(path, path_info)
         self.cache.create(path_info)
+        self._commit(path_info)
+        self._record('create', path_info)
         return 0
 
     def read(self, path, length, offset, fh):
         path_info = self.structure[path]
+        self._record('read', path_info, offset, length)
         if path_info in self.cache:
             return self.cache.read_bytes(path_info, offset, length)
 
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        os.lseek(_fd(fh), offset, os.SEEK_SET)
+        return os.read(_fd(fh), length)
+
+    def read_resident(self, path, length, offset):
+        """Like read(), but returns None rather than waiting for the content
+        of the file to be loaded."""
+        path_info = self.structure[path]
+        data = self.cache.read_resident(path_info, offset, length)
+        if data is not None:
+            self._record('read', path_info, offset, length)
+        return data
 
     def write(self, path, buf, offset, fh):
         path_info = self.structure[path]
         if path_info in self.cache:
+            self._lease(path_info, write=True)
             bytes_written, size = self.cache.write_bytes(path_info, buf, offset)
             self.metadata[path_info].set_size(size)
+            self.metadata[path_info].set_allocated(self.cache.allocated(path_info))
+            self.metadata[path_info].set_mtime(self.cache.mtime(path_info))
+            self._record('write', path_info, offset, len(buf))
             return bytes_written
 
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        os.lseek(_fd(fh), offset, os.SEEK_SET)
+        return os.write(_fd(fh), buf)
 
     def truncate(self, path, length, fh=None):
         path_info = self.structure[path]
         if path_info in self.cache:
+            self._lease(path_info, write=True)
             self.cache.truncate_bytes(path_info, length)
             self.metadata[path_info].set_size(length)
+            self.metadata[path_info].set_allocated(self.cache.allocated(path_info))
+            self.metadata[path_info].set_mtime(self.cache.mtime(path_info))
+            self._record('truncate', path_info, length)
             return
 
-        actual_path = self._actual_path(path)
-        with open(actual_path, 'r+') as f:
-            f.truncate(length)
+        # Truncated by path, without being opened
+        self._lease(path_info, write=True)
+        try:
+            self.cache.open(path_info, self.metadata[path_info].stats['st_mtime'])
+            try:
+                self.truncate(path, length)
+                self.cache.flush(path_info)
+                self._commit(path_info)
+            finally:
+                self.cache.release(path_info)
+        finally:
+            self._unlease(path_info)
 
     def flush(self, path, fh):
         path_info = self.structure[path]
         if path_info in self.cache:
             self.cache.flush(path_info, force=True)
+            self._commit(path_info)
+            self._record('flush', path_info)
             return 0
 
-        return os.fsync(fh)
+        return os.fsync(_fd(fh))
 
     def release(self, path, fh):
         path_info = self.structure[path]
         if path_info in self.cache:
             self.cache.release(path_info)
+            self._unlease(path_info)
+            self._record('release', path_info)
             return 0
 
-        return os.close(fh)
+        return os.close(_fd(fh))
 
     def fsync(self, path, fdatasync, fh):
-        return self.flush(path, fh)
+        res = self.flush(path, fh)
+        self.cache.sync(self.structure[path])
+        self.packer.seal(self.structure[path].path_id)
+        self.fragments.sync()
+        self._record('fsync', self.structure[path])
+        return res
+
+    def ioctl(self, path, cmd, arg, fh, flags, data):
+        if cmd != FREYAFS_IOC_CLONE:
+            raise FuseOSError(errno.ENOTTY)
+
+        dest = ctypes.string_at(data, CLONE_PATH_MAX).split(b'\0', 1)[0].decode('utf-8')
+        dest = os.path.relpath(dest, self.mountpoint)
+        if dest.startswith('..'):
+            # Blocks can only be shared within the same file system
+            raise FuseOSError(errno.EXDEV)
+        self.clone(path, '/' + dest)
+        return 0
+
+    def clone(self, source, dest):
+        """Copy-on-write copy of source: the clone shares its stored blocks."""
+        if dest in self.structure:
+            raise FuseOSError(errno.EEXIST)
+        source_info = self.structure[source]
+        source_meta = self.metadata[source_info]
+        if not source_meta.is_file():
+            raise FuseOSError(errno.EISDIR)
+
+        # Same key and IV, so that unchanged macroblocks keep their CIDs
+        path_info = PathInfo.make(key=source_info.key, iv=source_info.iv)
+        self.structure.add(dest, path_info)
+        self.packer.assign(path_info.path_id, self.structure[str(Path(dest).parent)].path_id)
+        self.metadata.add_file(path_info, source_meta.stats['st_mode'] & 0o7777)
+        self.metadata[path_info].set_size(source_meta.stats['st_size'])
+        self.metadata[path_info].set_allocated(source_meta.stats.get('st_blocks', 0) * 512)
+        self._publish_add(dest, path_info)
+
+        self._lease(path_info, write=True)
+        try:
+            self.cache.clone(source_info, path_info)
+            self._commit(path_info)
+        finally:
+            self._unlease(path_info)
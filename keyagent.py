@@ -0,0 +1,58 @@
+import os
+import signal
+from argparse import ArgumentParser
+from pathlib import Path
+
+from utils import keyagent
+from utils.persist import generate_key, key_opens
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Agent keeping the keys of FreyaFS file systems, for mounts that do not ask for the password'
+    )
+    parser.add_argument('--socket',
+                        help=f'UNIX socket of the agent (default: {keyagent.default_socket()})',
+                        default=None)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='run the agent')
+    serve.add_argument('--timeout',
+                       metavar='SECONDS',
+                       help='how long keys are kept',
+                       type=int,
+                       default=keyagent.DEFAULT_TIMEOUT)
+
+    add = commands.add_parser('add', help='ask for the password of a file system and hand its key over')
+    add.add_argument('data',
+                     metavar='DATA',
+                     help='folder containing your encrypted files')
+
+    forget = commands.add_parser('forget', help='wipe the key of a file system, or every key')
+    forget.add_argument('data',
+                        metavar='DATA',
+                        nargs='?',
+                        default=None)
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        agent = keyagent.KeyAgent(socket_path=args.socket, timeout=args.timeout)
+        print(f'[*] FreyaFS key agent listening at {agent.socket_path}')
+        # Wipe the keys when stopped by the service manager as well
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            agent.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print('[*] FreyaFS key agent stopped, keys wiped')
+    elif args.command == 'add':
+        root = Path(args.data).resolve()
+        key = generate_key(ask_confirm=not os.path.exists(root / '.freyafs'))
+        if not key_opens(key, root / '.freyafs'):
+            parser.error('wrong password')
+        if not keyagent.add_key(str(root), key, args.socket):
+            parser.error('the agent is not running')
+    else:
+        ident = str(Path(args.data).resolve()) if args.data else None
+        keyagent.forget_keys(ident, args.socket)
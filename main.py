@@ -1,9 +1,24 @@
 import math
+import sys
 from argparse import ArgumentParser
+from pathlib import Path
 from fuse import FUSE
 
-from freyafs import FreyaFS
+from freyafs import FreyaFS, ATTR_TIMEOUT, PREFETCH_FRACTION, PREFETCH_TOP
+from utils.aioipfs import DEFAULT_CONCURRENCY
+from utils.collector import DEFAULT_RATE as DEFAULT_GC_RATE
+from storage import INLINE_THRESHOLD, PACK_THRESHOLD
+from storage.blockstore import BlockStoreKind, kinds as block_store_kinds
 from cache.eviction import EvictionTechnique, values as eviction_values
+from utils import keyagent, trace
+from utils.optrace import OpRecorder
+from utils.scheduler import Priority, values as priority_values
+from utils.compression import Codec, values as codec_values
+
+
+def bandwidth_cap(text):
+    name, _, rate = text.partition('=')
+    return Priority.parse(name), int(rate)
 
 
 if __name__ == '__main__':
@@ -25,10 +40,21 @@ if __name__ == '__main__':
                         help='run in multi-threaded mode',
                         action='store_true',
                         default=False)
+    parser.add_argument('--backend',
+                        help='FUSE front end: fusepy, or pyfuse3 to serve many requests concurrently '
+                             '(needs the pyfuse3 and trio packages)',
+                        choices=['fusepy', 'pyfuse3'],
+                        default='fusepy')
     parser.add_argument('--cache-max-mem',
                         help='maximum memory to allow for the cache of open files (in Bytes)',
                         type=int,
                         default=math.inf)
+    parser.add_argument('--cache-hard-limit',
+                        metavar='BYTES',
+                        help='memory the cache never exceeds, including the working memory of flushes and '
+                             'loads, which wait for room (default: no limit)',
+                        type=int,
+                        default=None)
     parser.add_argument('--eviction-technique',
                         help=f'how to perform cache eviction, one of {", ".join(eviction_values())}',
                         type=EvictionTechnique,
@@ -37,26 +63,202 @@ if __name__ == '__main__':
                         help='print metadata information to the terminal',
                         action='store_true',
                         default=False)
+    parser.add_argument('--block-store',
+                        help=f'where to store the mixed blocks, one of {", ".join(block_store_kinds())}',
+                        type=BlockStoreKind,
+                        default=BlockStoreKind.IPFS)
+    parser.add_argument('--block-store-path',
+                        metavar='PATH',
+                        help='directory (local) or database file (sqlite) of the block store '
+                             '(default: inside DATA)',
+                        default=None)
+    parser.add_argument('--ipfs-endpoint',
+                        metavar='URL',
+                        help='IPFS API (e.g. http://localhost:5001/api/v0) or gateway to fetch blocks from; '
+                             'can be repeated, blocks are written to the first one',
+                        action='append',
+                        default=None)
+    parser.add_argument('--ipfs-concurrency',
+                        help='maximum number of concurrent requests to the IPFS node',
+                        type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--bandwidth-cap',
+                        metavar='CLASS=BYTES',
+                        help='bytes per second the blocks of a class of jobs are transferred at most, '
+                             f'with CLASS one of {", ".join(priority_values())}; can be repeated',
+                        type=bandwidth_cap,
+                        action='append',
+                        default=None)
+    parser.add_argument('--gc-rate',
+                        help='maximum number of superseded IPFS blocks removed per second (0 disables it)',
+                        type=int,
+                        default=DEFAULT_GC_RATE)
+    parser.add_argument('--gc-dry-run',
+                        help='report the space reclaimable from superseded IPFS blocks and exit',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--pack-small-files',
+                        metavar='BYTES',
+                        help=f'store files up to BYTES (default: {PACK_THRESHOLD}) in shared per-directory packs',
+                        type=int,
+                        nargs='?',
+                        const=PACK_THRESHOLD,
+                        default=None)
+    parser.add_argument('--inline-threshold',
+                        metavar='BYTES',
+                        help='keep files up to BYTES within the encrypted metadata (-1 disables it)',
+                        type=int,
+                        default=INLINE_THRESHOLD)
+    parser.add_argument('--compress',
+                        metavar='CODEC',
+                        help=f'compress files before mixing them, with one of {", ".join(codec_values())} '
+                             '(zstd and lz4 need the zstandard and lz4 packages)',
+                        type=Codec,
+                        default=None)
+    parser.add_argument('--content-defined-chunks',
+                        help='cut files where their content allows it rather than every 256 KB, so that '
+                             'insertions only store again the chunks around them (needs numpy; chunks are '
+                             'padded to 256 KB, so files take more room)',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--fragment-segments',
+                        help='append the kept fragments of files to a few large segment files instead of '
+                             'one host file each, compacted in background (data folders using them keep '
+                             'using them)',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--convergent',
+                        metavar='DIR',
+                        help='encrypt the files written under DIR (a path within the mount) with key '
+                             'material derived from their content, so that identical 256 KB blocks are '
+                             'stored once (anyone with the metadata can tell which files share content); '
+                             'can be repeated, and is remembered',
+                        action='append',
+                        default=None)
+    parser.add_argument('--group-commit',
+                        metavar='MS',
+                        help='store the flushes of small files on close in groups, waiting up to MS '
+                             'milliseconds for others to join (close returns before the file is stored, '
+                             'fsync waits for it)',
+                        type=float,
+                        default=None)
+    parser.add_argument('--prefetch-fraction',
+                        help='fraction of --cache-max-mem used to prefetch the files used the most '
+                             'in previous sessions (0 disables it, as does an unlimited cache)',
+                        type=float,
+                        default=PREFETCH_FRACTION)
+    parser.add_argument('--prefetch-top',
+                        metavar='K',
+                        help='maximum number of files to prefetch',
+                        type=int,
+                        default=PREFETCH_TOP)
+    parser.add_argument('--attr-timeout',
+                        metavar='SECONDS',
+                        help='how long the kernel caches file attributes and lookups',
+                        type=float,
+                        default=ATTR_TIMEOUT)
+    parser.add_argument('--key-agent',
+                        metavar='SOCKET',
+                        help='get the key from the agent started with keyagent.py instead of asking for the '
+                             'password (which is handed over to the agent otherwise)',
+                        nargs='?',
+                        const=str(keyagent.default_socket()),
+                        default=None)
+    parser.add_argument('--cluster',
+                        metavar='HOST:PORT',
+                        help='share the file system with other nodes through the coordinator started with '
+                             'coordinator.py (the block store must be shared as well)',
+                        default=None)
+    parser.add_argument('--node-id',
+                        metavar='NAME',
+                        help='name of this node within the cluster (default: host name and process id)',
+                        default=None)
+    parser.add_argument('--trace',
+                        metavar='FILE',
+                        help='record a Chrome/Perfetto trace of FreyaFS operations to FILE',
+                        default=None)
+    parser.add_argument('--record-ops',
+                        metavar='FILE',
+                        help='record the file operations, without names nor contents, to FILE, for simulate.py '
+                             'to find out how large the cache should be',
+                        default=None)
 
     args = parser.parse_args()
+    if args.compress is not None and args.content_defined_chunks:
+        parser.error('--compress and --content-defined-chunks cannot be used together')
     data = args.data
     mountpoint = args.mountpoint
 
+    if args.trace:
+        trace.enable(args.trace)
+
     print('[*] Mounting FreyaFS...')
+    block_store = args.block_store.open(Path(data), path=args.block_store_path,
+                                        concurrency=args.ipfs_concurrency,
+                                        endpoints=args.ipfs_endpoint)
     fs = FreyaFS(data,
                  mountpoint,
                  memory_cap=args.cache_max_mem,
                  eviction_technique=args.eviction_technique,
-                 dump_metadata=args.dump_metadata)
-    FUSE(fs,
-         mountpoint,
-         foreground=True,
-         debug=args.debug,
-         nothreads=not args.multithread,
-         big_writes=True)
+                 dump_metadata=args.dump_metadata,
+                 ipfs_concurrency=args.ipfs_concurrency,
+                 gc_rate=0 if args.gc_dry_run else args.gc_rate,
+                 pack_threshold=args.pack_small_files,
+                 inline_threshold=args.inline_threshold if args.inline_threshold >= 0 else None,
+                 block_store=block_store,
+                 prefetch_fraction=0 if args.gc_dry_run else args.prefetch_fraction,
+                 prefetch_top=args.prefetch_top,
+                 memory_limit=args.cache_hard_limit,
+                 key_agent=args.key_agent,
+                 cluster=args.cluster,
+                 node=args.node_id,
+                 compression=args.compress,
+                 chunking=args.content_defined_chunks,
+                 recorder=OpRecorder(args.record_ops) if args.record_ops else None,
+                 bandwidth_caps=dict(args.bandwidth_cap) if args.bandwidth_cap else None,
+                 fragment_segments=args.fragment_segments,
+                 group_commit=args.group_commit / 1000 if args.group_commit is not None else None,
+                 convergent_dirs=args.convergent)
+
+    if args.gc_dry_run:
+        blocks, size = fs.collector.report()
+        print(f'[i] {blocks} superseded blocks can be reclaimed ({size} B)')
+        fs.close()
+        sys.exit()
+
+    if args.backend == 'pyfuse3':
+        import asyncfs
+        asyncfs.mount(fs, mountpoint, debug=args.debug, attr_timeout=args.attr_timeout)
+    else:
+        FUSE(fs,
+             mountpoint,
+             foreground=True,
+             debug=args.debug,
+             nothreads=not args.multithread,
+             big_writes=True,
+             # open() decides whether the kernel keeps the cached pages of a file
+             # (kernel_cache and auto_cache would override that decision)
+             raw_fi=True,
+             attr_timeout=args.attr_timeout,
+             entry_timeout=args.attr_timeout)
 
     print('\n[*] Unmounting FreyaFS...')
+    for resource, classes in fs.scheduler.stats().items():
+        waited = ', '.join(f'{name} {stats["waited"]:.1f} s' for name, stats in classes.items() if stats['granted'])
+        if waited:
+            print(f'[i] Time waited for {resource} slots: {waited}')
     print('[*] FreyaFS unmounted')
     print('[*] Updating FreyaFS metadata...')
     fs.dump()
+    fs.close()
     print('[*] FreyaFS metadata updated')
+    if fs.convergent_dirs:
+        dedup = fs.cache.dedup.report()
+        print(f'[i] Deduplication saved {dedup["uploads_saved"]} B of uploads in this session, '
+              f'{dedup["stored_bytes_saved"]} B of storage overall.')
+    if args.record_ops:
+        print(f'[*] Operations recorded at {args.record_ops}')
+
+    if args.trace:
+        trace.save()
+        print(f'[*] Trace saved at {args.trace}')
@@ -72,6 +72,13 @@ class PathMetadata:
     def set_size(self, size):
         self.stats['st_size'] = size
 
+    def set_mtime(self, mtime):
+        self.stats['st_mtime'] = mtime
+
+    def set_allocated(self, allocated):
+        # In 512 B units, whatever the block size: holes are not counted
+        self.stats['st_blocks'] = (allocated + 511) // 512
+
     @property
     def nlink(self):
         return self.stats['st_nlink']
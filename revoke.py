@@ -0,0 +1,54 @@
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+
+from cache.eviction import EvictionTechnique
+from freyafs import FreyaFS, REVOKE_WORKERS
+from storage.blockstore import MemoryBlockStore
+from utils import keyagent
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Revoke access to files of an unmounted FreyaFS, rewrapping their local fragments with new keys'
+    )
+    parser.add_argument('data',
+                        metavar='DATA',
+                        help='folder containing your encrypted files')
+    parser.add_argument('paths',
+                        metavar='PATH',
+                        help='file or directory, within the file system, to revoke (default: everything)',
+                        nargs='*',
+                        default=['/'])
+    parser.add_argument('--workers',
+                        metavar='N',
+                        help='files rewrapped at the same time',
+                        type=int,
+                        default=REVOKE_WORKERS)
+    parser.add_argument('--key-agent',
+                        metavar='SOCKET',
+                        help='get the key from the agent started with keyagent.py instead of asking for the password',
+                        nargs='?',
+                        const=str(keyagent.default_socket()),
+                        default=None)
+    args = parser.parse_args()
+
+    # Only the fragments are touched: the block store is never used
+    with redirect_stdout(sys.stderr):
+        fs = FreyaFS(args.data, args.data, memory_cap=float('inf'), eviction_technique=EvictionTechnique.LRU,
+                     dump_metadata=False, gc_rate=0, block_store=MemoryBlockStore(), prefetch_fraction=0,
+                     key_agent=args.key_agent)
+
+    missing = [path for path in args.paths if path not in fs.structure]
+    if missing:
+        fs.close()
+        parser.error(f'no such file or directory: {", ".join(missing)}')
+
+    def progress(done, total, written):
+        print(f'\r[i] {done}/{total} files, {written} B rewritten', end='', flush=True)
+
+    try:
+        files, written = fs.revoke(args.paths, workers=args.workers, progress=progress)
+    finally:
+        fs.close()
+    print(f'\r[*] Revoked {files} files, {written} B of fragments rewritten, nothing transferred')
@@ -0,0 +1,283 @@
+import errno
+import json
+import math
+import sys
+import tempfile
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+
+from fuse import FuseOSError
+
+from aesmix256k import MACRO_SIZE
+from cache import Cache
+from cache.cache import LOCK
+from cache.eviction import EvictionTechnique, values as eviction_values
+from structure import PathInfo
+from utils.filebytecontent import FileByteContent
+from utils.optrace import read_ops
+
+# Replays the operations recorded with --record-ops against the cache of
+# FreyaFS, for each eviction technique and cache size. File contents, mixing
+# and the block store are left out: only sizes move around, so traces of
+# large file systems replay in seconds. Each result is printed as a JSON line.
+#
+# Closed files stay cached until evicted, as pages in the page cache do:
+# FreyaFS itself only keeps open (and prefetched) files, which rarely fill
+# the cache, so eviction techniques could not be told apart otherwise.
+
+DEFAULT_FRACTIONS = [1/32, 1/16, 1/8, 1/4, 1/2, 1]  # of the data the trace touches
+
+
+class _Blank:
+    """Stands for the data of a write, only its length matters."""
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+class SimulatedContent:
+    """Content of a cached file, as a size and the macroblocks written."""
+
+    def __init__(self, size=0):
+        self._size = size
+        self._dirty = set()
+
+    def __len__(self):
+        return self._size
+
+    def allocated(self):
+        return self._size
+
+    def footprint(self):
+        return self._size
+
+    def write_need(self, length, offset):
+        return max(offset + length - self._size, 0)
+
+    def snapshot(self):
+        dirty, self._dirty = self._dirty, set()
+        return {}, self._size, dirty
+
+    def release_snapshot(self):
+        pass
+
+    def restore_dirty(self, dirty):
+        self._dirty |= dirty
+
+    def read_bytes(self, offset, length, unpack=True):
+        return b''
+
+    def write_bytes(self, buf, offset):
+        if len(buf):
+            self._dirty.update(range(offset // MACRO_SIZE, (offset + len(buf) - 1) // MACRO_SIZE + 1))
+        self._size = max(self._size, offset + len(buf))
+        return len(buf)
+
+    def truncate(self, length):
+        if length < self._size:
+            self._dirty.add(length // MACRO_SIZE)
+        self._size = length
+
+
+class SimulatedCache(Cache):
+    """Cache whose files are loaded and stored by counting bytes."""
+
+    def __init__(self, root, capacity, technique, clock):
+        super().__init__(root=root, eviction_technique=technique, ipfs_cids={}, memory_cap=capacity, clock=clock)
+        self.stored = {}  # path_id -> size in storage
+        self.unlinked = set()  # path_ids whose entries go once released
+        self.stats = Counter()
+
+    def _decrypt(self, path: PathInfo, blocks=None):
+        size = self.stored.get(path.path_id, 0)
+        self.stats['loads'] += 1
+        self.stats['bytes_fetched'] += size
+        return SimulatedContent(size)
+
+    def _encrypt(self, path: PathInfo):
+        entry = self.files[path]
+        _, size, dirty = entry.content.snapshot()
+        blocks = (size + MACRO_SIZE - 1) // MACRO_SIZE
+        if path.path_id in self.stored:
+            # Unchanged macroblocks keep their blocks
+            mixed = len([i for i in dirty if i < blocks])
+        else:
+            mixed = blocks
+        self.stats['flushes'] += 1
+        self.stats['bytes_encrypted'] += min(mixed * MACRO_SIZE, size)
+        self.stored[path.path_id] = size
+        entry.stored_size = size
+
+    def create(self, path: PathInfo):
+        self.unlinked.discard(path.path_id)
+        super().create(path)
+        entry = self.files.get(path)
+        if entry is not None and isinstance(entry.content, FileByteContent):
+            # Created empty
+            entry.content = SimulatedContent()
+
+    def _load_need(self, path: PathInfo):
+        return 0
+
+    def _evict(self, path: PathInfo, entry):
+        self.stats['evictions'] += 1
+        super()._evict(path, entry)
+
+    def release(self, path: PathInfo, force=False):
+        with LOCK:
+            entry = self.files.get(path)
+            if not force and entry is not None and path.path_id not in self.unlinked:
+                # Kept, closed
+                entry.opens = max(entry.opens - 1, 0)
+                return
+        super().release(path, force)
+
+    def remove(self, path: PathInfo):
+        self.stored.pop(path.path_id, None)
+        with LOCK:
+            entry = self.files.get(path)
+            self.unlinked.add(path.path_id)
+        if entry is not None and not entry.opens:
+            super().release(path, force=True)
+
+
+def working_set(trace):
+    """Returns the largest size each file of the trace reaches, summed up."""
+    sizes = {}
+    for op in read_ops(trace):
+        sizes[op.file] = max(sizes.get(op.file, 0), op.size)
+    return sum(sizes.values())
+
+
+def simulate(trace, technique: EvictionTechnique, capacity):
+    now = [0.0]
+    with tempfile.TemporaryDirectory(prefix='freyafs-simulate-') as root:
+        cache = SimulatedCache(Path(root), capacity, technique, clock=lambda: now[0])
+        paths = {}
+        opens = Counter()
+        mtimes = {}
+        hits = misses = ops = 0
+
+        for op in read_ops(trace):
+            now[0] = op.time
+            ops += 1
+            path = paths.get(op.file)
+            if path is None:
+                path = paths[op.file] = PathInfo.make_only_id(str(op.file))
+                if op.op != 'create':
+                    # Stored before the trace started
+                    cache.stored[path.path_id] = op.size
+
+            if op.op in ('fsync', 'unlink'):
+                # fsync follows a flush, unlinked files stay open until released
+                if op.op == 'unlink':
+                    cache.remove(path)
+                continue
+            if op.op == 'release':
+                if opens[op.file]:
+                    opens[op.file] -= 1
+                    cache.release(path)
+                continue
+
+            cached = path in cache
+            try:
+                if op.op == 'create':
+                    cache.create(path)
+                    opens[op.file] += 1
+                    continue
+                if op.op == 'open':
+                    cache.open(path, mtimes.get(op.file, 1))
+                    opens[op.file] += 1
+                else:
+                    # Truncated by path, or open since before the trace
+                    implicit = not opens[op.file]
+                    if implicit:
+                        cache.open(path, mtimes.get(op.file, 1))
+                    if op.op == 'read':
+                        cache.read_bytes(path, op.offset, op.length)
+                    elif op.op == 'write':
+                        cache.write_bytes(path, _Blank(op.length), op.offset)
+                    elif op.op == 'truncate':
+                        cache.truncate_bytes(path, op.offset)
+                    elif op.op == 'flush':
+                        cache.flush(path, force=True)
+                        mtimes[op.file] = max(int(op.time), 1)
+                    if implicit:
+                        cache.flush(path, force=False)
+                        cache.release(path)
+            except FuseOSError as e:
+                if e.errno != errno.ENOMEM:
+                    raise
+                # Larger than the whole cache: served from the store, a miss
+                cache.stats['rejected'] += 1
+                if op.op != 'flush':
+                    misses += 1
+                continue
+
+            if op.op != 'flush':
+                if cached:
+                    hits += 1
+                else:
+                    misses += 1
+
+    return {
+        'technique': technique.value,
+        'capacity': capacity,
+        'ops': ops,
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+        'loads': cache.stats['loads'],
+        'bytes_fetched': cache.stats['bytes_fetched'],
+        'flushes': cache.stats['flushes'],
+        'bytes_encrypted': cache.stats['bytes_encrypted'],
+        'evictions': cache.stats['evictions'],
+        'rejected': cache.stats['rejected'],
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        description='Replay the operations recorded by FreyaFS (--record-ops) against its cache, '
+                    'for several eviction techniques and cache sizes'
+    )
+    parser.add_argument('trace',
+                        metavar='TRACE',
+                        help='file written by --record-ops')
+    parser.add_argument('--capacities',
+                        metavar='BYTES',
+                        help='cache sizes to try (default: fractions of the data the trace touches, '
+                             f'{", ".join(f"{f:g}" for f in DEFAULT_FRACTIONS)})',
+                        type=int,
+                        nargs='+',
+                        default=None)
+    parser.add_argument('--eviction-techniques',
+                        metavar='TECHNIQUE',
+                        help=f'eviction techniques to try, among {", ".join(eviction_values())} (default: all)',
+                        type=EvictionTechnique,
+                        nargs='+',
+                        default=list(EvictionTechnique))
+    parser.add_argument('-o', '--output',
+                        metavar='FILE',
+                        help='append the JSON lines to FILE instead of printing them',
+                        default=None)
+    args = parser.parse_args()
+
+    capacities = args.capacities
+    if capacities is None:
+        total = working_set(args.trace)
+        capacities = sorted({max(math.ceil(total * f), MACRO_SIZE) for f in DEFAULT_FRACTIONS})
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for technique in args.eviction_techniques:
+            for capacity in capacities:
+                out.write(json.dumps(simulate(args.trace, technique, capacity)) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
@@ -0,0 +1,2 @@
+from .inline import *
+from .packer import *
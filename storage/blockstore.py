@@ -0,0 +1,291 @@
+import os
+import sqlite3
+import threading
+
+from concurrent.futures import Future
+from enum import Enum
+from pathlib import Path
+
+from aesmix256k import MACRO_SIZE
+from utils.aioipfs import AsyncBlockClient, DEFAULT_CONCURRENCY
+from utils.ipfs import IPFS_API, cid_of
+from utils.trace import span
+
+
+def _done(f, *args):
+    future = Future()
+    try:
+        future.set_result(f(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class BlockStore:
+    """Content-addressed storage of the mixed blocks.
+
+    Subclasses implement put/get (or the submit_* variants, when transfers can
+    overlap), delete and size. The submit_* methods return futures.
+    """
+
+    def put(self, data):
+        raise NotImplementedError
+
+    def get(self, cid):
+        raise NotImplementedError
+
+    def delete(self, cid):
+        raise NotImplementedError
+
+    def size(self, cid):
+        """Returns the size of the block, or None if it is not stored."""
+        raise NotImplementedError
+
+    def submit_put(self, data):
+        return _done(self.put, data)
+
+    def submit_get(self, cid):
+        return _done(self.get, cid)
+
+    def put_many(self, blocks):
+        futures = [self.submit_put(block) for block in blocks]
+        return [f.result() for f in futures]
+
+    def get_many(self, cids):
+        futures = [self.submit_get(cid) for cid in cids]
+        return [f.result() for f in futures]
+
+    def close(self):
+        pass
+
+
+class ScheduledBlockStore(BlockStore):
+    """Block store whose transfers wait for a network slot of the scheduler."""
+
+    def __init__(self, store: BlockStore, scheduler):
+        self.store = store
+        self.scheduler = scheduler
+
+    def _scheduled(self, submit, arg, size=0):
+        token = self.scheduler.acquire('net', size)
+        try:
+            future = submit(arg)
+        except BaseException:
+            self.scheduler.release(token)
+            raise
+        future.add_done_callback(lambda _: self.scheduler.release(token))
+        return future
+
+    def put(self, data):
+        return self.submit_put(data).result()
+
+    def get(self, cid):
+        return self.submit_get(cid).result()
+
+    def submit_put(self, data):
+        return self._scheduled(self.store.submit_put, data, len(data))
+
+    def submit_get(self, cid):
+        # Blocks are about a macroblock large
+        return self._scheduled(self.store.submit_get, cid, MACRO_SIZE)
+
+    def delete(self, cid):
+        with self.scheduler.slot('net'):
+            self.store.delete(cid)
+
+    def size(self, cid):
+        with self.scheduler.slot('net'):
+            return self.store.size(cid)
+
+    def close(self):
+        self.store.close()
+
+
+class FetchedBlockStore(BlockStore):
+    """Serves the blocks fetched beforehand, and gets the other ones from store."""
+
+    def __init__(self, store: BlockStore, blocks: dict):
+        self.store = store
+        self.blocks = blocks
+
+    def put(self, data):
+        return self.store.put(data)
+
+    def get(self, cid):
+        return self.submit_get(cid).result()
+
+    def submit_put(self, data):
+        return self.store.submit_put(data)
+
+    def submit_get(self, cid):
+        if cid in self.blocks:
+            return _done(self.blocks.get, cid)
+        return self.store.submit_get(cid)
+
+    def delete(self, cid):
+        self.store.delete(cid)
+
+    def size(self, cid):
+        return self.store.size(cid)
+
+
+class IpfsBlockStore(BlockStore):
+    """Blocks stored by an IPFS node, through its HTTP API."""
+
+    def __init__(self, api=IPFS_API, concurrency=DEFAULT_CONCURRENCY, endpoints=None):
+        self.client = AsyncBlockClient(api=api, concurrency=concurrency, endpoints=endpoints)
+
+    def put(self, data):
+        return self.submit_put(data).result()
+
+    def get(self, cid):
+        return self.submit_get(cid).result()
+
+    def submit_put(self, data):
+        return self.client.submit_put(data)
+
+    def submit_get(self, cid):
+        return self.client.submit_get(cid)
+
+    def delete(self, cid):
+        self.client.submit_rm(cid).result()
+
+    def size(self, cid):
+        return self.client.submit_stat(cid).result()
+
+    def close(self):
+        self.client.close()
+
+
+class LocalBlockStore(BlockStore):
+    """Blocks stored as files of a local directory, sharded by CID."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, cid):
+        # Like flatfs, shard on the next-to-last characters of the CID
+        return self.root / cid[-3:-1] / cid
+
+    def put(self, data):
+        cid = cid_of(data)
+        path = self._path(cid)
+        if path.exists():
+            return cid
+
+        with span('local.put', cat='blocks', size=len(data)):
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name(f'.{cid}.{threading.get_ident()}')
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return cid
+
+    def get(self, cid):
+        with span('local.get', cat='blocks'), open(self._path(cid), 'rb') as f:
+            return f.read()
+
+    def delete(self, cid):
+        try:
+            os.remove(self._path(cid))
+        except FileNotFoundError:
+            pass
+
+    def size(self, cid):
+        try:
+            return os.path.getsize(self._path(cid))
+        except FileNotFoundError:
+            return None
+
+
+class SqliteBlockStore(BlockStore):
+    """Blocks stored in a single SQLite database file."""
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(filename), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks (cid TEXT PRIMARY KEY, data BLOB NOT NULL)')
+        self.db.commit()
+
+    def put(self, data):
+        cid = cid_of(data)
+        with self.lock, span('sqlite.put', cat='blocks', size=len(data)):
+            self.db.execute('INSERT OR IGNORE INTO blocks (cid, data) VALUES (?, ?)', (cid, data))
+            self.db.commit()
+        return cid
+
+    def get(self, cid):
+        with self.lock, span('sqlite.get', cat='blocks'):
+            row = self.db.execute('SELECT data FROM blocks WHERE cid = ?', (cid,)).fetchone()
+        if row is None:
+            raise KeyError(cid)
+        return row[0]
+
+    def delete(self, cid):
+        with self.lock:
+            self.db.execute('DELETE FROM blocks WHERE cid = ?', (cid,))
+            self.db.commit()
+
+    def size(self, cid):
+        with self.lock:
+            row = self.db.execute('SELECT length(data) FROM blocks WHERE cid = ?', (cid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class MemoryBlockStore(BlockStore):
+    """Blocks kept in memory, for tests and benchmarks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}
+
+    def put(self, data):
+        cid = cid_of(data)
+        with self.lock:
+            self.blocks[cid] = bytes(data)
+        return cid
+
+    def get(self, cid):
+        with self.lock:
+            return self.blocks[cid]
+
+    def delete(self, cid):
+        with self.lock:
+            self.blocks.pop(cid, None)
+
+    def size(self, cid):
+        with self.lock:
+            block = self.blocks.get(cid)
+        return len(block) if block is not None else None
+
+
+class BlockStoreKind(Enum):
+    IPFS = 'ipfs'
+    LOCAL = 'local'
+    SQLITE = 'sqlite'
+
+    def default_path(self, root: Path):
+        if self == BlockStoreKind.LOCAL:
+            return root / '.blocks'
+        if self == BlockStoreKind.SQLITE:
+            return root / '.blocks.sqlite'
+        return None
+
+    def open(self, root: Path, path=None, concurrency=DEFAULT_CONCURRENCY, endpoints=None):
+        path = path if path is not None else self.default_path(root)
+        if self == BlockStoreKind.LOCAL:
+            return LocalBlockStore(path)
+        if self == BlockStoreKind.SQLITE:
+            return SqliteBlockStore(path)
+        return IpfsBlockStore(concurrency=concurrency, endpoints=endpoints)
+
+
+def kinds():
+    return [k.value for k in BlockStoreKind]
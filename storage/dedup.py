@@ -0,0 +1,62 @@
+import threading
+
+from aesmix256k import MACRO_SIZE
+
+from utils.mixslice import SIZE_TO_KEEP
+
+STORED_BLOCK_SIZE = MACRO_SIZE - SIZE_TO_KEEP
+
+
+class DedupIndex:
+    """CIDs of the convergent macroblocks stored, by digest.
+
+    Each entry counts the macroblocks of stored files referencing it, and
+    goes away with the last one: the collector may then remove the block,
+    so it must not be handed out anymore. The index is built again from the
+    digests of each file and the CID map at every mount.
+    """
+
+    def __init__(self):
+        self.entries = {}  # digest -> [cid, references]
+        self.uploads_saved = 0  # bytes not uploaded since the mount
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            return entry[0] if entry is not None else None
+
+    def add(self, digests, cids):
+        with self.lock:
+            for digest, cid in zip(digests, cids):
+                if digest is None or cid is None:
+                    continue
+                entry = self.entries.setdefault(digest, [cid, 0])
+                entry[1] += 1
+
+    def remove(self, digests, cids):
+        with self.lock:
+            for digest, cid in zip(digests, cids):
+                entry = self.entries.get(digest)
+                if entry is None or entry[0] != cid:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.entries[digest]
+
+    def skipped(self, size):
+        with self.lock:
+            self.uploads_saved += size
+
+    def report(self):
+        """Returns the number of distinct blocks, of references to them, and
+        the bytes of storage and of uploads saved."""
+        with self.lock:
+            blocks = len(self.entries)
+            references = sum(refs for _, refs in self.entries.values())
+            return {
+                'blocks': blocks,
+                'references': references,
+                'stored_bytes_saved': (references - blocks) * STORED_BLOCK_SIZE,
+                'uploads_saved': self.uploads_saved,
+            }
@@ -0,0 +1,335 @@
+import os
+import shutil
+import threading
+
+from collections import Counter
+from pathlib import Path
+
+from utils.fastfile import FastFile
+from utils.trace import span
+
+SEGMENTS_DIR = '.segments'
+SEGMENT_SIZE = 64 * 1024 * 1024  # bytes appended to a segment before starting a new one
+SYNC_INTERVAL = 1  # seconds between two fsyncs of the segment being written
+COMPACT_INTERVAL = 30  # seconds between two compactions
+COMPACT_RATIO = 0.5  # segments with less live data than this are compacted
+
+
+class Fragment:
+    """The kept fragments of one file (or pack), as MixSlice reads and writes them."""
+
+    def __init__(self, store, fid):
+        self.store = store
+        self.fid = fid
+
+    def read(self):
+        return self.store.read(self.fid)
+
+    def write(self, data):
+        self.store.write(self.fid, data)
+
+
+class FragmentStore:
+    """Where the kept fragments of files are, by file (or pack) id.
+
+    Subclasses implement read, write, delete, exists and size.
+    """
+
+    def fragment(self, fid):
+        return Fragment(self, fid)
+
+    def read(self, fid):
+        raise NotImplementedError
+
+    def write(self, fid, data):
+        raise NotImplementedError
+
+    def delete(self, fid):
+        raise NotImplementedError
+
+    def exists(self, fid):
+        raise NotImplementedError
+
+    def size(self, fid):
+        raise NotImplementedError
+
+    def copy(self, source, dest):
+        self.write(dest, self.read(source))
+
+    def replace(self, source, dest):
+        """Moves the fragments of source over the ones of dest."""
+        self.write(dest, self.read(source))
+        self.delete(source)
+
+    def touch(self, fid, atime, mtime):
+        pass
+
+    def sync(self):
+        """Makes the writes so far durable."""
+        pass
+
+    def to_dict(self):
+        return None
+
+    def checkpoint(self):
+        """To be called once the dict last returned by to_dict() is persisted."""
+        pass
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileFragmentStore(FragmentStore):
+    """One host file per id, named after it, in the data folder."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, fid):
+        return (self.root / fid).absolute()
+
+    def read(self, fid):
+        with span('fastfile.read', cat='disk'), FastFile(self._path(fid), 'r') as f:
+            return f.read()
+
+    def write(self, fid, data):
+        with span('fastfile.write', cat='disk', size=len(data)), FastFile(self._path(fid), 'w') as f:
+            f.write(data)
+            f.truncate(len(data))
+
+    def delete(self, fid):
+        try:
+            os.remove(self._path(fid))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, fid):
+        return self._path(fid).exists()
+
+    def size(self, fid):
+        return os.path.getsize(self._path(fid))
+
+    def copy(self, source, dest):
+        shutil.copyfile(self._path(source), self._path(dest))
+
+    def replace(self, source, dest):
+        os.replace(self._path(source), self._path(dest))
+
+    def touch(self, fid, atime, mtime):
+        if self.exists(fid):
+            os.utime(self._path(fid), (atime, mtime))
+
+
+class SegmentFragmentStore(FragmentStore):
+    """Fragments appended to a few large segment files.
+
+    The index, from id to (segment, offset, length), is kept in memory and
+    saved within the metadata. Nothing is ever written over: segments whose
+    data is mostly superseded are compacted in background, by moving their
+    live fragments to the segment being written, and deleted once an index
+    not referencing them is saved. Writes are made durable by a single
+    fsync every SYNC_INTERVAL, and before the index is saved.
+
+    Fragments of files written before, one host file per id, are still
+    read, and moved to the segments when written again.
+    """
+
+    def __init__(self, root, data=None, segment_size=SEGMENT_SIZE):
+        self.dir = Path(root) / SEGMENTS_DIR
+        self.dir.mkdir(exist_ok=True)
+        self.files = FileFragmentStore(root)
+        self.segment_size = segment_size
+
+        self.index = {}  # fid -> (segment, offset, length)
+        self.members = {}  # segment -> fids
+        self.live = Counter()  # segment -> bytes
+        self.written = Counter()  # segment -> bytes
+        # Deleted once an index not referencing them is saved
+        self.retired = set()  # segments
+        self.obsolete = set()  # host files
+        self._saved = (set(), set())
+        self.lock = threading.RLock()
+        self._fds = {}
+        self._unsynced = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+        data = data if data is not None else {}
+        for fid, (segment, offset, length) in data.get('index', {}).items():
+            self._add(fid, segment, offset, length)
+        for segment, size in data.get('written', {}).items():
+            self.written[int(segment)] = size
+
+        # Segments not referenced by the saved index hold nothing live
+        # (written after the last save, or already compacted)
+        self.active = max([data.get('next', 0)] + [segment + 1 for segment in self.members])
+        for name in os.listdir(self.dir):
+            segment = int(name.split('.')[0])
+            if segment not in self.members:
+                os.remove(self.dir / name)
+
+    def _name(self, segment):
+        return self.dir / f'{segment:08d}.seg'
+
+    def _fd(self, segment):
+        fd = self._fds.get(segment)
+        if fd is None:
+            fd = self._fds[segment] = os.open(self._name(segment), os.O_RDWR | os.O_CREAT, 0o600)
+        return fd
+
+    def _add(self, fid, segment, offset, length):
+        self._remove(fid)
+        self.index[fid] = (segment, offset, length)
+        self.members.setdefault(segment, set()).add(fid)
+        self.live[segment] += length
+
+    def _remove(self, fid):
+        old = self.index.pop(fid, None)
+        if old is None:
+            return
+        segment, _, length = old
+        self.members[segment].discard(fid)
+        self.live[segment] -= length
+        if not self.members[segment]:
+            del self.members[segment]
+            self._retire(segment)
+
+    def _retire(self, segment):
+        if segment == self.active:
+            return
+        self.retired.add(segment)
+        self._unsynced.discard(segment)
+        fd = self._fds.pop(segment, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _append(self, fid, data):
+        if self.written[self.active] and self.written[self.active] + len(data) > self.segment_size:
+            # The full segment is synced along with the next one
+            self.active += 1
+        offset = self.written[self.active]
+        with span('segment.append', cat='disk', size=len(data)):
+            os.pwrite(self._fd(self.active), data, offset)
+        self.written[self.active] += len(data)
+        self._unsynced.add(self.active)
+        self._add(fid, self.active, offset, len(data))
+
+    # ------------------------------------------------------ Fragments
+
+    def read(self, fid):
+        with self.lock:
+            location = self.index.get(fid)
+            if location is None:
+                return self.files.read(fid)
+            segment, offset, length = location
+            with span('segment.read', cat='disk', size=length):
+                return os.pread(self._fd(segment), length, offset)
+
+    def _obsolete(self, fid):
+        # The saved index may still send readers to the host file
+        if fid not in self.obsolete and self.files.exists(fid):
+            self.obsolete.add(fid)
+
+    def write(self, fid, data):
+        with self.lock:
+            self._append(fid, data)
+            self._obsolete(fid)
+
+    def delete(self, fid):
+        with self.lock:
+            self._remove(fid)
+            self._obsolete(fid)
+
+    def exists(self, fid):
+        with self.lock:
+            return fid in self.index or (fid not in self.obsolete and self.files.exists(fid))
+
+    def size(self, fid):
+        with self.lock:
+            if fid in self.index:
+                return self.index[fid][2]
+            return self.files.size(fid)
+
+    def replace(self, source, dest):
+        with self.lock:
+            if source not in self.index:
+                # Moved to the segments on the way
+                self.write(source, self.files.read(source))
+            self._add(dest, *self.index[source])
+            self._remove(source)
+            self._obsolete(dest)
+
+    # ------------------------------------------------------ Durability and compaction
+
+    def sync(self):
+        with self.lock:
+            if not self._unsynced:
+                return
+            with span('segment.sync', cat='disk', segments=len(self._unsynced)):
+                for segment in self._unsynced:
+                    if segment in self._fds:
+                        os.fsync(self._fds[segment])
+            self._unsynced = set()
+
+    def to_dict(self):
+        with self.lock:
+            self._saved = (set(self.retired), set(self.obsolete))
+            return {
+                'index': {fid: list(location) for fid, location in self.index.items()},
+                'written': {str(segment): self.written[segment] for segment in self.members},
+                'next': self.active + 1,
+            }
+
+    def checkpoint(self):
+        with self.lock:
+            segments, files = self._saved
+            for segment in segments:
+                self._name(segment).unlink(missing_ok=True)
+            for fid in files:
+                self.files.delete(fid)
+            self.retired -= segments
+            self.obsolete -= files
+            self._saved = (set(), set())
+
+    def compact(self, limit=None):
+        """Moves the live fragments of mostly dead segments to the active one.
+        Returns the number of segments compacted."""
+        with self.lock:
+            sparse = [segment for segment in self.members
+                      if segment < self.active and self.live[segment] < self.written[segment] * COMPACT_RATIO]
+        compacted = 0
+        for segment in sparse[:limit]:
+            with self.lock, span('segment.compact', cat='disk', segment=segment):
+                for fid in list(self.members.get(segment, ())):
+                    self._append(fid, self.read(fid))
+            compacted += 1
+        return compacted
+
+    def _run(self):
+        waited = 0
+        while not self._stop.wait(SYNC_INTERVAL):
+            self.sync()
+            waited += SYNC_INTERVAL
+            if waited >= COMPACT_INTERVAL:
+                waited = 0
+                self.compact()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='fragment-segments', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self.lock:
+            self.sync()
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
@@ -0,0 +1,42 @@
+import threading
+
+from base64 import b64decode, b64encode
+
+INLINE_THRESHOLD = 256  # files up to this size are kept in the metadata
+
+
+class InlineStore:
+    """Keeps the content of tiny files within the (encrypted) metadata file.
+
+    Such files never go through Mix&Slice nor IPFS: they are encrypted along
+    with the rest of the metadata when it is saved. With no threshold, no new
+    file is inlined but existing ones are still readable.
+    """
+
+    def __init__(self, threshold=INLINE_THRESHOLD, data=None):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+
+        data = data if data is not None else {}
+        self.data = {path_id: b64decode(content.encode('ascii')) for path_id, content in data.items()}
+
+    def __contains__(self, path_id):
+        return path_id in self.data
+
+    def accepts(self, size):
+        return self.threshold is not None and size <= self.threshold
+
+    def load(self, path_id):
+        return self.data[path_id]
+
+    def store(self, path_id, data):
+        with self.lock:
+            self.data[path_id] = bytes(data)
+
+    def remove(self, path_id):
+        with self.lock:
+            self.data.pop(path_id, None)
+
+    def to_dict(self):
+        with self.lock:
+            return {path_id: b64encode(content).decode('ascii') for path_id, content in self.data.items()}
@@ -0,0 +1,272 @@
+import threading
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import utils.mixslice as MixSlice
+from aesmix256k import MACRO_SIZE
+from structure.pathinfo import PathInfo, random_id
+from .fragments import FileFragmentStore
+from utils.trace import span
+
+# A pack fills exactly one macroblock once padded
+PACK_CAPACITY = MACRO_SIZE - MixSlice.padder._padinfosize
+PACK_THRESHOLD = 32 * 1024  # files up to this size are packed
+MAX_LOADED_PACKS = 64
+COMPACT_RATIO = 0.5  # packs with less live data than this are compacted
+COMPACT_BATCH = 32  # extents moved at each compaction step
+
+
+class Pack:
+    def __init__(self, info: PathInfo, group=None, size=0):
+        self.info = info
+        self.group = group
+        self.size = size
+        self.live = 0
+        self.members = set()
+        self.content = None
+        self.dirty = False
+
+    @property
+    def pack_id(self):
+        return self.info.path_id
+
+    def free(self):
+        return PACK_CAPACITY - self.size
+
+    def to_dict(self):
+        return {
+            'key': b64encode(self.info.key).decode('ascii'),
+            'iv': b64encode(self.info.iv).decode('ascii'),
+            'group': self.group,
+            'size': self.size,
+        }
+
+    @staticmethod
+    def from_dict(pack_id, data):
+        info = PathInfo.make(
+            path_id=pack_id,
+            key=b64decode(data['key'].encode('ascii')),
+            iv=b64decode(data['iv'].encode('ascii')))
+        return Pack(info, group=data['group'], size=data['size'])
+
+
+class Packer:
+    """Stores small files as extents of shared, per-directory packs.
+
+    Each pack is encrypted as a single file of one macroblock, with its own
+    key and its CIDs kept in the shared CID map. Extents are never updated in
+    place: a new version of a file is appended to the active pack of its
+    directory, and the space of the previous one becomes dead. Packs that are
+    mostly dead are compacted a few extents at a time.
+
+    Packs are sealed (encrypted and uploaded) when they are full, evicted from
+    memory, or on flush(), so a burst of small files costs a single block.
+    With no threshold, no new file is packed but existing packs are readable.
+    """
+
+    def __init__(self, root: Path, cids: dict, store=None, collector=None,
+                 threshold=PACK_THRESHOLD, data=None, fragment_keys=None, fragments=None):
+        self.root = root
+        self.fragments = fragments if fragments is not None else FileFragmentStore(root)
+        self.cids = cids
+        self.fragment_keys = fragment_keys if fragment_keys is not None else {}
+        self.block_store = store
+        self.collector = collector
+        self.threshold = min(threshold, PACK_CAPACITY) if threshold is not None else None
+
+        self.packs = {}
+        self.extents = {}
+        self.groups = {}
+        self.active = {}
+        self.loaded = OrderedDict()
+        self.sparse = set()  # packs to compact
+        self.lock = threading.RLock()
+
+        data = data if data is not None else {}
+        for pack_id, pack in data.get('packs', {}).items():
+            self.packs[pack_id] = Pack.from_dict(pack_id, pack)
+        for path_id, (pack_id, offset, length) in data.get('extents', {}).items():
+            self.extents[path_id] = (pack_id, offset, length)
+            pack = self.packs[pack_id]
+            pack.members.add(path_id)
+            pack.live += length
+        for pack in self.packs.values():
+            self._check_sparse(pack)
+
+    def __contains__(self, path_id):
+        return path_id in self.extents
+
+    def accepts(self, size):
+        return self.threshold is not None and size <= self.threshold
+
+    def assign(self, path_id, group):
+        """Sets the directory whose packs will hold the file."""
+        self.groups[path_id] = group
+
+    # ------------------------------------------------------ Helpers
+
+    @contextmanager
+    def _locked(self):
+        # Sealing takes the guard of the collector, which the cache holds
+        # when it stores a file: it is always taken first
+        guard = self.collector.guard() if self.collector is not None else nullcontext()
+        with guard, self.lock:
+            yield
+
+    def _group_of(self, path_id):
+        if path_id in self.groups:
+            return self.groups[path_id]
+        if path_id in self.extents:
+            return self.packs[self.extents[path_id][0]].group
+        return None
+
+    def _new_pack(self, group):
+        pack = Pack(PathInfo.make(path_id=random_id(10)), group=group)
+        pack.content = bytearray()
+        self.packs[pack.pack_id] = pack
+        self._remember(pack)
+        self.active[group] = pack.pack_id
+        return pack
+
+    def _remember(self, pack: Pack):
+        self.loaded[pack.pack_id] = pack
+        self.loaded.move_to_end(pack.pack_id)
+        while len(self.loaded) > MAX_LOADED_PACKS:
+            _, oldest = self.loaded.popitem(last=False)
+            self._seal(oldest)
+            oldest.content = None
+
+    def _content(self, pack: Pack):
+        if pack.content is None:
+            with span('pack.load', cat='pack', pack_id=pack.pack_id):
+                pack.content = MixSlice.decrypt(
+                    self.fragments.fragment(pack.pack_id), pack.info.key, pack.info.iv, self.block_store,
+                    cids=self.cids[pack.pack_id],
+                    fragment_key=self.fragment_keys.get(pack.pack_id))
+        self._remember(pack)
+        return pack.content
+
+    def _seal(self, pack: Pack):
+        if not pack.dirty:
+            return
+
+        with span('pack.seal', cat='pack', pack_id=pack.pack_id, size=pack.size):
+            if pack.pack_id not in self.cids:
+                self.fragment_keys.setdefault(pack.pack_id, MixSlice.new_fragment_key())
+            cids = MixSlice.encrypt(
+                data=bytes(pack.content),
+                fragment=self.fragments.fragment(pack.pack_id),
+                key=pack.info.key,
+                iv=pack.info.iv,
+                store=self.block_store,
+                fragment_key=self.fragment_keys.get(pack.pack_id))
+
+            old_cids = self.cids.get(pack.pack_id)
+            self.cids[pack.pack_id] = cids
+            if old_cids and self.collector is not None:
+                self.collector.supersede(set(old_cids) - set(cids))
+        pack.dirty = False
+
+    def _check_sparse(self, pack: Pack):
+        if pack.size > 0 and pack.live / pack.size < COMPACT_RATIO:
+            self.sparse.add(pack.pack_id)
+
+    def _drop_pack(self, pack: Pack):
+        del self.packs[pack.pack_id]
+        self.loaded.pop(pack.pack_id, None)
+        self.sparse.discard(pack.pack_id)
+        if self.active.get(pack.group) == pack.pack_id:
+            del self.active[pack.group]
+
+        old_cids = self.cids.pop(pack.pack_id, [])
+        self.fragment_keys.pop(pack.pack_id, None)
+        if self.collector is not None:
+            self.collector.supersede(old_cids)
+        self.fragments.delete(pack.pack_id)
+
+    def _release_extent(self, path_id):
+        pack_id, _, length = self.extents.pop(path_id)
+        pack = self.packs[pack_id]
+        pack.members.discard(path_id)
+        pack.live -= length
+        if not pack.members and self.active.get(pack.group) != pack_id:
+            self._drop_pack(pack)
+        else:
+            self._check_sparse(pack)
+
+    def _compact_step(self):
+        for pack_id in list(self.sparse):
+            pack = self.packs[pack_id]
+            if self.active.get(pack.group) == pack_id:
+                # Still being filled, it will be compacted once sealed
+                continue
+
+            with span('pack.compact', cat='pack', pack_id=pack_id):
+                for path_id in list(pack.members)[:COMPACT_BATCH]:
+                    self._store(path_id, self._read(path_id))
+            return
+
+    def _read(self, path_id):
+        pack_id, offset, length = self.extents[path_id]
+        content = self._content(self.packs[pack_id])
+        return bytes(content[offset:offset + length])
+
+    def _store(self, path_id, data):
+        group = self._group_of(path_id)
+        pack = self.packs.get(self.active.get(group))
+        if pack is None or pack.free() < len(data):
+            if pack is not None:
+                self._seal(pack)
+            pack = self._new_pack(group)
+
+        content = self._content(pack)
+        offset = len(content)
+        content += data
+        pack.size = len(content)
+        pack.dirty = True
+
+        if path_id in self.extents:
+            self._release_extent(path_id)
+        self.extents[path_id] = (pack.pack_id, offset, len(data))
+        pack.members.add(path_id)
+        pack.live += len(data)
+
+    # ------------------------------------------------------ Public interface
+
+    def store(self, path_id, data):
+        with self._locked():
+            self._store(path_id, data)
+            self._compact_step()
+
+    def load(self, path_id):
+        with self._locked():
+            return self._read(path_id)
+
+    def remove(self, path_id):
+        with self._locked():
+            self.groups.pop(path_id, None)
+            if path_id in self.extents:
+                self._release_extent(path_id)
+
+    def seal(self, path_id):
+        """Makes sure the pack holding the file is encrypted and uploaded."""
+        with self._locked():
+            if path_id in self.extents:
+                self._seal(self.packs[self.extents[path_id][0]])
+
+    def flush(self):
+        with self._locked():
+            for pack in self.loaded.values():
+                self._seal(pack)
+
+    # ------------------------------------------------------ Dict conversions
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'packs': {pack_id: pack.to_dict() for pack_id, pack in self.packs.items()},
+                'extents': {path_id: list(extent) for path_id, extent in self.extents.items()},
+            }
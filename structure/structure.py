@@ -26,6 +26,14 @@ class PathStructure:
         trie = Trie.from_dict(data, transform=transform)
         return PathStructure(trie)
 
+    def by_id(self):
+        return {info.path_id: info for info in self.trie.values()}
+
+    def under(self, path):
+        """Returns the Info of path and of everything below it."""
+        node = self.trie[parts(path)]
+        return list(Trie(node).values()) if node is not None else []
+
     def _get(self, path):
         return self.trie[parts(path)].value
 
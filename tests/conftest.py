@@ -0,0 +1,77 @@
+import math
+import os
+
+import nacl.utils
+import pytest
+
+from cache.eviction import EvictionTechnique
+from storage.blockstore import MemoryBlockStore
+
+
+class FileInfo:
+    """What the kernel hands to open() and create()."""
+
+    def __init__(self, flags=os.O_RDWR):
+        self.flags = flags
+        self.fh = 0
+        self.keep_cache = 0
+        self.direct_io = 0
+
+
+def put(fs, path, data, create=True, offset=0):
+    """Writes a file like a process would: open, write, close."""
+    if create:
+        fs('create', path, 0o644, FileInfo())
+    else:
+        fs('open', path, FileInfo())
+    fs('write', path, data, offset, FileInfo())
+    fs('flush', path, FileInfo())
+    fs('release', path, FileInfo())
+
+
+def get(fs, path, length=None, offset=0):
+    fs('open', path, FileInfo(os.O_RDONLY))
+    try:
+        size = fs('getattr', path)['st_size']
+        return fs('read', path, size if length is None else length, offset, FileInfo(os.O_RDONLY))
+    finally:
+        fs('release', path, FileInfo(os.O_RDONLY))
+
+
+@pytest.fixture
+def store():
+    return MemoryBlockStore()
+
+
+@pytest.fixture
+def key():
+    return nacl.utils.random(32)
+
+
+@pytest.fixture
+def mount(tmp_path, store, key):
+    """Mounts (without FUSE) a file system kept in tmp_path and the store,
+    again at each call, as long as the previous one was closed. Nodes of a
+    cluster each have a root of their own."""
+    mounted = []
+
+    def make(root=tmp_path, **kwargs):
+        options = {
+            'memory_cap': math.inf,
+            'eviction_technique': EvictionTechnique.LRU,
+            'dump_metadata': False,
+            'gc_rate': 0,
+            'block_store': store,
+            'prefetch_fraction': 0,
+            'key': key,
+        }
+        options.update(kwargs)
+        # Imported here, FUSE has to be there
+        from freyafs import FreyaFS
+        fs = FreyaFS(str(root), str(root), **options)
+        mounted.append(fs)
+        return fs
+
+    yield make
+    for fs in mounted:
+        fs.close()
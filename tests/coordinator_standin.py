@@ -0,0 +1,35 @@
+import threading
+
+from utils import coordinator
+
+
+class StandIn:
+    """A coordinator served on a thread, at an ephemeral port of localhost.
+
+    The Coordinator itself is at hand, so that tests can look at its leases
+    and journal, or change them (e.g. to make a lease expire).
+    """
+
+    def __init__(self, verify_key=None):
+        self.coordinator = coordinator.Coordinator(verify_key)
+        self._server = coordinator._Server(('127.0.0.1', 0), coordinator._Handler)
+        self._server.coordinator = self.coordinator
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05},
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self):
+        host, port = self._server.server_address
+        return f'{host}:{port}'
+
+    def expire(self, path_id):
+        """Makes the leases on a file expire, as if their node stopped renewing them."""
+        with self.coordinator.lock:
+            self.coordinator.writers.pop(path_id, None)
+            self.coordinator.readers.pop(path_id, None)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
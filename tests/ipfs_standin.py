@@ -0,0 +1,77 @@
+import asyncio
+import threading
+
+from aiohttp import web
+
+from utils.ipfs import cid_of
+
+
+class StandIn:
+    """A local stand-in for an IPFS node, serving blocks over both the RPC
+    API (/api/v0/block/*) and the gateway (/ipfs/<cid>).
+
+    Each request waits `delay` seconds, and fails with a 500 while `fail` is
+    set. Stand-ins created with the same `blocks` dict serve the same blocks.
+    """
+
+    def __init__(self, blocks=None, delay=0, fail=False):
+        self.blocks = blocks if blocks is not None else {}
+        self.delay = delay
+        self.fail = fail
+        self.requests = 0
+
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ipfs-standin', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    @property
+    def api(self):
+        return f'http://127.0.0.1:{self.port}/api/v0'
+
+    @property
+    def gateway(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._setup())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _setup(self):
+        app = web.Application()
+        app.router.add_post('/api/v0/block/put', self._put)
+        app.router.add_post('/api/v0/block/get', self._get)
+        app.router.add_get('/ipfs/{cid}', self._get)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _answer(self):
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise web.HTTPInternalServerError()
+
+    async def _put(self, request):
+        await self._answer()
+        data = (await request.post())['data'].file.read()
+        cid = cid_of(data)
+        self.blocks[cid] = data
+        return web.json_response({'Key': cid, 'Size': len(data)})
+
+    async def _get(self, request):
+        await self._answer()
+        cid = request.match_info.get('cid') or request.query['arg']
+        if cid not in self.blocks:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.blocks[cid])
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
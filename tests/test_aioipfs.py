@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from utils import aioipfs
+from utils.aioipfs import AsyncBlockClient
+from utils.ipfs import cid_of
+
+from .ipfs_standin import StandIn
+
+BLOCK = b'freyafs' * 1024
+CID = cid_of(BLOCK)
+
+
+@pytest.fixture
+def standins():
+    created = []
+
+    def make(**kwargs):
+        standin = StandIn(blocks={CID: BLOCK}, **kwargs)
+        created.append(standin)
+        return standin
+
+    yield make
+    for standin in created:
+        standin.close()
+
+
+@pytest.fixture
+def client():
+    created = []
+
+    def make(endpoints):
+        c = AsyncBlockClient(endpoints=endpoints)
+        created.append(c)
+        return c
+
+    yield make
+    for c in created:
+        c.close()
+
+
+def test_put_goes_to_first_endpoint(standins, client):
+    local, remote = standins(), standins()
+    local.blocks.clear()
+    c = client([local.api, remote.gateway])
+
+    data = b'another block'
+    assert c.put_many([data]) == [cid_of(data)]
+    assert local.blocks[cid_of(data)] == data
+    assert remote.requests == 0
+
+
+def test_hedged_read_wins(standins, client):
+    slow, fast = standins(delay=3), standins()
+    c = client([slow.api, fast.gateway])
+
+    start = time.monotonic()
+    assert c.get_many([CID]) == [BLOCK]
+    elapsed = time.monotonic() - start
+
+    # The slow endpoint is ranked first, the fetch is hedged after its p95
+    assert slow.requests == 1 and fast.requests == 1
+    assert aioipfs.DEFAULT_HEDGE_DELAY <= elapsed < slow.delay
+
+
+def test_wrong_block_is_rejected(standins, client):
+    liar, honest = standins(), standins()
+    liar.blocks[CID] = b'not the block'
+    c = client([liar.api, honest.api])
+
+    assert c.get_many([CID]) == [BLOCK]
+    assert c.endpoints[0].failures == 1
+
+
+def test_breaker_opens_and_closes(standins, client, monkeypatch):
+    monkeypatch.setattr(aioipfs, 'BREAKER_COOLDOWN', 0.5)
+    broken, working = standins(fail=True), standins()
+    c = client([broken.api, working.api])
+    endpoint = c.endpoints[0]
+
+    for _ in range(aioipfs.BREAKER_THRESHOLD):
+        assert c.get_many([CID]) == [BLOCK]
+    assert not endpoint.available()
+
+    # While open, the endpoint is skipped
+    c.get_many([CID])
+    assert broken.requests == aioipfs.BREAKER_THRESHOLD
+
+    # After the cooldown one request goes through, and closes it on success
+    broken.fail = False
+    time.sleep(aioipfs.BREAKER_COOLDOWN)
+    assert endpoint.available()
+    assert c.get_many([CID]) == [BLOCK]
+    assert broken.requests == aioipfs.BREAKER_THRESHOLD + 1
+    assert endpoint.failures == 0
+
+
+def test_every_endpoint_failing_raises(standins, client):
+    first, second = standins(fail=True), standins(fail=True)
+    c = client([first.api, second.gateway])
+
+    with pytest.raises(Exception):
+        c.get_many([CID])
+    assert first.requests == 1 and second.requests == 1
@@ -0,0 +1,93 @@
+import errno
+import os
+import threading
+
+import pytest
+
+from aesmix256k import MACRO_SIZE
+
+from cache.budget import MemoryBudget
+from fuse import FuseOSError
+
+from .conftest import get, put
+
+
+def _holding(budget, size):
+    """Starts a thread reserving size, returns (reserved, release)."""
+    reserved = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with budget.reserve(size):
+            reserved.set()
+            release.wait()
+
+    threading.Thread(target=hold, daemon=True).start()
+    return reserved, release
+
+
+def test_reservations_wait_under_the_limit():
+    budget = MemoryBudget(100, resident=lambda: 0)
+    first, release_first = _holding(budget, 60)
+    assert first.wait(5)
+
+    second, release_second = _holding(budget, 60)
+    assert not second.wait(0.2)
+    assert budget.reserved == 60
+
+    release_first.set()
+    assert second.wait(5)
+    assert budget.peak <= 100
+    release_second.set()
+
+
+def test_resident_memory_counts_and_shrinking_wakes_up():
+    resident = [50]
+    budget = MemoryBudget(100, resident=lambda: resident[0])
+    first, release_first = _holding(budget, 30)
+    assert first.wait(5)
+
+    second, release_second = _holding(budget, 30)
+    assert not second.wait(0.2)
+    resident[0] = 10
+    budget.changed()
+    assert second.wait(5)
+    release_first.set()
+    release_second.set()
+
+
+def test_oversized_reservations_run_alone_and_reentrant_ones_do_not_wait():
+    budget = MemoryBudget(100, resident=lambda: 0)
+    with budget.reserve(500):
+        # The same thread, e.g. evicting to make room for its own load
+        with budget.reserve(50):
+            assert budget.reserved == 550
+
+        other, release_other = _holding(budget, 1)
+        assert not other.wait(0.2)
+    assert other.wait(5)
+    release_other.set()
+
+
+def test_no_limit_never_waits():
+    budget = MemoryBudget(None, resident=lambda: 10 ** 12)
+    with budget.reserve(10 ** 12):
+        assert budget.reserved == 0
+
+
+def test_writes_stay_under_the_hard_limit(mount):
+    limit = 2 * 1024 * 1024
+    fs = mount(memory_cap=limit, memory_limit=limit)
+    files = {f'/f{i}': os.urandom(6 * MACRO_SIZE) for i in range(6)}
+    for path, data in files.items():
+        put(fs, path, data)
+        assert fs.cache.total_size <= limit
+    assert fs.cache.budget.reserved == 0
+
+    for path, data in files.items():
+        assert get(fs, path) == data
+
+    # Larger than the limit on its own
+    with pytest.raises(FuseOSError) as e:
+        put(fs, '/big', os.urandom(limit + MACRO_SIZE))
+    assert e.value.errno == errno.ENOMEM
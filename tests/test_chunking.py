@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from aesmix256k import MACRO_SIZE
+from utils.chunking import chunk_pages
+
+from .conftest import get, put
+
+pytest.importorskip('numpy')
+
+KEY = bytes(16)
+
+
+def _pages(data):
+    return {i: bytearray(data[MACRO_SIZE*i: MACRO_SIZE*(i+1)]) for i in range((len(data) + MACRO_SIZE - 1) // MACRO_SIZE)}
+
+
+def test_chunks_nearly_fill_their_macroblocks():
+    data = os.urandom(32 * MACRO_SIZE)
+    chunks, layout = chunk_pages(_pages(data), len(data), KEY)
+    # Each chunk takes a macroblock
+    assert len(chunks) <= 32 * 1.25
+    assert sum(length for _, length, _ in layout['chunks']) == len(data)
+
+
+def test_inserts_change_the_chunks_around_them():
+    data = os.urandom(32 * MACRO_SIZE)
+    changed = data[:5 * MACRO_SIZE + 100] + b'inserted' + data[5 * MACRO_SIZE + 100:]
+    before, _ = chunk_pages(_pages(data), len(data), KEY)
+    after, _ = chunk_pages(_pages(changed), len(changed), KEY)
+    digests = {digest for digest, _ in before}
+    assert len([digest for digest, _ in after if digest not in digests]) <= 2
+
+
+def test_chunked_files_are_read_back(mount):
+    fs = mount(chunking=True)
+    data = os.urandom(3 * MACRO_SIZE + 1000)
+    put(fs, '/f', data)
+    fs.dump()
+    fs.close()
+
+    fs = mount(chunking=True)
+    assert get(fs, '/f') == data
@@ -0,0 +1,45 @@
+import os
+
+from aesmix256k import MACRO_SIZE
+
+from .conftest import get, put
+
+
+def test_clone_shares_every_block(mount, store):
+    fs = mount()
+    data = os.urandom(3 * MACRO_SIZE + 1000)
+    put(fs, '/a', data)
+    blocks = len(store.blocks)
+
+    fs.clone('/a', '/b')
+    assert fs._cids('/b') == fs._cids('/a')
+    assert len(store.blocks) == blocks
+    assert get(fs, '/b') == data
+
+
+def test_write_after_clone_only_changes_its_macroblock(mount, store):
+    fs = mount()
+    data = os.urandom(3 * MACRO_SIZE + 1000)
+    put(fs, '/a', data)
+    fs.clone('/a', '/b')
+    source_cids = list(fs._cids('/a'))
+
+    patch = os.urandom(100)
+    put(fs, '/b', patch, create=False, offset=MACRO_SIZE + 10)
+    changed = data[:MACRO_SIZE + 10] + patch + data[MACRO_SIZE + 110:]
+
+    cids = fs._cids('/b')
+    assert [i for i, (old, new) in enumerate(zip(source_cids, cids)) if old != new] == [1]
+    assert fs._cids('/a') == source_cids
+    assert get(fs, '/a') == data
+    assert get(fs, '/b') == changed
+
+    # The source goes, the clone keeps the blocks they shared
+    fs('unlink', '/a')
+    fs.collector.checkpoint(fs.collector.candidates())
+    fs.collector.sweep()
+    assert get(fs, '/b') == changed
+
+    fs.dump()
+    fs.close()
+    assert get(mount(), '/b') == changed
@@ -0,0 +1,146 @@
+import errno
+import os
+import time
+
+import pytest
+
+from fuse import FuseOSError
+from utils import coordinator
+from utils.coordinator import ClusterClient
+
+from .conftest import FileInfo, get, put
+from .coordinator_standin import StandIn
+
+
+@pytest.fixture
+def standin(key):
+    standin = StandIn(coordinator.verify_key(key))
+    yield standin
+    standin.close()
+
+
+@pytest.fixture
+def clients(standin, key):
+    created = []
+
+    def make(node, **kwargs):
+        client = ClusterClient(standin.address, key, node=node, **kwargs)
+        created.append(client)
+        return client
+
+    yield make
+    for client in created:
+        client.stop()
+
+
+@pytest.fixture
+def node(mount, standin, tmp_path):
+    def make(name):
+        root = tmp_path / name
+        root.mkdir()
+        return mount(root=root, cluster=standin.address, node=name)
+    return make
+
+
+def _eventually(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_read_leases_are_upgraded(clients, monkeypatch):
+    monkeypatch.setattr(coordinator, 'LEASE_WAIT', 0.3)
+    a, b = clients('a'), clients('b')
+    assert a.acquire('f', 'read') == 0
+    assert b.acquire('f', 'read') == 0
+
+    # Not while another node reads
+    with pytest.raises(OSError) as e:
+        a.upgrade('f')
+    assert e.value.errno == errno.EBUSY
+    b.release('f')
+
+    a.upgrade('f')
+    assert a.held('f') == 'write'
+    with pytest.raises(OSError):
+        b.acquire('f', 'read')
+
+    # The upgrade did not count as one more open
+    a.release('f')
+    assert a.held('f') is None
+    b.acquire('f', 'write')
+
+
+def test_leases_expire_unless_renewed(clients, standin, monkeypatch):
+    monkeypatch.setattr(coordinator, 'LEASE_WAIT', 5)
+    a, b = clients('a', ttl=0.3), clients('b')
+    a.acquire('f', 'write')
+
+    start = time.monotonic()
+    b.acquire('f', 'write')
+    assert time.monotonic() - start >= 0.2
+
+    with pytest.raises(ValueError):
+        a.commit('f', 0, {'cids': []})
+    assert standin.coordinator.files.get('f') is None
+
+
+def test_lost_write_lease_fails_the_flush(node, standin):
+    a = node('a')
+    put(a, '/f', os.urandom(1000))
+    fs_info = a.structure['/f']
+
+    a('open', '/f', FileInfo())
+    a('write', '/f', b'changed', 0, FileInfo())
+    standin.expire(fs_info.path_id)
+    with pytest.raises(FuseOSError) as e:
+        a('flush', '/f', FileInfo())
+    assert e.value.errno == errno.ESTALE
+
+
+def test_nodes_replay_the_journal(node, standin):
+    a = node('a')
+    a('mkdir', '/d', 0o755)
+    data = os.urandom(300000)
+    put(a, '/d/f', data)
+
+    # Mounted afterwards, from the journal
+    b = node('b')
+    assert '/d/f' in b.structure
+    assert get(b, '/d/f') == data
+
+    # Records that cannot be unsealed are skipped, not stuck on
+    with standin.coordinator.lock:
+        standin.coordinator._append('intruder', {'kind': 'namespace', 'record': 'not sealed'})
+
+    changed = os.urandom(200000)
+    put(a, '/d/f', changed, create=False)
+    a('mkdir', '/e', 0o755)
+    assert _eventually(lambda: '/e' in b.structure)
+    assert get(b, '/d/f') == changed[:200000] + data[200000:]
+
+    a('unlink', '/d/f')
+    assert _eventually(lambda: '/d/f' not in b.structure)
+    assert b.structure['/d'].path_id == a.structure['/d'].path_id
+
+
+def test_reset_keeps_the_blocks_of_packs(mount, tmp_path):
+    fs = mount(pack_threshold=64 * 1024)
+    files = {f'/f{i}': os.urandom(2000) for i in range(4)}
+    for path, data in files.items():
+        put(fs, path, data)
+    fs.packer.flush()
+    pack_ids = set(fs.packer.packs)
+    assert pack_ids <= set(fs.cids)
+
+    # As if caught up with a checkpoint of the same tree
+    fs._reset({'structure': fs.structure.to_dict(), 'metadata': fs.metadata.to_dict()})
+    assert pack_ids <= set(fs.cids)
+    fs.packer.loaded.clear()
+    for pack in fs.packer.packs.values():
+        pack.content = None
+    for path, data in files.items():
+        assert get(fs, path) == data
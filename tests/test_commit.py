@@ -0,0 +1,79 @@
+import os
+import threading
+
+import pytest
+
+from cache import commit
+
+from .conftest import get, put
+
+
+def test_failed_groups_are_committed_again(mount, store, monkeypatch):
+    monkeypatch.setattr(commit, 'RETRY_DELAY', 0.05)
+    put_block = store.put
+    failures = []
+
+    def flaky(data):
+        if not failures:
+            failures.append(data)
+            raise OSError('store unavailable')
+        return put_block(data)
+
+    monkeypatch.setattr(store, 'put', flaky)
+    fs = mount(group_commit=0.01)
+    data = os.urandom(5000)
+    put(fs, '/f', data)
+    path_id = fs.structure['/f'].path_id
+
+    # fsync reports the failure, the next one the commit that went through
+    with pytest.raises(OSError):
+        fs.committer.settle(path_id)
+    fs.committer.settle(path_id)
+    assert fs.committer.stats['failed'] == 1
+    assert path_id in fs.cids
+    fs.dump()
+    fs.close()
+
+    fs = mount(group_commit=0.01)
+    assert get(fs, '/f') == data
+
+
+def test_queued_flushes_of_removed_files_are_cancelled(mount, store):
+    fs = mount(group_commit=60)
+    put(fs, '/f', os.urandom(5000))
+    path_id = fs.structure['/f'].path_id
+    assert path_id in fs.committer.queued
+
+    fs('unlink', '/f')
+    assert path_id not in fs.committer.queued
+    assert fs.committer.queued_bytes == 0
+    fs.committer.drain()
+    assert path_id not in fs.cids
+    assert not store.blocks
+
+
+def test_removals_wait_for_the_commit_under_way(mount, store, monkeypatch):
+    put_block = store.put
+    committing, resume = threading.Event(), threading.Event()
+
+    def held(data):
+        committing.set()
+        resume.wait(10)
+        return put_block(data)
+
+    monkeypatch.setattr(store, 'put', held)
+    fs = mount(group_commit=0.01)
+    put(fs, '/f', os.urandom(5000))
+    path_id = fs.structure['/f'].path_id
+    assert committing.wait(10)
+
+    unlink = threading.Thread(target=fs, args=('unlink', '/f'))
+    unlink.start()
+    unlink.join(0.2)
+    assert unlink.is_alive()
+    resume.set()
+    unlink.join(10)
+    assert not unlink.is_alive()
+    # Committed, then dropped
+    assert fs.committer.stats['files'] >= 1
+    assert path_id not in fs.cids
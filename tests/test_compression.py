@@ -0,0 +1,72 @@
+import zlib
+
+from aesmix256k import MACRO_SIZE
+from utils.compression import Codec
+
+from .conftest import FileInfo, get, put
+
+
+def _text(size):
+    line = b'the quick brown fox jumps over the lazy dog %d\n'
+    return b''.join(line % i for i in range(size // 40))[:size]
+
+
+def _content(fs, path):
+    return fs.cache.files[fs.structure[path]].content
+
+
+def test_macroblocks_are_decompressed_when_read(mount):
+    fs = mount(compression=Codec.ZLIB)
+    data = _text(4 * MACRO_SIZE + 1000)
+    put(fs, '/f', data)
+    assert 'codec' in fs.cache.layouts[fs.structure['/f'].path_id]
+    fs.dump()
+    fs.close()
+
+    fs = mount(compression=Codec.ZLIB)
+    fs('open', '/f', FileInfo())
+    content = _content(fs, '/f')
+    assert set(content._packed) == set(range(5))
+
+    offset = 2 * MACRO_SIZE + 10
+    assert fs('read', '/f', 100, offset, FileInfo()) == data[offset:offset + 100]
+    assert set(content._packed) == {0, 1, 3, 4}
+    # Not on the event loop of asyncfs
+    assert fs('read_resident', '/f', 100, 0) is None
+    assert get(fs, '/f') == data
+
+
+def test_clean_macroblocks_are_not_compressed_again(mount, monkeypatch):
+    fs = mount(compression=Codec.ZLIB)
+    data = _text(4 * MACRO_SIZE + 1000)
+    put(fs, '/f', data)
+    fs.dump()
+    fs.close()
+
+    fs = mount(compression=Codec.ZLIB)
+    compressed = []
+
+    def counting(data, *args):
+        compressed.append(len(data))
+        return compress(data, *args)
+
+    compress = zlib.compress
+    monkeypatch.setattr(zlib, 'compress', counting)
+    fs('open', '/f', FileInfo())
+    fs('write', '/f', b'changed', MACRO_SIZE + 5, FileInfo())
+    fs('flush', '/f', FileInfo())
+    assert compressed == [MACRO_SIZE]
+    # Left packed by the flush
+    assert set(_content(fs, '/f')._packed) == {0, 2, 3, 4}
+
+    fs('truncate', '/f', 3 * MACRO_SIZE + 7)
+    fs('flush', '/f', FileInfo())
+    fs('release', '/f', FileInfo())
+    assert compressed == [MACRO_SIZE, 7]
+    fs.dump()
+    fs.close()
+
+    expected = bytearray(data[:3 * MACRO_SIZE + 7])
+    expected[MACRO_SIZE + 5:MACRO_SIZE + 12] = b'changed'
+    fs = mount(compression=Codec.ZLIB)
+    assert get(fs, '/f') == expected
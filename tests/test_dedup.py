@@ -0,0 +1,63 @@
+import os
+
+from aesmix256k import MACRO_SIZE
+from storage.dedup import STORED_BLOCK_SIZE, DedupIndex
+
+from .conftest import get, put
+
+
+def test_entries_go_with_their_last_reference():
+    index = DedupIndex()
+    index.add(['a', 'b', None], ['cid-a', 'cid-b', None])
+    index.add(['a'], ['cid-a'])
+    assert index.report()['references'] == 3
+    assert index.report()['stored_bytes_saved'] == STORED_BLOCK_SIZE
+
+    # Another CID for the same digest is not a reference to the entry
+    index.remove(['a'], ['cid-other'])
+    assert index.get('a') == 'cid-a'
+
+    index.remove(['a', 'b'], ['cid-a', 'cid-b'])
+    assert index.get('a') == 'cid-a'
+    assert index.get('b') is None
+    index.remove(['a'], ['cid-a'])
+    assert index.get('a') is None
+    assert index.report()['blocks'] == 0
+
+
+def _sweep(fs):
+    fs.collector.checkpoint(fs.collector.candidates())
+    fs.collector.sweep()
+
+
+def test_shared_blocks_outlive_a_removed_file(mount, store):
+    fs = mount(convergent_dirs=['/c'])
+    fs('mkdir', '/c', 0o755)
+    data = os.urandom(2 * MACRO_SIZE)
+    put(fs, '/c/a', data)
+    put(fs, '/c/b', data)
+    a, b = fs.structure['/c/a'].path_id, fs.structure['/c/b'].path_id
+    assert fs.cids[a] == fs.cids[b]
+    assert fs.cache.dedup.uploads_saved > 0
+
+    # Still referenced by b: neither collected nor forgotten by the index
+    fs('unlink', '/c/a')
+    _sweep(fs)
+    assert all(store.size(cid) is not None for cid in fs.cids[b] if cid is not None)
+    assert fs.cache.dedup.report()['references'] == len([cid for cid in fs.cids[b] if cid is not None])
+    assert get(fs, '/c/b') == data
+
+    # Collected with the last reference, and never handed out again
+    cids = [cid for cid in fs.cids[b] if cid is not None]
+    fs('unlink', '/c/b')
+    _sweep(fs)
+    assert all(store.size(cid) is None for cid in cids)
+    assert fs.cache.dedup.report()['blocks'] == 0
+
+    put(fs, '/c/again', data)
+    assert all(store.size(cid) is not None for cid in fs.cids[fs.structure['/c/again'].path_id] if cid is not None)
+    fs.dump()
+    fs.close()
+
+    fs = mount(convergent_dirs=['/c'])
+    assert get(fs, '/c/again') == data
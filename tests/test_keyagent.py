@@ -0,0 +1,73 @@
+import os
+import socket
+import threading
+import time
+
+import nacl.utils
+import pytest
+
+from utils import keyagent
+
+
+@pytest.fixture
+def agent(tmp_path):
+    path = str(tmp_path / 'agent.sock')
+    agent = keyagent.KeyAgent(socket_path=path)
+    threading.Thread(target=agent.serve_forever, daemon=True).start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    return path
+
+
+def test_keys_are_added_and_forgotten(agent):
+    key = nacl.utils.random(32)
+    assert keyagent.add_key('fs', key, agent)
+    assert keyagent.get_key('fs', agent) == key
+    keyagent.forget_keys('fs', agent)
+    assert keyagent.get_key('fs', agent) is None
+
+
+def test_refused_keys_are_not_added(agent, monkeypatch):
+    # The agent fails to decode the key
+    monkeypatch.setattr(keyagent, 'b64encode', lambda key: b'not base64!')
+    assert not keyagent.add_key('fs', b'key', agent)
+
+
+def test_no_agent(tmp_path):
+    path = str(tmp_path / 'none.sock')
+    assert keyagent.get_key('fs', path) is None
+    assert not keyagent.add_key('fs', nacl.utils.random(32), path)
+
+
+def test_stuck_agent_times_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(keyagent, 'REQUEST_TIMEOUT', 0.2)
+    path = str(tmp_path / 'stuck.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    try:
+        start = time.monotonic()
+        # Connected, never answered
+        assert keyagent.get_key('fs', path) is None
+        assert not keyagent.add_key('fs', nacl.utils.random(32), path)
+        assert time.monotonic() - start < 5
+    finally:
+        server.close()
+
+
+def test_wrong_key_of_the_agent_asks_for_the_password(mount, agent, tmp_path, monkeypatch):
+    fs = mount()
+    fs('mkdir', '/a', 0o755)
+    fs.dump()
+    fs.close()
+    right = fs.key
+
+    import freyafs
+    ident = str(tmp_path.resolve())
+    keyagent.add_key(ident, nacl.utils.random(32), agent)
+    monkeypatch.setattr(freyafs, 'generate_key', lambda ask_confirm: right)
+
+    fs = mount(key=None, key_agent=agent)
+    assert '/a' in fs.structure
+    # The right key took the place of the wrong one
+    assert keyagent.get_key(ident, agent) == right
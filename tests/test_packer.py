@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from .conftest import FileInfo, get, put
+
+PACK_THRESHOLD = 64 * 1024
+
+
+@pytest.fixture
+def fast_switches():
+    interval = sys.getswitchinterval()
+    # Threads switch as often as possible, to hit the bad interleavings
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def test_small_files_share_a_pack(mount):
+    fs = mount(pack_threshold=PACK_THRESHOLD)
+    files = {f'/f{i}': os.urandom(1000 + i) for i in range(10)}
+    for path, data in files.items():
+        put(fs, path, data)
+
+    packer = fs.packer
+    assert len(packer.packs) == 1
+    pack_id = next(iter(packer.packs))
+    assert all(packer.extents[fs.structure[path].path_id][0] == pack_id for path in files)
+    for path, data in files.items():
+        assert get(fs, path) == data
+
+
+def test_fsync_seals_the_pack(mount):
+    fs = mount(pack_threshold=PACK_THRESHOLD)
+    data = os.urandom(5000)
+    fs('create', '/f', 0o644, FileInfo())
+    fs('write', '/f', data, 0, FileInfo())
+    fs('flush', '/f', FileInfo())
+
+    path_id = fs.structure['/f'].path_id
+    pack_id = fs.packer.extents[path_id][0]
+    # Flushed in the pack, not uploaded yet
+    assert pack_id not in fs.cids
+
+    fs('fsync', '/f', 0, FileInfo())
+    assert pack_id in fs.cids
+    assert not fs.packer.packs[pack_id].dirty
+    fs('release', '/f', FileInfo())
+
+    fs.dump()
+    fs.close()
+    assert get(mount(pack_threshold=PACK_THRESHOLD), '/f') == data
+
+
+def test_mostly_dead_packs_are_compacted(mount):
+    fs = mount(pack_threshold=PACK_THRESHOLD)
+    files = {f'/f{i}': os.urandom(20000) for i in range(4)}
+    for path, data in files.items():
+        put(fs, path, data)
+
+    # Rewritten until the first packs hold mostly dead extents
+    for _ in range(20):
+        files['/f0'] = os.urandom(20000)
+        put(fs, '/f0', files['/f0'], create=False)
+    fs.packer.flush()
+
+    packer = fs.packer
+    live = sum(pack.live for pack in packer.packs.values())
+    assert live == sum(len(data) for data in files.values())
+    # Every pack left but the active one is at least half live
+    assert all(pack.live / pack.size >= 0.5 for pack_id, pack in packer.packs.items()
+               if pack_id not in packer.active.values())
+    assert len(packer.packs) <= 3
+    for path, data in files.items():
+        assert get(fs, path) == data
+
+    fs.dump()
+    fs.close()
+    fs = mount(pack_threshold=PACK_THRESHOLD)
+    for path, data in files.items():
+        assert get(fs, path) == data
+
+
+def test_concurrent_flushes_and_seals_do_not_deadlock(mount, fast_switches):
+    fs = mount(pack_threshold=PACK_THRESHOLD)
+    errors = []
+
+    def worker(n, sync):
+        try:
+            for i in range(60):
+                path = f'/w{n}-{i}'
+                # Mostly packed, some large enough to be stored on their own
+                data = os.urandom(1000 + (i * 7919 + n * 104729) % 100000)
+                fs('create', path, 0o644, FileInfo())
+                fs('write', path, data, 0, FileInfo())
+                if sync:
+                    fs('fsync', path, 0, FileInfo())
+                else:
+                    fs('flush', path, FileInfo())
+                fs('release', path, FileInfo())
+                assert get(fs, path) == data
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n, n % 2 == 1), daemon=True) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 60
+    for thread in threads:
+        thread.join(timeout=max(deadline - time.monotonic(), 0))
+
+    assert not any(thread.is_alive() for thread in threads), 'deadlocked'
+    assert not errors
@@ -0,0 +1,61 @@
+import os
+
+import freyafs
+from freyafs import REKEY_SUFFIX
+from utils import mixslice
+
+from .conftest import get, put
+
+
+def _fill(fs):
+    files = {'/big': os.urandom(600000), '/d/small': os.urandom(2000)}
+    fs('mkdir', '/d', 0o755)
+    for path, data in files.items():
+        put(fs, path, data)
+    return files
+
+
+def _fragments(fs):
+    # The big file has a fragment of its own, the small one shares its pack
+    big = fs.structure['/big'].path_id
+    pack = fs.packer.extents[fs.structure['/d/small'].path_id][0]
+    return [big, pack]
+
+
+def test_revoked_files_are_read_back(mount):
+    fs = mount(pack_threshold=64 * 1024)
+    files = _fill(fs)
+    fs.packer.flush()
+    fragments = _fragments(fs)
+    before = {fid: (fs.fragments.read(fid), fs.cache.fragment_keys.get(fid)) for fid in fragments}
+
+    assert fs.revoke()[0] == 2
+    for fid, (old, old_key) in before.items():
+        new, new_key = fs.fragments.read(fid), fs.cache.fragment_keys[fid]
+        assert new_key != old_key and new != old
+        # The same kept fragments, wrapped with the new key
+        assert mixslice.unwrap(new, new_key) == mixslice.unwrap(old, old_key)
+        assert not fs.fragments.exists(fid + REKEY_SUFFIX)
+    fs.close()
+
+    fs = mount(pack_threshold=64 * 1024)
+    for path, data in files.items():
+        assert get(fs, path) == data
+
+
+def test_interrupted_revocations_are_finished_at_mount(mount, monkeypatch):
+    fs = mount(pack_threshold=64 * 1024)
+    files = _fill(fs)
+    # Stopped once the new keys are saved
+    monkeypatch.setattr(freyafs.FreyaFS, '_finish_revocation', lambda self: None)
+    fs.revoke()
+    fragments = _fragments(fs)
+    assert all(fs.fragments.exists(fid + REKEY_SUFFIX) for fid in fragments)
+    fs.close()
+    monkeypatch.undo()
+
+    fs = mount(pack_threshold=64 * 1024)
+    assert not any(fs.fragments.exists(fid + REKEY_SUFFIX) for fid in fragments)
+    assert fs.revocation == {}
+    for path, data in files.items():
+        assert get(fs, path) == data
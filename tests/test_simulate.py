@@ -0,0 +1,41 @@
+from aesmix256k import MACRO_SIZE
+from cache.eviction import EvictionTechnique
+from simulate import simulate
+from utils.optrace import OpRecorder
+
+
+def _trace(filename):
+    # A hot file, read between scans of the others, one of them large
+    sizes = {'hot': MACRO_SIZE, 'large': 6 * MACRO_SIZE, **{f'f{i}': MACRO_SIZE for i in range(6)}}
+    recorder = OpRecorder(filename)
+
+    def read(name):
+        size = sizes[name]
+        recorder.record('open', name, size=size)
+        recorder.record('read', name, 0, 4096, size)
+        recorder.record('release', name, size=size)
+
+    for _ in range(5):
+        read('hot')
+        read('hot')
+        for name in sizes:
+            if name != 'hot':
+                read(name)
+    recorder.close()
+
+
+def test_techniques_evict_differently(tmp_path):
+    trace = str(tmp_path / 'ops')
+    _trace(trace)
+    results = [simulate(trace, technique, 8 * MACRO_SIZE) for technique in EvictionTechnique]
+    assert all(result['evictions'] for result in results)
+    assert len({(result['hits'], result['evictions'], result['bytes_fetched']) for result in results}) > 1
+
+
+def test_closed_files_stay_cached(tmp_path):
+    trace = str(tmp_path / 'ops')
+    _trace(trace)
+    # Everything fits: each file is loaded once
+    result = simulate(trace, EvictionTechnique.LRU, 64 * MACRO_SIZE)
+    assert result['evictions'] == 0
+    assert result['loads'] == 8
@@ -0,0 +1,81 @@
+import os
+import threading
+
+from aesmix256k import MACRO_SIZE
+
+from .conftest import FileInfo, get, put
+
+SIZE = 3 * MACRO_SIZE
+
+
+def test_flush_stores_a_consistent_version_under_writes(mount):
+    fs = mount()
+    put(fs, '/f', bytes(SIZE))
+    fs('open', '/f', FileInfo())
+    path_info = fs.structure['/f']
+    stop = threading.Event()
+    written = []
+
+    def writer():
+        version = 0
+        while not stop.is_set():
+            version = version % 255 + 1
+            # Each write replaces the whole file
+            fs('write', '/f', bytes([version]) * SIZE, 0, FileInfo())
+            written.append(version)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        for _ in range(20):
+            fs('flush', '/f', FileInfo())
+            stored = fs.cache._decrypt(path_info).read_all()
+            assert len(stored) == SIZE
+            assert stored == stored[:1] * SIZE, 'torn snapshot'
+    finally:
+        stop.set()
+        thread.join()
+
+    assert written
+    # Writes made during the flushes are not lost
+    fs('flush', '/f', FileInfo())
+    fs('release', '/f', FileInfo())
+    assert fs.cache._decrypt(path_info).read_all() == bytes([written[-1]]) * SIZE
+
+    fs.dump()
+    fs.close()
+    assert get(mount(), '/f') == bytes([written[-1]]) * SIZE
+
+
+def test_concurrent_opens_decrypt_once(mount):
+    fs = mount()
+    data = os.urandom(SIZE)
+    put(fs, '/f', data)
+    cache = fs.cache
+
+    decrypted = []
+    decrypt = cache._decrypt_file
+
+    def counting(path, *args):
+        decrypted.append(path)
+        return decrypt(path, *args)
+
+    cache._decrypt_file = counting
+    barrier = threading.Barrier(8)
+    results = []
+
+    def reader():
+        barrier.wait()
+        fs('open', '/f', FileInfo())
+        results.append(fs('read', '/f', SIZE, 0, FileInfo()))
+
+    threads = [threading.Thread(target=reader) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [data] * 8
+    assert len(decrypted) == 1
+    assert cache.files[fs.structure['/f']].opens == 8
+    assert not cache.loading
@@ -0,0 +1,48 @@
+import os
+
+from aesmix256k import MACRO_SIZE
+
+from .conftest import get, put
+
+
+def test_holes_read_as_zeros_and_take_no_blocks(mount):
+    fs = mount()
+    data = os.urandom(1000)
+    put(fs, '/f', data, offset=3 * MACRO_SIZE)
+
+    size = 3 * MACRO_SIZE + len(data)
+    assert fs('getattr', '/f')['st_size'] == size
+    assert get(fs, '/f') == bytes(3 * MACRO_SIZE) + data
+    assert get(fs, '/f', 100, MACRO_SIZE + 5) == bytes(100)
+    # Across the end of the hole
+    assert get(fs, '/f', 20, 3 * MACRO_SIZE - 10) == bytes(10) + data[:10]
+
+    assert fs._cids('/f')[:3] == [None] * 3
+    assert fs('getattr', '/f')['st_blocks'] * 512 < size
+
+    fs.dump()
+    fs.close()
+    assert get(mount(), '/f') == bytes(3 * MACRO_SIZE) + data
+
+
+def test_truncate_grows_with_zeros_and_shrinks(mount):
+    fs = mount()
+    data = os.urandom(MACRO_SIZE + 1000)
+    put(fs, '/f', data)
+
+    fs('truncate', '/f', 4 * MACRO_SIZE)
+    assert fs('getattr', '/f')['st_size'] == 4 * MACRO_SIZE
+    assert get(fs, '/f') == data + bytes(4 * MACRO_SIZE - len(data))
+    assert fs._cids('/f')[2:4] == [None, None]
+
+    fs('truncate', '/f', 500)
+    assert fs('getattr', '/f')['st_size'] == 500
+    assert get(fs, '/f') == data[:500]
+
+    # Grown again, the bytes cut off do not come back
+    fs('truncate', '/f', 2000)
+    assert get(fs, '/f') == data[:500] + bytes(1500)
+
+    fs.dump()
+    fs.close()
+    assert get(mount(), '/f') == data[:500] + bytes(1500)
@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import time
+
+from collections import deque
+
+import aiohttp
+
+from .ipfs import IPFS_API, cid_of
+from .trace import async_span
+
+DEFAULT_CONCURRENCY = 64
+LATENCY_SAMPLES = 100  # per endpoint, used to compute the hedging delay
+DEFAULT_HEDGE_DELAY = 0.5  # seconds, until enough latencies are known
+BREAKER_THRESHOLD = 3  # consecutive failures opening the circuit breaker
+BREAKER_COOLDOWN = 30  # seconds before an open breaker lets a request through
+
+
+class Endpoint:
+    """An IPFS HTTP API (or trustless gateway) blocks can be fetched from.
+
+    URLs containing /api/ are treated as RPC APIs, any other one as a
+    gateway serving raw blocks at /ipfs/<cid>.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.gateway = '/api/' not in self.url
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.failures = 0
+        self.open_until = 0
+
+    def __repr__(self):
+        return f'Endpoint(url="{self.url}")'
+
+    def p95(self):
+        if len(self.latencies) < 20:
+            return DEFAULT_HEDGE_DELAY
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95)]
+
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def succeeded(self, latency):
+        self.latencies.append(latency)
+        self.failures = 0
+
+    def failed(self):
+        # A failure after the cooldown (half-open breaker) opens it again
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+
+class AsyncBlockClient:
+    """Asyncio client for the IPFS block API.
+
+    The event loop runs on a dedicated thread, so the client can be used from
+    synchronous code: the submit_* methods return concurrent.futures.Future
+    objects, while put_many and get_many block until all transfers are done.
+    At most `concurrency` blocks are transferred at any given time,
+    regardless of how many blocks are submitted.
+
+    Blocks are written to the first endpoint (the local node), but they can
+    be fetched from any of them. A fetch goes to the fastest endpoint first,
+    and is duplicated to the next one if no answer arrives within the p95
+    latency of the first: whichever answers first wins.
+    """
+
+    def __init__(self, api=IPFS_API, concurrency=DEFAULT_CONCURRENCY, endpoints=None):
+        self.endpoints = [Endpoint(url) for url in (endpoints if endpoints else [api])]
+        self.api = self.endpoints[0].url
+        self.concurrency = concurrency
+
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ipfs-event-loop', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._setup())
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _setup(self):
+        # Both have to be created from within the loop they are used in
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Hedged requests may exceed the concurrency, the semaphore bounds blocks
+        connector = aiohttp.TCPConnector(limit=0)
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    def _ranked(self):
+        available = [e for e in self.endpoints if e.available()]
+        # With every breaker open, try anyway rather than failing right away
+        return sorted(available if available else self.endpoints, key=lambda e: e.p95())
+
+    # ------------------------------------------------------ Coroutines
+
+    async def _block_put(self, data):
+        form = aiohttp.FormData()
+        form.add_field('data', data, filename='data')
+
+        async with self._semaphore:
+            with async_span('ipfs.block_put', cat='ipfs', size=len(data)):
+                async with self._session.post(f'{self.api}/block/put', data=form) as r:
+                    r.raise_for_status()
+                    return (await r.json(content_type=None))['Key']
+
+    async def _fetch(self, endpoint: Endpoint, cid):
+        start = time.monotonic()
+        try:
+            with async_span('ipfs.block_get', cat='ipfs', cid=cid, endpoint=endpoint.url):
+                if endpoint.gateway:
+                    url = f'{endpoint.url}/ipfs/{cid}'
+                    params = {'format': 'raw'}
+                    request = self._session.get(url, params=params)
+                else:
+                    request = self._session.post(f'{endpoint.url}/block/get', params={'arg': cid})
+
+                async with request as r:
+                    r.raise_for_status()
+                    data = await r.read()
+
+            # Raw blocks can be verified, so that a misbehaving peer is caught
+            if cid.startswith('bafkrei') and cid_of(data) != cid:
+                raise ValueError(f'{endpoint} returned a wrong block for {cid}')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            endpoint.failed()
+            raise
+
+        endpoint.succeeded(time.monotonic() - start)
+        return data
+
+    async def _block_get(self, cid):
+        async with self._semaphore:
+            endpoints = self._ranked()
+            running = set()
+            error = None
+            try:
+                while endpoints or running:
+                    if endpoints:
+                        endpoint = endpoints.pop(0)
+                        running.add(asyncio.ensure_future(self._fetch(endpoint, cid)))
+                        timeout = endpoint.p95() if endpoints else None
+                    else:
+                        timeout = None
+
+                    done, running = await asyncio.wait(
+                        running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            return task.result()
+                        error = task.exception()
+            finally:
+                for task in running:
+                    task.cancel()
+
+            raise error
+
+    async def _block_rm(self, cid):
+        async with self._semaphore:
+            with async_span('ipfs.block_rm', cat='ipfs', cid=cid):
+                # Both fail if the block is not pinned or not there anymore,
+                # which is fine: only connection errors are raised
+                async with self._session.post(f'{self.api}/pin/rm', params={'arg': cid}):
+                    pass
+                async with self._session.post(f'{self.api}/block/rm', params={'arg': cid}):
+                    pass
+
+    async def _block_stat(self, cid):
+        async with self._semaphore:
+            async with self._session.post(f'{self.api}/block/stat', params={'arg': cid}) as r:
+                if r.status != 200:
+                    return None
+                return (await r.json(content_type=None))['Size']
+
+    # ------------------------------------------------------ Synchronous interface
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def submit_put(self, data):
+        return self._submit(self._block_put(data))
+
+    def submit_get(self, cid):
+        return self._submit(self._block_get(cid))
+
+    def submit_rm(self, cid):
+        return self._submit(self._block_rm(cid))
+
+    def submit_stat(self, cid):
+        return self._submit(self._block_stat(cid))
+
+    def put_many(self, blocks):
+        futures = [self.submit_put(block) for block in blocks]
+        return [f.result() for f in futures]
+
+    def get_many(self, cids):
+        futures = [self.submit_get(cid) for cid in cids]
+        return [f.result() for f in futures]
+
+    def close(self):
+        if not self._loop.is_running():
+            return
+        self._submit(self._session.close()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,133 @@
+import functools
+import hashlib
+
+from aesmix256k import MACRO_SIZE
+
+# Content-defined chunking: files are cut where a rolling hash of the last
+# bytes matches a pattern, rather than every MACRO_SIZE bytes. Inserting or
+# removing bytes only moves the boundaries around the change, so the chunks
+# after it are the same as before, and keep their blocks. Each chunk is
+# padded to a macroblock when mixed, so chunks are made of small pieces cut
+# the same way, packed as long as they fit: a chunk ends early only at a
+# stronger boundary, which the chunks after a change meet again.
+
+MIN_CHUNK = 3 * MACRO_SIZE // 4
+MAX_CHUNK = MACRO_SIZE
+WINDOW = 16  # bytes the rolling hash depends on
+PIECE_MASK = (1 << 12) - 1  # a piece every 4 KB on average
+MASK = (1 << 16) - 1  # a stronger boundary every 64 KB on average
+SEGMENT = 4 * MACRO_SIZE  # bytes hashed at a time
+
+
+def _numpy():
+    # Hashing every byte is only fast enough vectorized
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError('content-defined chunking needs the numpy package')
+    return numpy
+
+
+@functools.lru_cache(maxsize=None)
+def _gear(np):
+    # Fixed pseudo-random value of each byte
+    seed = hashlib.sha256(b'freyafs-gear').digest()
+    values = [int.from_bytes(hashlib.sha256(seed + bytes([b])).digest()[:4], 'little') for b in range(256)]
+    return np.array(values, dtype=np.uint32)
+
+
+def _read(pages, start, end):
+    """Returns the bytes in [start, end) of data given as a map of macroblocks."""
+    data = bytearray(end - start)
+    for index in range(start // MACRO_SIZE, (end - 1) // MACRO_SIZE + 1):
+        page = pages.get(index)
+        if page is None:
+            continue
+        page_start = MACRO_SIZE * index
+        lo, hi = max(start, page_start), min(end, page_start + len(page))
+        if lo < hi:
+            data[lo - start: hi - start] = page[lo - page_start: hi - page_start]
+    return data
+
+
+def _candidates(pages, size):
+    """Returns the offsets where the rolling hash allows a boundary between
+    pieces, and whether each one is a stronger boundary."""
+    np = _numpy()
+    gear = _gear(np)
+    found = []
+    for start in range(0, size, SEGMENT):
+        # The first bytes of a segment hash along with the end of the previous one
+        lead = min(start, WINDOW - 1)
+        data = np.frombuffer(_read(pages, start - lead, min(start + SEGMENT, size)), dtype=np.uint8)
+        values = gear[data]
+        h = np.zeros(len(data), dtype=np.uint32)
+        for k in range(WINDOW):
+            h[k:] += values[:len(data) - k] << np.uint32(k)
+        cuts = np.flatnonzero((h[lead:] & PIECE_MASK) == 0)
+        found.append((cuts + start + 1, (h[lead:][cuts] & MASK) == 0))
+    if not found:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    return np.concatenate([cuts for cuts, _ in found]), np.concatenate([strong for _, strong in found])
+
+
+def boundaries(pages, size):
+    """Returns the (offset, length) of the chunks of data given as a map of macroblocks."""
+    if size == 0:
+        return []
+
+    np = _numpy()
+    candidates, strong = _candidates(pages, size)
+    strong_candidates = candidates[strong]
+    chunks = []
+    start = 0
+    while start < size:
+        # The first stronger boundary past MIN_CHUNK, or else the last piece
+        # that fits
+        i = np.searchsorted(strong_candidates, start + MIN_CHUNK)
+        if i < len(strong_candidates) and strong_candidates[i] <= start + MAX_CHUNK:
+            end = int(strong_candidates[i])
+        else:
+            j = np.searchsorted(candidates, start + MAX_CHUNK, side='right')
+            end = int(candidates[j - 1]) if j > 0 and candidates[j - 1] >= start + MIN_CHUNK else start + MAX_CHUNK
+        end = min(end, size)
+        chunks.append((start, end - start))
+        start = end
+    return chunks
+
+
+def chunk_pages(pages, size, key):
+    """Cuts data given as a map of macroblocks in chunks.
+
+    Returns the digest and data (None if only zeros) of each chunk, and the
+    layout of the file.
+    """
+    chunks = []
+    index = []
+    for offset, length in boundaries(pages, size):
+        data = _read(pages, offset, offset + length)
+        digest = hashlib.blake2b(data, digest_size=16, key=key).hexdigest()
+        chunks.append((digest, data if data.count(0) != len(data) else None))
+        index.append([offset, length, digest])
+    return chunks, {'chunking': 'cdc', 'size': size, 'chunks': index}
+
+
+def unchunk(blocks, layout):
+    """Returns the map of macroblocks, and the size, of a chunked file."""
+    pages = {}
+    for i, (offset, length, _) in enumerate(layout['chunks']):
+        block = blocks.get(i)
+        if block is None:
+            continue
+        view = memoryview(block)[:length]
+        done = 0
+        while done < length:
+            index, start = divmod(offset + done, MACRO_SIZE)
+            n = min(MACRO_SIZE - start, length - done)
+            page = pages.setdefault(index, bytearray())
+            if len(page) < start:
+                page.extend(bytes(start - len(page)))
+            page[start:start + n] = view[done:done + n]
+            done += n
+        del view
+    return pages, layout['size']
@@ -0,0 +1,132 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+from . import scheduler
+from .scheduler import Priority
+from .trace import span
+
+DEFAULT_RATE = 50  # blocks removed per second
+SWEEP_INTERVAL = 5  # seconds between two sweeps
+
+
+class BlockCollector:
+    """Mark-and-sweep collector of stored blocks that are no longer referenced.
+
+    Blocks superseded by a new encryption of a file (or by its removal) are
+    first kept as *pending*: the metadata persisted on disk may still reference
+    them, so removing them before the next dump would make a crash lose data.
+    Once a dump has written a CID map that does not reference them anymore,
+    they become *reclaimable* and are recorded in the metadata themselves, so
+    they are not leaked if FreyaFS stops before sweeping them.
+
+    Before removing anything, the sweep marks every CID that is still
+    referenced by the live CID map (the same content encrypted with the same
+    key produces the same CID again), and skips it.
+    """
+
+    def __init__(self, cids: dict, store, garbage=None, rate=DEFAULT_RATE):
+        self.cids = cids
+        self.store = store
+        self.pending = set()
+        self.reclaimable = set(garbage if garbage is not None else [])
+        self.rate = rate
+
+        # Held while blocks are written or removed, so that a block uploaded
+        # again by an encryption is never removed before it becomes live
+        self.lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ------------------------------------------------------ Marking
+
+    def _live(self):
+        live = set()
+        for cids in list(self.cids.values()):
+            live.update(cids)
+        return live
+
+    @contextmanager
+    def guard(self):
+        with self.lock:
+            yield
+
+    def supersede(self, cids):
+        with self.lock:
+            # Holes have no block
+            self.pending.update(cid for cid in cids if cid is not None)
+
+    def candidates(self):
+        """Returns the unreferenced blocks, to be persisted with the CID map."""
+        with self.lock:
+            return (self.pending | self.reclaimable) - self._live()
+
+    def checkpoint(self, persisted):
+        """To be called once a CID map not referencing `persisted` is on disk."""
+        with self.lock:
+            self.pending -= persisted
+            self.reclaimable |= persisted
+
+    # ------------------------------------------------------ Sweeping
+
+    def sweep(self, limit=None):
+        with self.lock:
+            to_remove = list(self.reclaimable - self._live())[:limit]
+
+        removed = 0
+        for cid in to_remove:
+            if self._stop.is_set():
+                break
+
+            with self.lock, span('gc.remove', cat='gc', cid=cid):
+                if cid in self._live():
+                    self.reclaimable.discard(cid)
+                    continue
+                try:
+                    self.store.delete(cid)
+                except OSError:
+                    # Store not reachable, try again at the next sweep
+                    break
+                self.reclaimable.discard(cid)
+                removed += 1
+
+            if self.rate:
+                time.sleep(1 / self.rate)
+
+        return removed
+
+    def _run(self):
+        with scheduler.job(Priority.GC):
+            while not self._stop.wait(SWEEP_INTERVAL):
+                self.sweep()
+
+    def start(self):
+        if not self.rate or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='block-collector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # ------------------------------------------------------ Reporting
+
+    def report(self):
+        """Dry run: returns the number and total size of the reclaimable blocks."""
+        with self.lock:
+            to_check = (self.pending | self.reclaimable) - self._live()
+
+        blocks, size = 0, 0
+        for cid in to_check:
+            block_size = self.store.size(cid)
+            if block_size is None:
+                # Already gone from the store
+                continue
+            blocks += 1
+            size += block_size
+
+        return blocks, size
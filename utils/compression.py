@@ -0,0 +1,134 @@
+import zlib
+
+from enum import Enum
+
+from aesmix256k import MACRO_SIZE
+
+from .filebytecontent import join_pages
+
+# Macroblocks are compressed one by one, and the results laid one after the
+# other in a stream which is then mixed as usual. The layout of each file maps
+# its macroblocks to their place in the stream, so that any of them can be
+# found, and decompressed, from the one or two stream blocks covering it.
+
+COMPRESSION_RATIO = 0.9  # compressed data larger than this share of the original is kept as it is
+SAMPLE = 4  # macroblocks compressed to tell whether a file is worth it
+
+
+class Codec(Enum):
+    ZLIB = 'zlib'
+    ZSTD = 'zstd'
+    LZ4 = 'lz4'
+
+    def _functions(self):
+        # zstd and lz4 are optional dependencies
+        if self == Codec.ZSTD:
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError('zstd compression needs the zstandard package')
+            return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+        if self == Codec.LZ4:
+            try:
+                import lz4.frame
+            except ImportError:
+                raise ValueError('lz4 compression needs the lz4 package')
+            return lz4.frame.compress, lz4.frame.decompress
+        return zlib.compress, zlib.decompress
+
+    def compress(self, data):
+        return self._functions()[0](data)
+
+    def decompress(self, data):
+        return self._functions()[1](data)
+
+
+def values():
+    return [c.value for c in Codec]
+
+
+def _worth_it(pages, codec: Codec):
+    sample = [bytes(pages[i]) for i in sorted(pages)[:SAMPLE]]
+    raw = sum(len(page) for page in sample)
+    return raw > 0 and sum(len(codec.compress(page)) for page in sample) < raw * COMPRESSION_RATIO
+
+
+def compress_pages(pages, size, codec: Codec, previous=None, dirty=frozenset(), stored=None):
+    """Compresses data given as a map of macroblocks (missing ones are holes).
+
+    Macroblocks not written since they were stored with this codec keep the
+    form they were stored in, given by stored as their compressed data (None
+    for those stored as they are): they are not compressed again, and may be
+    missing from pages.
+
+    Returns the stream to mix as a map of macroblocks, its size, the layout
+    of the file, the macroblocks of the stream that changed since the
+    previous layout, and the form of each macroblock, like stored. Returns
+    None if the data does not compress well.
+    """
+    stored = stored or {}
+    # Files stored compressed were worth it
+    if not any(data is not None for data in stored.values()) and not _worth_it(pages, codec):
+        return None
+
+    compress, _ = codec._functions()
+    stream = bytearray()
+    extents = []
+    forms = {}
+    for i in range((size + MACRO_SIZE - 1) // MACRO_SIZE):
+        if i in stored and i not in dirty:
+            form = stored[i]
+            data = form if form is not None else bytes(pages[i])
+        else:
+            page = pages.get(i)
+            if page is None:
+                extents.append(None)
+                continue
+            raw = bytes(page)
+            data = compress(raw)
+            form = data if len(data) < len(raw) * COMPRESSION_RATIO else None
+            if form is None:
+                data = raw
+        extents.append([len(stream), len(data), form is not None])
+        forms[i] = form
+        stream.extend(data)
+
+    layout = {'codec': codec.value, 'size': size, 'stream': len(stream), 'extents': extents}
+
+    # The stream is the same up to the first macroblock that changed
+    changed = 0
+    if previous is not None and previous['codec'] == codec.value:
+        old = previous['extents']
+        changed = next((i for i, extent in enumerate(extents)
+                        if i in dirty or i >= len(old) or old[i] != extent), len(extents))
+    start = next((extent[0] for extent in extents[changed:] if extent is not None), len(stream))
+
+    stream_pages = {j: stream[MACRO_SIZE*j: MACRO_SIZE*(j+1)]
+                    for j in range((len(stream) + MACRO_SIZE - 1) // MACRO_SIZE)}
+    stream_dirty = set(range(start // MACRO_SIZE, len(stream) // MACRO_SIZE + 1))
+    return stream_pages, len(stream), layout, stream_dirty, forms
+
+
+def split_stream(stream_pages, stream_size, layout):
+    """Splits the stream of a compressed file into the form each macroblock
+    was stored in, like compress_pages() returns them. Compressed ones are
+    left for the reader to decompress when needed.
+
+    Returns the macroblocks stored as they are, as a map, the size of the
+    file, and the forms.
+    """
+    stream = join_pages(stream_pages, stream_size)
+
+    pages = {}
+    forms = {}
+    for i, extent in enumerate(layout['extents']):
+        if extent is None:
+            continue
+        offset, length, compressed = extent
+        data = stream[offset: offset + length]
+        if compressed:
+            forms[i] = bytes(data)
+        else:
+            pages[i] = data
+            forms[i] = None
+    return pages, layout['size'], forms
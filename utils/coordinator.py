@@ -0,0 +1,425 @@
+import errno
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from base64 import b64decode, b64encode
+
+import nacl.encoding
+import nacl.exceptions
+import nacl.hash
+import nacl.secret
+import nacl.signing
+
+# Lets several FreyaFS daemons, on different hosts, mount the same file system
+# sharing one block store. The coordinator hands out per-file leases (many
+# readers or one writer), keeps the latest stored version of every file, and
+# a journal of the changes, which the nodes poll to stay in sync. It only
+# sees file ids, versions and CIDs: everything else is encrypted by the nodes
+# with the key of the file system. Clients talk to it with one JSON line per
+# request over TCP, signed with a key derived from the one of the file system:
+# the coordinator only knows the key verifying them.
+
+DEFAULT_PORT = 7600
+LEASE_TTL = 30  # seconds a lease lasts, unless renewed
+LEASE_WAIT = 10  # seconds waited for a lease held by other nodes
+POLL_INTERVAL = 0.5  # seconds between polls of the journal
+AUTH_WINDOW = 60  # seconds a signed request stays valid, clocks of the nodes included
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+
+def default_node():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def signing_key(key: bytes):
+    """Returns the key the nodes sign their requests with, derived from the
+    key of the file system."""
+    seed = nacl.hash.blake2b(key, digest_size=32, person=b'freyafs-cluster', encoder=nacl.encoding.RawEncoder)
+    return nacl.signing.SigningKey(seed)
+
+
+def verify_key(key: bytes):
+    """Returns the key the coordinator checks the requests with, in base64."""
+    return signing_key(key).verify_key.encode(nacl.encoding.Base64Encoder).decode('ascii')
+
+
+def _signed_part(request):
+    return json.dumps({k: v for k, v in request.items() if k != 'sig'}, sort_keys=True).encode('utf-8')
+
+
+class Coordinator:
+    """In-memory coordination service, enough to run a few nodes (and to test them).
+
+    With a verify key, requests not signed by a node holding the key of the
+    file system, or signed more than AUTH_WINDOW ago, or already seen, are
+    refused.
+    """
+
+    def __init__(self, verify_key=None):
+        self.verify_key = nacl.signing.VerifyKey(verify_key.encode('ascii'), nacl.encoding.Base64Encoder) \
+            if verify_key is not None else None
+        self.seen = {}  # signatures of the requests still valid -> time
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.journal = []
+        self.files = {}  # path_id -> (version, record)
+        self.readers = {}  # path_id -> {node: expiry}
+        self.writers = {}  # path_id -> (node, expiry)
+        self.checkpoint = (0, None)
+
+    def handle(self, request):
+        with self.lock:
+            self._authenticate(request)
+            self._expire()
+            op = request['op']
+            if op == 'acquire':
+                return self._acquire(request['node'], request['id'], request['mode'], request['ttl'])
+            if op == 'renew':
+                return self._renew(request['node'], request['ttl'])
+            if op == 'release':
+                self._release(request['node'], request['id'])
+                return {'ok': True}
+            if op == 'commit':
+                return self._commit(request['node'], request['id'], request['base'], request['record'])
+            if op == 'fetch':
+                version, record = self.files.get(request['id'], (0, None))
+                return {'version': version, 'record': record}
+            if op == 'publish':
+                return {'seq': self._append(request['node'], {'kind': 'namespace', 'record': request['record']})}
+            if op == 'poll':
+                return self._poll(request['since'])
+            if op == 'checkpoint':
+                return self._checkpoint(request['seq'], request['blob'])
+            if op == 'load':
+                seq, blob = self.checkpoint
+                return {'seq': seq, 'blob': blob}
+            raise ValueError(f'Unknown operation "{op}"')
+
+    def _authenticate(self, request):
+        if self.verify_key is None:
+            return
+        now = time.time()
+        for sig in [sig for sig, ts in self.seen.items() if ts < now - AUTH_WINDOW]:
+            del self.seen[sig]
+
+        sig = request.get('sig')
+        try:
+            self.verify_key.verify(_signed_part(request), b64decode(sig.encode('ascii')))
+        except (nacl.exceptions.BadSignatureError, AttributeError, ValueError):
+            raise ValueError('Unauthenticated request')
+        if abs(now - request.get('ts', 0)) > AUTH_WINDOW or sig in self.seen:
+            raise ValueError('Expired or replayed request')
+        self.seen[sig] = now
+
+    def _expire(self):
+        now = time.monotonic()
+        for path_id, (node, expiry) in list(self.writers.items()):
+            if expiry <= now:
+                del self.writers[path_id]
+        for path_id, nodes in list(self.readers.items()):
+            for node in [node for node, expiry in nodes.items() if expiry <= now]:
+                del nodes[node]
+            if not nodes:
+                del self.readers[path_id]
+
+    def _acquire(self, node, path_id, mode, ttl):
+        version = self.files.get(path_id, (0, None))[0]
+        writer = self.writers.get(path_id)
+        if writer is not None and writer[0] != node:
+            return {'granted': False, 'version': version}
+
+        expiry = time.monotonic() + ttl
+        if mode == 'write':
+            if set(self.readers.get(path_id, ())) - {node}:
+                return {'granted': False, 'version': version}
+            self.writers[path_id] = (node, expiry)
+        else:
+            self.readers.setdefault(path_id, {})[node] = expiry
+        return {'granted': True, 'version': version}
+
+    def _renew(self, node, ttl):
+        expiry = time.monotonic() + ttl
+        for path_id, (holder, _) in self.writers.items():
+            if holder == node:
+                self.writers[path_id] = (node, expiry)
+        for nodes in self.readers.values():
+            if node in nodes:
+                nodes[node] = expiry
+        return {'ok': True}
+
+    def _release(self, node, path_id):
+        if self.writers.get(path_id, (None,))[0] == node:
+            del self.writers[path_id]
+        nodes = self.readers.get(path_id, {})
+        nodes.pop(node, None)
+        if not nodes:
+            self.readers.pop(path_id, None)
+
+    def _commit(self, node, path_id, base, record):
+        if self.writers.get(path_id, (None,))[0] != node:
+            raise ValueError(f'No write lease on "{path_id}"')
+
+        version = self.files.get(path_id, (0, None))[0]
+        if version != base:
+            return {'conflict': True, 'version': version}
+        self.files[path_id] = (version + 1, record)
+        self._append(node, {'kind': 'commit', 'id': path_id, 'version': version + 1, 'record': record})
+        return {'version': version + 1}
+
+    def _append(self, node, entry):
+        self.seq += 1
+        self.journal.append({**entry, 'seq': self.seq, 'node': node})
+        return self.seq
+
+    def _poll(self, since):
+        if since < self.checkpoint[0]:
+            # The entries were dropped: start again from the checkpoint
+            return {'reset': True}
+        return {'entries': [entry for entry in self.journal if entry['seq'] > since]}
+
+    def _checkpoint(self, seq, blob):
+        if seq > self.checkpoint[0]:
+            self.checkpoint = (seq, blob)
+            # Anything older is in the checkpoint
+            self.journal = [entry for entry in self.journal if entry['seq'] > seq]
+        return {'ok': True}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.coordinator.handle(json.loads(line))
+            except (ValueError, KeyError) as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(address, coordinator=None, verify_key=None):
+    """Runs a coordinator at address until interrupted."""
+    server = _Server(parse_address(address), _Handler)
+    server.coordinator = coordinator if coordinator is not None else Coordinator(verify_key)
+    try:
+        server.serve_forever(poll_interval=1)
+    finally:
+        server.server_close()
+
+
+# ------------------------------------------------------ Client
+
+class ClusterClient:
+    """Connection of a FreyaFS node to the coordinator.
+
+    Leases are counted per file, so that a file open several times is
+    released once closed everywhere. A background thread renews them, and
+    hands the journal entries of the other nodes over to `apply`.
+    """
+
+    def __init__(self, address, key: bytes, node=None, ttl=LEASE_TTL):
+        self.address = parse_address(address)
+        self.node = node if node is not None else default_node()
+        self.ttl = ttl
+        self.box = nacl.secret.SecretBox(key)
+        self.signer = signing_key(key)
+        self.seq = 0  # last journal entry applied
+        self.leases = {}  # path_id -> [mode, count]
+
+        self._lock = threading.Lock()
+        self._leases_lock = threading.Lock()
+        self._conn = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _request(self, request):
+        request = {**request, 'ts': time.time(), 'nonce': b64encode(os.urandom(12)).decode('ascii')}
+        request['sig'] = b64encode(self.signer.sign(_signed_part(request)).signature).decode('ascii')
+        data = (json.dumps(request) + '\n').encode('utf-8')
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        sock = socket.create_connection(self.address)
+                        self._conn = (sock, sock.makefile('rb'))
+                    self._conn[0].sendall(data)
+                    line = self._conn[1].readline()
+                    if not line:
+                        raise ConnectionResetError(errno.ECONNRESET, 'coordinator closed the connection')
+                    break
+                except OSError:
+                    # Reconnect once, the coordinator may have been restarted
+                    self._close()
+                    if attempt:
+                        raise
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn[1].close()
+            self._conn[0].close()
+            self._conn = None
+
+    def seal(self, data):
+        return b64encode(self.box.encrypt(json.dumps(data).encode('utf-8'))).decode('ascii')
+
+    def unseal(self, blob):
+        return json.loads(self.box.decrypt(b64decode(blob.encode('ascii'))))
+
+    # ------------------------------------------------------ Leases
+
+    def acquire(self, path_id, mode='read'):
+        """Takes a lease on a file, waiting for other nodes to let it go.
+
+        Returns the latest version of the file, or None if the lease was
+        already held by this node.
+        """
+        with self._leases_lock:
+            lease = self.leases.get(path_id)
+            if lease is not None and (lease[0] == 'write' or mode == 'read'):
+                lease[1] += 1
+                return None
+
+        deadline = time.monotonic() + LEASE_WAIT
+        delay = 0.05
+        while True:
+            response = self._request({'op': 'acquire', 'node': self.node, 'id': path_id,
+                                      'mode': mode, 'ttl': self.ttl})
+            if response['granted']:
+                break
+            if time.monotonic() >= deadline:
+                raise OSError(errno.EBUSY, f'"{path_id}" is in use on another node')
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+        with self._leases_lock:
+            lease = self.leases.setdefault(path_id, [mode, 0])
+            if mode == 'write':
+                lease[0] = mode
+            lease[1] += 1
+        return response['version']
+
+    def held(self, path_id):
+        """Returns the mode of the lease this node holds on a file, or None."""
+        with self._leases_lock:
+            lease = self.leases.get(path_id)
+            return lease[0] if lease is not None else None
+
+    def upgrade(self, path_id):
+        """Turns a read lease into a write one. Returns the latest version,
+        or None if the lease was already a write one."""
+        with self._leases_lock:
+            lease = self.leases.get(path_id)
+            if lease is not None and lease[0] == 'write':
+                return None
+        version = self.acquire(path_id, 'write')
+        # Upgrading does not count as one more open
+        self.release(path_id)
+        return version
+
+    def release(self, path_id):
+        with self._leases_lock:
+            lease = self.leases.get(path_id)
+            if lease is None:
+                return
+            lease[1] -= 1
+            if lease[1] <= 0:
+                del self.leases[path_id]
+                self._request({'op': 'release', 'node': self.node, 'id': path_id})
+
+    # ------------------------------------------------------ Versions and journal
+
+    def commit(self, path_id, base, record):
+        """Stores a new version of a file. Returns it, or None if another node
+        committed since base."""
+        response = self._request({'op': 'commit', 'node': self.node, 'id': path_id,
+                                  'base': base, 'record': self.seal(record)})
+        return None if response.get('conflict') else response['version']
+
+    def fetch(self, path_id):
+        response = self._request({'op': 'fetch', 'id': path_id})
+        record = response['record']
+        return response['version'], self.unseal(record) if record is not None else None
+
+    def publish(self, record):
+        self._request({'op': 'publish', 'node': self.node, 'record': self.seal(record)})
+
+    def checkpoint(self, data):
+        self._request({'op': 'checkpoint', 'node': self.node, 'seq': self.seq, 'blob': self.seal(data)})
+
+    def load(self):
+        """Returns the latest checkpoint, if newer than what this node has seen."""
+        response = self._request({'op': 'load'})
+        if response['blob'] is None or response['seq'] <= self.seq:
+            return None
+        self.seq = response['seq']
+        return self.unseal(response['blob'])
+
+    def poll(self, apply, reset):
+        response = self._request({'op': 'poll', 'since': self.seq})
+        if response.get('reset'):
+            reset(self.load())
+            return
+        for entry in response['entries']:
+            # A record that cannot be applied is skipped, rather than
+            # stopping the journal there for good
+            if entry['node'] != self.node:
+                try:
+                    record = self.unseal(entry['record'])
+                except (nacl.exceptions.CryptoError, ValueError, TypeError, AttributeError) as e:
+                    print(f'[i] Skipped journal entry {entry["seq"]} from "{entry["node"]}", '
+                          f'not sealed with the key of the file system: {e}')
+                else:
+                    try:
+                        apply({**entry, 'record': record})
+                    except Exception as e:
+                        print(f'[i] Skipped journal entry {entry["seq"]} from "{entry["node"]}", '
+                              f'which could not be applied: {e!r}')
+            self.seq = entry['seq']
+
+    # ------------------------------------------------------ Background thread
+
+    def start(self, apply, reset):
+        def run():
+            renewed = time.monotonic()
+            while not self._stop.wait(POLL_INTERVAL):
+                try:
+                    if time.monotonic() - renewed >= self.ttl / 3:
+                        self._request({'op': 'renew', 'node': self.node, 'ttl': self.ttl})
+                        renewed = time.monotonic()
+                    self.poll(apply, reset)
+                except (OSError, ValueError) as e:
+                    print(f'[i] Coordinator unreachable: {e}')
+                except Exception as e:
+                    # Leases would expire silently with the thread gone
+                    print(f'[i] Could not sync with the coordinator: {e!r}')
+
+        self._thread = threading.Thread(target=run, name='freyafs-cluster', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._leases_lock:
+            for path_id in list(self.leases):
+                self._request({'op': 'release', 'node': self.node, 'id': path_id})
+            self.leases.clear()
+        with self._lock:
+            self._close()
@@ -1,13 +1,65 @@
+import sys
 import threading
 
+from aesmix256k import MACRO_SIZE
+
+PAGE_SIZE = MACRO_SIZE
+
+
+def join_pages(pages, size):
+    text = bytearray(size)
+    for index, page in pages.items():
+        text[PAGE_SIZE*index: PAGE_SIZE*index + len(page)] = page
+    return text
+
 
 class FileByteContent:
-    def __init__(self, text):
-        # NOTE: We use bytearray instead of bytes because we may need to extend
-        #       it due to write operations
-        self._text = bytearray(text)
+    """Content of an open file, as a map of pages as large as a macroblock.
+
+    Pages that were never written (holes) are not allocated, and read as
+    zeros. The last allocated bytes of a page may be missing as well.
+
+    Appending fills the last page in place, and truncating drops whole pages,
+    so neither copies the rest of the file. Snapshots share the pages with the
+    content: a page is copied only when written while a snapshot holds it.
+
+    Pages of compressed files are kept in the form they were stored in until
+    read (packed), and that form is kept until they are written, so that
+    storing the file again does not compress them again.
+    """
+
+    def __init__(self, text=b'', pages=None, size=None, stored=None, unpack=None):
+        if pages is None:
+            pages, size = self._split(text), len(text)
+        self._pages = pages
+        self._size = size
+        # Form each page was stored in, as long as it is not written: its
+        # compressed data, or None if it was stored as it is
+        self._stored = dict(stored) if stored else {}
+        self._unpack = unpack
+        self._unpacking = threading.Lock()
+        # Pages still packed, with the length they count for until unpacked
+        self._packed = {index: min(PAGE_SIZE, size - PAGE_SIZE*index)
+                        for index, data in self._stored.items() if data is not None and index not in pages}
+        self._allocated = sum(len(page) for page in pages.values()) + sum(self._packed.values())
+        # Memory actually taken by the pages, overallocation included
+        self._footprint = sum(sys.getsizeof(page) for page in pages.values()) + \
+            sum(sys.getsizeof(data) for data in self._stored.values() if data is not None)
+        self._shared = set()  # pages held by a snapshot
+        self._held = 0  # memory of the pages copied away from a snapshot
         self._cond = threading.Condition(threading.Lock())
         self._readers = 0
+        # Macroblocks written since the content was last stored
+        self._dirty = set()
+
+    @staticmethod
+    def _split(text):
+        pages = {}
+        for index in range(0, (len(text) + PAGE_SIZE - 1) // PAGE_SIZE):
+            page = bytearray(text[PAGE_SIZE*index: PAGE_SIZE*(index+1)])
+            if page.count(0) != len(page):
+                pages[index] = page
+        return pages
 
     def _r_acquire(self):
         self._cond.acquire()
@@ -35,33 +87,227 @@ class FileByteContent:
 
     def __len__(self):
         self._r_acquire()
-        length = len(self._text)
+        length = self._size
         self._r_release()
         return length
 
+    def allocated(self):
+        """Returns the number of bytes actually held, holes excluded."""
+        return self._allocated
+
+    def footprint(self):
+        """Returns the memory taken by the content and its snapshot."""
+        return self._footprint + self._held
+
+    def _page(self, index):
+        # Packed pages are unpacked when first used, readers may race for it
+        page = self._pages.get(index)
+        if page is None and index in self._packed:
+            with self._unpacking:
+                page = self._pages.get(index)
+                if page is None:
+                    page = self._pages[index] = bytearray(self._unpack(self._stored[index]))
+                    self._allocated += len(page) - self._packed.pop(index)
+                    self._footprint += sys.getsizeof(page)
+        return page
+
+    def _unpack_all(self):
+        for index in list(self._packed):
+            self._page(index)
+
+    def _forget_stored(self, index):
+        data = self._stored.pop(index, None)
+        if data is not None:
+            self._footprint -= sys.getsizeof(data)
+
     def read_all(self, as_bytearray=False):
         self._r_acquire()
-        text = self._text.copy()
+        self._unpack_all()
+        text = join_pages(self._pages, self._size)
         self._r_release()
         if as_bytearray:
             return text
         else:
             return bytes(text)
 
-    def read_bytes(self, offset, length):
+    def snapshot(self, packed=False):
+        """Returns the pages and size of the content, along with the written
+        macroblocks, and forgets them.
+
+        The pages must not be modified: writers copy them instead, so the
+        snapshot stays consistent while they go on.
+
+        If packed, pages still packed are missing from the map, and the form
+        the pages were stored in is returned as well (see stored_as()).
+        """
+        self._w_acquire()
+        if not packed:
+            self._unpack_all()
+        pages = dict(self._pages)
+        size = self._size
+        stored = dict(self._stored)
+        self._shared = set(pages)
+        self._held = 0
+        dirty = self._dirty
+        self._dirty = set()
+        self._w_release()
+        if packed:
+            return pages, size, dirty, stored
+        return pages, size, dirty
+
+    def unpacked(self, pages, stored):
+        """Returns the pages of a packed snapshot, those still packed included."""
+        missing = [index for index, data in stored.items() if data is not None and index not in pages]
+        if not missing:
+            return pages
+        pages = dict(pages)
+        for index in missing:
+            pages[index] = bytearray(self._unpack(stored[index]))
+        return pages
+
+    def stored_as(self, stored, unpack):
+        """Records the form the pages of the last snapshot were stored in, as
+        a map of their compressed data (None for pages stored as they are),
+        for the pages not written since. unpack() decompresses that data."""
+        self._w_acquire()
+        # Pages whose form is not kept cannot stay packed
+        for index in [i for i in self._packed if stored.get(i) is None]:
+            self._page(index)
+        for index in list(self._stored):
+            self._forget_stored(index)
+        for index, data in stored.items():
+            if index not in self._dirty and (index in self._pages or index in self._packed):
+                self._stored[index] = data
+                if data is not None:
+                    self._footprint += sys.getsizeof(data)
+        self._unpack = unpack
+        self._w_release()
+
+    def release_snapshot(self):
+        """To be called once the last snapshot is not used anymore."""
+        self._w_acquire()
+        self._shared = set()
+        self._held = 0
+        self._w_release()
+
+    def _own(self, index):
+        # Copy on write of a page held by a snapshot
+        self._page(index)
+        self._forget_stored(index)
+        if index not in self._pages:
+            page = self._pages[index] = bytearray()
+            self._footprint += sys.getsizeof(page)
+            return page
+
+        page = self._pages[index]
+        if index in self._shared:
+            self._shared.discard(index)
+            self._held += sys.getsizeof(page)
+            page = self._pages[index] = bytearray(page)
+        return page
+
+    def write_need(self, length, offset):
+        """Estimates the memory a write would add, pages copied away from a
+        snapshot included."""
+        if not length:
+            return 0
+        self._r_acquire()
+        need = 0
+        end = offset + length
+        for index in range(offset // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1):
+            page_end = min(end - PAGE_SIZE * index, PAGE_SIZE)
+            page = self._pages.get(index)
+            if page is None and index in self._packed:
+                # Unpacked first
+                need += max(self._packed[index], page_end)
+            elif page is None:
+                need += page_end
+            elif index in self._shared:
+                need += max(len(page), page_end)
+            else:
+                need += max(page_end - len(page), 0)
+        self._r_release()
+        return need
+
+    def restore_dirty(self, dirty):
+        """Marks again macroblocks that could not be stored."""
+        self._w_acquire()
+        self._dirty |= dirty
+        self._w_release()
+
+    def _mark_dirty(self, start, end):
+        self._dirty.update(range(start // MACRO_SIZE, (end - 1) // MACRO_SIZE + 1))
+
+    def read_bytes(self, offset, length, unpack=True):
+        """Returns the bytes in range, None if pages would have to be
+        unpacked and unpack is false."""
         self._r_acquire()
-        text = self._text[offset:offset + length]
+        end = min(offset + length, self._size)
+        if not unpack and offset < end and any(index in self._packed
+                              for index in range(offset // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1)):
+            self._r_release()
+            return None
+        parts = []
+        while offset < end:
+            index, start = divmod(offset, PAGE_SIZE)
+            n = min(PAGE_SIZE - start, end - offset)
+            page = self._page(index) or b''
+            available = max(min(len(page) - start, n), 0)
+            if available:
+                parts.append(memoryview(page)[start:start + available])
+            if available < n:
+                parts.append(bytes(n - available))
+            offset += n
+        # Copied once, before the views are dropped (pages cannot be resized
+        # while exported)
+        text = bytes(parts[0]) if len(parts) == 1 else b''.join(parts)
+        del parts
         self._r_release()
-        return bytes(text)
+        return text
 
     def write_bytes(self, buf, offset):
         self._w_acquire()
         bytes_to_write = len(buf)
-        self._text[offset:offset + bytes_to_write] = buf
+        view = memoryview(buf)
+        written = 0
+        while written < bytes_to_write:
+            index, start = divmod(offset + written, PAGE_SIZE)
+            n = min(PAGE_SIZE - start, bytes_to_write - written)
+            page = self._own(index)
+            allocated, footprint = len(page), sys.getsizeof(page)
+            if allocated < start:
+                page.extend(bytes(start - allocated))
+            page[start:start + n] = view[written:written + n]
+            self._allocated += len(page) - allocated
+            self._footprint += sys.getsizeof(page) - footprint
+            written += n
+        self._size = max(self._size, offset + bytes_to_write)
+        self._mark_dirty(offset, offset + bytes_to_write)
         self._w_release()
         return bytes_to_write
 
     def truncate(self, length):
         self._w_acquire()
-        self._text = self._text[:length]
+        if length < self._size:
+            last, rest = divmod(length, PAGE_SIZE)
+            for index in [i for i in [*self._pages, *self._packed] if i > last or (i == last and rest == 0)]:
+                self._forget_stored(index)
+                if index in self._packed:
+                    self._allocated -= self._packed.pop(index)
+                    continue
+                page = self._pages.pop(index)
+                self._allocated -= len(page)
+                if index in self._shared:
+                    self._shared.discard(index)
+                    self._held += sys.getsizeof(page)
+                self._footprint -= sys.getsizeof(page)
+            if self._page(last) is not None:
+                page = self._own(last)
+                allocated, footprint = len(page), sys.getsizeof(page)
+                del page[rest:]
+                self._allocated -= max(allocated - rest, 0)
+                self._footprint += sys.getsizeof(page) - footprint
+        # Growing the file only makes a hole
+        self._size = length
+        self._mark_dirty(length, length + 1)
         self._w_release()
@@ -0,0 +1,18 @@
+# Linux ioctl request encoding (see asm-generic/ioctl.h)
+_IOC_WRITE = 1
+
+
+def _IOC(direction, type, nr, size):
+    return (direction << 30) | (size << 16) | (type << 8) | nr
+
+
+def _IOW(type, nr, size):
+    return _IOC(_IOC_WRITE, type, nr, size)
+
+
+FREYAFS_IOC_MAGIC = 0xF7
+
+# Clones the file the ioctl is issued on to the (absolute, NUL-terminated)
+# path given as argument, which must be within the same mount
+CLONE_PATH_MAX = 4096
+FREYAFS_IOC_CLONE = _IOW(FREYAFS_IOC_MAGIC, 1, CLONE_PATH_MAX)
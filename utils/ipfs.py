@@ -1,38 +1,65 @@
+import hashlib
 import requests
 
+from base64 import b32encode
+
+from .trace import traced
+
 IPFS_API = 'http://localhost:5001/api/v0'
 
+# CIDv1 prefix of a raw block hashed with sha2-256, the same kind of CID
+# returned by `ipfs block put`
+RAW_CID_PREFIX = bytes([0x01, 0x55, 0x12, 0x20])
+
+
+def cid_of(data):
+    digest = hashlib.sha256(data).digest()
+    return 'b' + b32encode(RAW_CID_PREFIX + digest).decode('ascii').lower().rstrip('=')
 
+
+@traced(name='ipfs.block_put', cat='ipfs')
 def block_put(data):
     r = requests.post(f'{IPFS_API}/block/put', files={'data': data})
     return r.json()['Key']
 
 
+@traced(name='ipfs.block_get', cat='ipfs')
 def block_get(cid):
     r = requests.post(f'{IPFS_API}/block/get?arg={cid}')
     return r.content
 
 
+@traced(name='ipfs.block_stat', cat='ipfs')
+def block_stat(cid):
+    r = requests.post(f'{IPFS_API}/block/stat?arg={cid}')
+    return r.json()
+
+
+@traced(name='ipfs.file_write', cat='ipfs')
 def file_write(path, data):
     r = requests.post(f'{IPFS_API}/files/write?arg={path}', files={'data': data})
     print(r)
     print(r.content)
 
 
+@traced(name='ipfs.send_to_ipfs', cat='ipfs')
 def send_to_ipfs(data, name='data'):
     r = requests.post(f'{IPFS_API}/add', files={name: data})
     cid = r.json()['Hash']
     return cid
 
 
+@traced(name='ipfs.unpin_locally', cat='ipfs')
 def unpin_locally(cid):
     requests.post(f'{IPFS_API}/pin/rm?arg={cid}')
 
 
+@traced(name='ipfs.get_from_ipfs', cat='ipfs')
 def get_from_ipfs(cid):
     r = requests.post(f'{IPFS_API}/cat?arg={cid}')
     return r.content
 
 
+@traced(name='ipfs.remove_local_block', cat='ipfs')
 def remove_local_block(cid):
     requests.post(f'{IPFS_API}/block/rm?arg={cid}')
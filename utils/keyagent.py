@@ -0,0 +1,168 @@
+import ctypes
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from base64 import b64decode, b64encode
+from pathlib import Path
+
+# Keeps the keys derived from the passwords of mounted file systems, so that
+# they can be mounted again without prompting, nor paying the KDF again.
+# Clients talk to it with one JSON line per request over a UNIX socket only
+# its owner can connect to.
+
+DEFAULT_TIMEOUT = 8 * 60 * 60  # seconds a key is kept after being added
+REQUEST_TIMEOUT = 5  # seconds a client waits for the agent
+
+
+def default_socket():
+    runtime = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+    return Path(runtime) / f'freyafs-agent-{os.getuid()}.sock'
+
+
+class _LockedKey:
+    """A key in memory that is never swapped out, and wiped when forgotten."""
+
+    _libc = ctypes.CDLL(None, use_errno=True)
+
+    def __init__(self, key: bytes, expires):
+        self.buffer = ctypes.create_string_buffer(key, len(key))
+        self.length = len(key)
+        self.expires = expires
+        # Best effort: fails when RLIMIT_MEMLOCK is exhausted
+        self.locked = self._libc.mlock(ctypes.addressof(self.buffer), self.length) == 0
+
+    def value(self):
+        return self.buffer.raw[:self.length]
+
+    def wipe(self):
+        ctypes.memset(self.buffer, 0, self.length)
+        if self.locked:
+            self._libc.munlock(ctypes.addressof(self.buffer), self.length)
+            self.locked = False
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        if uid != os.getuid():
+            return
+
+        for line in self.rfile:
+            try:
+                response = self.server.agent.handle(json.loads(line))
+            except (ValueError, KeyError) as e:
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Clients with a timeout fail to connect, rather than wait, once full
+    request_queue_size = 128
+
+    def service_actions(self):
+        self.agent.expire()
+
+
+class KeyAgent:
+    def __init__(self, socket_path=None, timeout=DEFAULT_TIMEOUT):
+        self.socket_path = Path(socket_path) if socket_path is not None else default_socket()
+        self.timeout = timeout
+        self.keys = {}
+        # Each connection is served by its own thread
+        self.lock = threading.RLock()
+
+    def handle(self, request):
+        with self.lock:
+            self.expire()
+            op = request['op']
+            if op == 'get':
+                key = self.keys.get(request['id'])
+                return {'key': b64encode(key.value()).decode('ascii') if key is not None else None}
+            if op == 'add':
+                self._forget(request['id'])
+                key = b64decode(request['key'].encode('ascii'))
+                self.keys[request['id']] = _LockedKey(key, time.monotonic() + self.timeout)
+                return {'ok': True}
+            if op == 'forget':
+                for ident in [request['id']] if request.get('id') else list(self.keys):
+                    self._forget(ident)
+                return {'ok': True}
+            raise ValueError(f'Unknown operation "{op}"')
+
+    def _forget(self, ident):
+        key = self.keys.pop(ident, None)
+        if key is not None:
+            key.wipe()
+
+    def expire(self):
+        with self.lock:
+            now = time.monotonic()
+            for ident in [ident for ident, key in self.keys.items() if key.expires <= now]:
+                self._forget(ident)
+
+    def serve_forever(self):
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+        # The socket is created readable and writable by its owner only
+        old_umask = os.umask(0o077)
+        try:
+            server = _Server(str(self.socket_path), _Handler)
+        finally:
+            os.umask(old_umask)
+        server.agent = self
+
+        try:
+            server.serve_forever(poll_interval=1)
+        finally:
+            server.server_close()
+            self.socket_path.unlink()
+            with self.lock:
+                for ident in list(self.keys):
+                    self._forget(ident)
+
+
+# ------------------------------------------------------ Client
+
+def _request(request, socket_path=None):
+    socket_path = socket_path if socket_path is not None else default_socket()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        # A stuck agent must not hang the mount
+        s.settimeout(REQUEST_TIMEOUT)
+        s.connect(str(socket_path))
+        s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with s.makefile('rb') as f:
+            response = json.loads(f.readline())
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response
+
+
+def get_key(ident, socket_path=None):
+    """Returns the key held by the agent for ident, or None (also when no agent runs)."""
+    try:
+        key = _request({'op': 'get', 'id': ident}, socket_path)['key']
+    except (OSError, ValueError):
+        return None
+    return b64decode(key.encode('ascii')) if key is not None else None
+
+
+def add_key(ident, key: bytes, socket_path=None):
+    """Hands a key over to the agent. Returns False if no agent runs, or if
+    it did not take the key."""
+    try:
+        _request({'op': 'add', 'id': ident, 'key': b64encode(key).decode('ascii')}, socket_path)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def forget_keys(ident=None, socket_path=None):
+    _request({'op': 'forget', 'id': ident}, socket_path)
@@ -1,88 +1,496 @@
+import hashlib
+import hmac
+import itertools
+import os
+import threading
+
+from collections import deque
+from concurrent.futures import Future
+
 from aesmix256k import mixencrypt, mixdecrypt, MACRO_SIZE
+from Crypto.Cipher import AES
+from Crypto.Util import number
 from multiprocessing import Pool
 
-from pathlib import Path
-
-from .fastfile import FastFile
+from . import scheduler
 from .padder import Padder
-from .ipfs import block_put, block_get
+from .trace import span
 
 padder = Padder(blocksize=MACRO_SIZE)
 SIZE_TO_KEEP = 1024  # Keep 1KB over 256KB of macro block
+WINDOW = 16  # macroblocks in transfer between the block store and the workers
+FRAGMENT_KEY_SIZE = 32
+NONCE_SIZE = 8
+
+# Macroblocks made only of zeros (holes of sparse files) are neither mixed nor
+# stored: their CID is None, and they have no kept fragment
+ZERO_MACROBLOCK = bytes(MACRO_SIZE)
 
 
 def _encrypt_block(arg):
-    block, key, iv = arg
-    encrypted = mixencrypt(data=block, key=key, iv=iv)
-    to_keep = encrypted[:SIZE_TO_KEEP]
-    to_ipfs = encrypted[SIZE_TO_KEEP:]
+    index, block, key, iv = arg
+    with span('mixencrypt', cat='mix', block=index):
+        encrypted = mixencrypt(data=block, key=key, iv=iv)
+    return index, encrypted
 
-    cid = block_put(to_ipfs)
 
-    return to_keep, cid
+def _decrypt_block(arg):
+    index, kept_data, from_ipfs, key, iv = arg
+    with span('mixdecrypt', cat='mix', block=index):
+        decrypted = mixdecrypt(kept_data + from_ipfs, key, iv)
+    return decrypted
 
 
-def _decrypt_block(arg):
-    kept_data, cid, key, iv = arg
+def new_fragment_key():
+    return os.urandom(FRAGMENT_KEY_SIZE)
 
-    from_ipfs = block_get(cid)
 
-    decrypted = mixdecrypt(kept_data + from_ipfs, key, iv)
-    return decrypted
+def wrap(data, fragment_key):
+    """Encrypts kept fragments (AES-CTR, with a fresh nonce in front).
+
+    Without the fragments the stored blocks cannot be un-mixed, so changing
+    the key wrapping them is enough to revoke the key material of a file.
+    """
+    if fragment_key is None:
+        return data
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AES.new(fragment_key, AES.MODE_CTR, nonce=nonce).encrypt(data)
+
+
+def unwrap(data, fragment_key):
+    if fragment_key is None:
+        return data
+    nonce = data[:NONCE_SIZE]
+    return AES.new(fragment_key, AES.MODE_CTR, nonce=nonce).decrypt(data[NONCE_SIZE:])
+
+
+class Convergent:
+    """Convergent encryption of a file.
+
+    The key and iv of each macroblock are derived from its content, under a
+    secret (HMAC-SHA256), instead of being the ones of the file: identical
+    macroblocks are mixed into identical blocks, and blocks already found in
+    the dedup index are not uploaded again. `digests` holds the digest of
+    each macroblock (None for holes), which is all decryption needs. Given
+    the ones of the previous version, those of reused macroblocks are kept.
+    """
+
+    def __init__(self, secret, digests=None, index=None):
+        self.secret = secret
+        self.digests = list(digests) if digests is not None else []
+        self.index = index
+
+    def digest(self, block):
+        return hmac.new(self.secret, block, hashlib.sha256).digest()
+
+
+def convergent_key(digest):
+    """Returns the key and iv of a macroblock encrypted with the given digest."""
+    return digest[:16], digest[16:]
+
+
+def _read_kept(fragment, fragment_key):
+    return unwrap(fragment.read(), fragment_key)
+
+
+def rewrap(fragment, fragment_key, new_key, dest):
+    """Writes the kept fragments of fragment to dest, wrapped with new_key.
+    Returns the fragment as read, and the number of bytes written."""
+    data = fragment.read()
+    wrapped = wrap(unwrap(data, fragment_key), new_key)
+    dest.write(wrapped)
+    return data, len(wrapped)
+
 
+def working_memory(num_macroblocks):
+    """Estimates the memory used by encrypting or decrypting, besides the data."""
+    # The window of blocks in transfer, the blocks sent to and received from
+    # each worker, and the padded tail
+    in_flight = min(num_macroblocks, WINDOW + 2 * os.cpu_count())
+    return (2 * in_flight + 2) * MACRO_SIZE
 
-def encrypt(data, path: Path, key, iv):
+
+def _kept_offsets(cids):
+    """Maps each stored macroblock to the offset of its kept fragment."""
+    offsets = {}
+    for i, cid in enumerate(cids):
+        if cid is not None:
+            offsets[i] = SIZE_TO_KEEP * len(offsets)
+    return offsets
+
+
+def _reusable(index, size, previous, dirty):
+    """Tells whether the stored macroblock can be kept as it is.
+
+    Only macroblocks made entirely of data (no padding) in both versions, and
+    not written in between, are guaranteed to be mixed exactly the same.
+    """
+    if previous is None:
+        return False
+    previous_size, previous_cids = previous
+    end = MACRO_SIZE * (index + 1)
+    return index < len(previous_cids) and index not in dirty \
+        and end <= size and end <= previous_size
+
+
+def _padded_tail(pages, size):
+    """Returns the index of the first macroblock holding padding, and the padded tail."""
+    first = size // MACRO_SIZE
+    tail = bytearray(pages.get(first, b''))
+    tail.extend(bytes(size - MACRO_SIZE*first - len(tail)))
+    padder.pad_mutable(tail)
+    return first, tail
+
+
+def _macroblock(pages, first, tail, index):
+    """Returns the macroblock to mix, or None for a hole."""
+    if index >= first:
+        offset = MACRO_SIZE * (index - first)
+        return tail[offset: offset + MACRO_SIZE]
+
+    page = pages.get(index)
+    if page is None:
+        return None
+    if len(page) < MACRO_SIZE:
+        page = bytes(page) + bytes(MACRO_SIZE - len(page))
+    return page if page != ZERO_MACROBLOCK else None
+
+
+def encrypt(data, fragment, key, iv, store, previous=None, dirty=frozenset(), fragment_key=None):
     """Encrypts plaintext data.
 
     Args:
-        data (bytestr|bytearray): The data to encrypt (multiple of MACRO_SIZE).
+        data (bytestr|bytearray): The data to encrypt.
+        fragment (Fragment): Where the kept fragments are written.
+        key (bytestr): The key used for AES encryption (16 bytes long).
+        iv (bytestr): The iv used for AES encryption (16 bytes long).
+        store (BlockStore): The store the mixed blocks are uploaded to.
+        previous (tuple): The size and CIDs of the version stored before.
+        dirty (set): The indexes of the macroblocks written since then.
+        fragment_key (bytestr): The key wrapping the kept fragments, if any.
+    """
+    pages = {i: data[MACRO_SIZE*i: MACRO_SIZE*(i+1)] for i in range(len(data) // MACRO_SIZE)}
+    pages[len(data) // MACRO_SIZE] = data[MACRO_SIZE * (len(data) // MACRO_SIZE):]
+    return encrypt_pages(pages, len(data), fragment, key, iv, store, previous=previous, dirty=dirty,
+                         fragment_key=fragment_key)
+
+
+def encrypt_pages(pages, size, fragment, key, iv, store, previous=None, dirty=frozenset(), fragment_key=None,
+                  convergent=None):
+    """Encrypts plaintext data, given as a map of macroblocks (missing ones are holes).
+
+    Macroblocks are mixed by a pool of worker processes, and each one is
+    handed over to the block store as soon as it is ready, so uploads overlap
+    with the mixing of the following macroblocks. No more than WINDOW mixed
+    macroblocks wait for their upload at any time.
+
+    When the previous version stored is given, along with the indexes
+    of the macroblocks written since then, the unchanged macroblocks reuse
+    their kept fragments and CIDs without being mixed again.
+
+    Macroblocks made only of zeros get None as CID.
+
+    Args:
+        pages (dict): The data to encrypt, by macroblock (may be shorter).
+        size (int): The size of the data.
+        fragment (Fragment): Where the kept fragments are written.
+        key (bytestr): The key used for AES encryption (16 bytes long).
+        iv (bytestr): The iv used for AES encryption (16 bytes long).
+        store (BlockStore): The store the mixed blocks are uploaded to.
+        previous (tuple): The size and CIDs of the version stored before.
+        dirty (set): The indexes of the macroblocks written since then.
+        fragment_key (bytestr): The key wrapping the kept fragments, if any.
+        convergent (Convergent): To derive the key material of each
+            macroblock from its content, and record it.
+    """
+    kept, futures, blocks = _prepare_pages(pages, size, fragment, key, iv, previous, dirty, fragment_key,
+                                           convergent)
+    mixed = _mix(blocks, store, kept, futures, convergent.index if convergent is not None else None)
+    return _store(fragment, kept, futures, mixed, fragment_key)
+
+
+def _prepare_pages(pages, size, fragment, key, iv, previous, dirty, fragment_key, convergent=None):
+    """Returns the kept fragments and CIDs of the reused macroblocks, and
+    the (index, macroblock, key, iv, digest) tuples to mix."""
+    with span('pad', cat='mix', size=size):
+        first, tail = _padded_tail(pages, size)
+
+    num_macroblocks = first + len(tail) // MACRO_SIZE
+    reused = set(i for i in range(num_macroblocks) if _reusable(i, size, previous, dirty))
+    kept = [b''] * num_macroblocks
+    futures = [None] * num_macroblocks
+
+    offsets = _kept_offsets(previous[1]) if reused else {}
+    if offsets.keys() & reused:
+        previous_kept = _read_kept(fragment, fragment_key)
+    for i in reused:
+        if i in offsets:
+            kept[i] = previous_kept[offsets[i]: offsets[i] + SIZE_TO_KEEP]
+        futures[i] = previous[1][i]
+
+    # Holes keep None as CID: nothing to mix, nor to store
+    blocks = ((i, _macroblock(pages, first, tail, i)) for i in range(num_macroblocks) if i not in reused)
+    if convergent is None:
+        return kept, futures, ((i, block, key, iv, None) for i, block in blocks)
+
+    digests = convergent.digests
+    digests[num_macroblocks:] = []
+    digests.extend([None] * (num_macroblocks - len(digests)))
+
+    def convergent_blocks():
+        for i, block in blocks:
+            if block is None:
+                digests[i] = None
+                yield i, None, None, None, None
+                continue
+            digests[i] = convergent.digest(block)
+            block_key, block_iv = convergent_key(digests[i])
+            yield i, block, block_key, block_iv, digests[i]
+
+    return kept, futures, convergent_blocks()
+
+
+def encrypt_group(files, store):
+    """Encrypts several files at once, as many calls to encrypt_pages() would.
+
+    The macroblocks of all the files are mixed in a single pass of the pool
+    of workers, and uploaded concurrently. The kept fragments are written
+    once every block is stored.
+
+    Args:
+        files (list): The arguments of encrypt_pages() for each file, but
+            the store, as dicts.
+        store (BlockStore): The store the mixed blocks are uploaded to.
+    Returns the CIDs of each file.
+    """
+    kept, futures, blocks, ranges = [], [], [], []
+    index = None
+    for f in files:
+        file_kept, file_futures, file_blocks = _prepare_pages(
+            f['pages'], f['size'], f['fragment'], f['key'], f['iv'],
+            f.get('previous'), f.get('dirty', frozenset()), f.get('fragment_key'), f.get('convergent'))
+        ranges.append((len(kept), len(file_kept)))
+        blocks.append(_shifted(file_blocks, len(kept)))
+        kept += file_kept
+        futures += file_futures
+        if f.get('convergent') is not None:
+            index = f['convergent'].index
+
+    mixed = _mix(itertools.chain.from_iterable(blocks), store, kept, futures, index)
+    with span('blocks.wait', cat='blocks', blocks=len(mixed)):
+        ipfs_cids = [f.result() if i in mixed else f for i, f in enumerate(futures)]
+
+    for f, (start, length) in zip(files, ranges):
+        f['fragment'].write(wrap(b''.join(kept[start:start + length]), f.get('fragment_key')))
+    return [ipfs_cids[start:start + length] for start, length in ranges]
+
+
+def _shifted(blocks, offset):
+    for i, *rest in blocks:
+        yield offset + i, *rest
+
+
+def encrypt_chunks(chunks, fragment, key, iv, store, previous=None, fragment_key=None):
+    """Encrypts data split in chunks, each one padded with zeros to a macroblock.
+
+    Chunks already stored in the previous version, told apart by their
+    digest, reuse their kept fragment and CID without being mixed again.
+    Chunks made only of zeros get None as CID.
+
+    Args:
+        chunks (list): The digest and data (None for zeros) of each chunk,
+            at most a macroblock long.
+        fragment (Fragment): Where the kept fragments are written.
         key (bytestr): The key used for AES encryption (16 bytes long).
         iv (bytestr): The iv used for AES encryption (16 bytes long).
+        store (BlockStore): The store the mixed blocks are uploaded to.
+        previous (tuple): The digests and CIDs of the version stored before.
+        fragment_key (bytestr): The key wrapping the kept fragments, if any.
     """
-    padded_data = data if isinstance(data, bytearray) else bytearray(data)
-    padder.pad_mutable(padded_data)
+    kept = [b''] * len(chunks)
+    futures = [None] * len(chunks)
+
+    stored = {}
+    if previous is not None:
+        digests, cids = previous
+        offsets = _kept_offsets(cids)
+        if offsets:
+            previous_kept = _read_kept(fragment, fragment_key)
+        for j, digest in enumerate(digests):
+            kept_data = previous_kept[offsets[j]: offsets[j] + SIZE_TO_KEEP] if j in offsets else b''
+            stored.setdefault(digest, (cids[j], kept_data))
 
-    num_macroblocks = len(padded_data) // MACRO_SIZE
-    with Pool() as p:
-        args = [
-            (padded_data[MACRO_SIZE*i: MACRO_SIZE*(i+1)], key, iv) for i in range(num_macroblocks)
-        ]
-        res = p.map(_encrypt_block, args)
+    to_mix = []
+    for i, (digest, data) in enumerate(chunks):
+        if digest in stored:
+            futures[i], kept[i] = stored[digest]
+        elif data is not None:
+            to_mix.append(i)
 
-    ipfs_cids = []
-    to_keep = bytearray(b'')
-    for kept, cid in res:
-        to_keep += kept
-        ipfs_cids.append(cid)
+    blocks = ((i, bytes(chunks[i][1]).ljust(MACRO_SIZE, b'\0'), key, iv, None) for i in to_mix)
+    mixed = _mix(blocks, store, kept, futures)
+    return _store(fragment, kept, futures, mixed, fragment_key)
 
-    with FastFile(path, 'w') as f:
-        f.write(to_keep)
+
+def _mix(blocks, store, kept, futures, index=None):
+    """Mixes the given (index, macroblock, key, iv, digest) tuples, and hands
+    each one over to the store as soon as it is ready. Returns the indexes of
+    the mixed ones.
+
+    Blocks of convergent macroblocks (with a digest) are uploaded once: those
+    in the dedup index, or already uploaded by this call, are not uploaded
+    again. Their kept fragment still comes from mixing them."""
+    to_mix = []
+    digests = {}
+    uploads = {}  # digest -> future
+    window = threading.Semaphore(WINDOW)
+    # The pool takes the arguments from a thread of its own
+    owner = scheduler.current()
+    slots = deque()
+
+    def args():
+        for i, block, key, iv, digest in blocks:
+            if block is not None:
+                to_mix.append(i)
+                if digest is not None:
+                    digests[i] = digest
+                window.acquire()
+                slots.append(scheduler.acquire('cpu', owner=owner))
+                yield i, block, key, iv
+
+    with span('pool.start', cat='mix'):
+        p = Pool()
+    with p:
+        try:
+            with span('pool.map', cat='mix', blocks=len(futures)):
+                for i, encrypted in p.imap(_encrypt_block, args()):
+                    scheduler.release(slots.popleft())
+                    kept[i] = encrypted[:SIZE_TO_KEEP]
+                    futures[i] = _upload(store, encrypted[SIZE_TO_KEEP:], digests.get(i), index, uploads)
+                    futures[i].add_done_callback(lambda _: window.release())
+        except BaseException:
+            # Unblock the pool feeding the workers, or it cannot be terminated
+            window.release(len(futures))
+            while slots:
+                scheduler.release(slots.popleft())
+            raise
+    return set(to_mix)
+
+
+def _upload(store, block, digest, index, uploads):
+    if digest is None:
+        return store.submit_put(block)
+    if digest in uploads:
+        if index is not None:
+            index.skipped(len(block))
+        return uploads[digest]
+    cid = index.get(digest) if index is not None else None
+    if cid is not None:
+        index.skipped(len(block))
+        future = Future()
+        future.set_result(cid)
+    else:
+        future = store.submit_put(block)
+    uploads[digest] = future
+    return future
+
+
+def _store(fragment, kept, futures, mixed, fragment_key):
+    """Waits for the mixed blocks to be stored, then writes the kept fragments."""
+    with span('blocks.wait', cat='blocks', blocks=len(mixed)):
+        ipfs_cids = [f.result() if i in mixed else f for i, f in enumerate(futures)]
+
+    fragment.write(wrap(b''.join(kept), fragment_key))
 
     return ipfs_cids
 
 
-def decrypt(path, key, iv, cids=[], threads=None):
-    """Decrypts data saved in the given path.
+def decrypt(fragment, key, iv, store, cids=[], threads=None, fragment_key=None, digests=None):
+    """Decrypts data whose kept fragments are in the given fragment.
+
+    Blocks are requested to the block store WINDOW at a time, ahead of the
+    macroblock being un-mixed.
 
     Args:
-        path (str): The path to read.
+        fragment (Fragment): The kept fragments of the data.
         key (bytestr): The key used for AES encryption (16 bytes long).
         iv (bytestr): The iv used for AES encryption (16 bytes long).
+        store (BlockStore): The store the mixed blocks are downloaded from.
         threads (int): The number of threads used. (default: cpu count).
+        fragment_key (bytestr): The key wrapping the kept fragments, if any.
+        digests (list): The digests of the macroblocks, if encrypted with
+            convergent encryption.
     """
-    with FastFile(path, 'r') as f:
-        kept_pieces = f.read()
-
-    num_macroblocks = len(cids)
-    assert len(kept_pieces) // SIZE_TO_KEEP == num_macroblocks
 
-    with Pool() as p:
-        pieces = p.map(_decrypt_block,
-                       [(kept_pieces[i*SIZE_TO_KEEP: (i+1)*SIZE_TO_KEEP], cids[i], key, iv)
-                        for i in range(num_macroblocks)])
+    pages, size = decrypt_pages(fragment, key, iv, store, cids=cids, threads=threads, fragment_key=fragment_key,
+                                digests=digests)
 
-    data = bytearray(b'')
-    for p in pieces:
-        data += p
-    data = padder.unpad(data)
+    data = bytearray(size)
+    for i, page in pages.items():
+        data[MACRO_SIZE*i: MACRO_SIZE*i + len(page)] = page
     return data
+
+
+def decrypt_pages(fragment, key, iv, store, cids=[], threads=None, fragment_key=None, digests=None):
+    """Like decrypt(), but returns the data as a map of macroblocks, and its size.
+
+    Holes (macroblocks with no CID) are missing from the map, and cost no
+    fetch: they are zeros.
+    """
+
+    pages = decrypt_chunks(fragment, key, iv, store, cids=cids, threads=threads, fragment_key=fragment_key,
+                           digests=digests)
+
+    with span('unpad', cat='mix'):
+        # The last macroblock always holds the padding info, so it is stored
+        last = pages[len(cids) - 1]
+        padsize = number.bytes_to_long(last[-padder._padinfosize:])
+        size = len(cids) * MACRO_SIZE - padsize
+        for i in list(pages):
+            start = MACRO_SIZE * i
+            if start >= size:
+                del pages[i]
+            elif start + MACRO_SIZE > size:
+                del pages[i][size - start:]
+    return pages, size
+
+
+def decrypt_chunks(fragment, key, iv, store, cids=[], threads=None, fragment_key=None, digests=None):
+    """Returns the stored macroblocks as they were mixed, by index."""
+
+    kept_pieces = _read_kept(fragment, fragment_key)
+
+    offsets = _kept_offsets(cids)
+    assert len(kept_pieces) // SIZE_TO_KEEP == len(offsets)
+
+    order = list(offsets)
+    futures = {}
+    # The pool takes the arguments from a thread of its own
+    owner = scheduler.current()
+    slots = deque()
+
+    def args():
+        with scheduler.job(*owner):
+            for n, i in enumerate(order):
+                for ahead in order[n:n + WINDOW]:
+                    if ahead not in futures:
+                        futures[ahead] = store.submit_get(cids[ahead])
+                kept = kept_pieces[offsets[i]: offsets[i] + SIZE_TO_KEEP]
+                from_store = futures.pop(i).result()
+                slots.append(scheduler.acquire('cpu'))
+                block_key, block_iv = convergent_key(digests[i]) if digests is not None else (key, iv)
+                yield i, kept, from_store, block_key, block_iv
+
+    with span('pool.start', cat='mix'):
+        p = Pool(threads)
+    with p:
+        with span('pool.map', cat='mix', blocks=len(offsets)):
+            blocks = {}
+            try:
+                for i, piece in zip(order, p.imap(_decrypt_block, args())):
+                    scheduler.release(slots.popleft())
+                    blocks[i] = bytearray(piece)
+            finally:
+                while slots:
+                    scheduler.release(slots.popleft())
+            return blocks
@@ -0,0 +1,63 @@
+import struct
+import threading
+import time
+
+from typing import NamedTuple
+
+# Opt-in recording of the file operations served by FreyaFS, to replay them
+# offline (see simulate.py). Files are numbered in order of appearance, so a
+# trace tells nothing about names or path IDs. Each operation takes a fixed
+# size record after a short header.
+
+MAGIC = b'FREYAOPS\x01'
+OPS = ('open', 'create', 'read', 'write', 'truncate', 'flush', 'fsync', 'release', 'unlink')
+
+# Seconds since the start, operation, file, offset, length, file size afterwards
+_RECORD = struct.Struct('<dBIQIQ')
+
+
+class Op(NamedTuple):
+    time: float
+    op: str
+    file: int
+    offset: int
+    length: int
+    size: int
+
+
+class OpRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'wb')
+        self._file.write(MAGIC)
+        self._files = {}
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, op, path_id, offset=0, length=0, size=0):
+        with self._lock:
+            if self._file is None:
+                return
+            file = self._files.setdefault(path_id, len(self._files))
+            self._file.write(_RECORD.pack(time.monotonic() - self._start, OPS.index(op), file,
+                                          offset, length, size))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_ops(filename):
+    """Yields the operations recorded in filename."""
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a FreyaFS operation trace')
+        while True:
+            data = f.read(_RECORD.size * 4096)
+            if not data:
+                return
+            # A recording cut short may end with a partial record
+            for t, op, file, offset, length, size in _RECORD.iter_unpack(data[:len(data) - len(data) % _RECORD.size]):
+                yield Op(t, OPS[op], file, offset, length, size)
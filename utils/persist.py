@@ -20,9 +20,13 @@ def generate_key(ask_confirm: bool):
     return nacl.pwhash.argon2id.kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
 
 
-def load_from_file(key: bytes, filename: str):
+def _decrypt(key: bytes, filename: str):
+    """Returns the content of filename, None if it does not exist.
+
+    Raises CryptoError if key does not decrypt it.
+    """
     if not os.path.isfile(filename):
-        return
+        return None
 
     # Read the encrypted file
     with open(filename, 'r') as f:
@@ -31,17 +35,40 @@ def load_from_file(key: bytes, filename: str):
 
     # Decrypt
     box = nacl.secret.SecretBox(key)
-    try:
-        plaintext = box.decrypt(encrypted)
-    except nacl.exceptions.CryptoError:
+    return box.decrypt(encrypted)
+
+
+def load_from_file(key: bytes, filename: str):
+    read = try_load(key, filename)
+    if read is False:
         print('ERROR: Wrong password.')
         sys.exit()
+    return read
+
+
+def try_load(key: bytes, filename: str):
+    """Like load_from_file(), but returns False if key does not decrypt filename."""
+    try:
+        plaintext = _decrypt(key, filename)
+    except nacl.exceptions.CryptoError:
+        return False
+    if plaintext is None:
+        return None
 
     # Read JSON
     read = json.loads(plaintext)
     return read
 
 
+def key_opens(key: bytes, filename: str):
+    """Tells whether key decrypts filename, which any key does until it exists."""
+    try:
+        _decrypt(key, filename)
+    except nacl.exceptions.CryptoError:
+        return False
+    return True
+
+
 def save_to_file(key: bytes, filename: str, data: dict):
     # Produce JSON string
     plaintext = json.dumps(data)
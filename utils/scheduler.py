@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from enum import IntEnum
+
+from . import trace
+
+# Mixing workers and block transfers are shared by everything FreyaFS does:
+# each macroblock mixed or un-mixed takes a CPU slot, each block transferred a
+# network slot. Free slots go to the most urgent class first, and within a
+# class to the files in turn, so that a large flush cannot hold back a read.
+# The class and file of the jobs are set per thread, with job().
+
+class Priority(IntEnum):
+    READ = 0  # opens and reads
+    FSYNC = 1
+    WRITEBACK = 2  # flushes on close
+    EVICTION = 3  # flushes making room in the cache
+    PREFETCH = 4
+    GC = 5
+
+    @staticmethod
+    def parse(name):
+        try:
+            return Priority[name.upper()]
+        except KeyError:
+            raise ValueError(f'Unknown priority class "{name}"')
+
+
+def values():
+    return [p.name.lower() for p in Priority]
+
+
+_local = threading.local()
+
+
+def current():
+    """Returns the (class, file) of the jobs of this thread."""
+    return getattr(_local, 'job', (Priority.READ, None))
+
+
+@contextmanager
+def job(priority=None, file=None):
+    """Runs the with block with the given class or file, keeping the current
+    ones for what is not given."""
+    previous = current()
+    _local.job = (priority if priority is not None else previous[0],
+                  file if file is not None else previous[1])
+    try:
+        yield
+    finally:
+        _local.job = previous
+
+
+class _Resource:
+    def __init__(self, slots):
+        self.free = slots
+        # Per class, the files waiting in turn, each with its waiters
+        self.queues = {p: OrderedDict() for p in Priority}
+        self.waiting = Counter()
+        self.running = Counter()
+        self.granted = Counter()
+        self.waited = Counter()  # seconds
+
+    def next(self):
+        for queue in self.queues.values():
+            if queue:
+                file, waiters = queue.popitem(last=False)
+                waiter = waiters.popleft()
+                if waiters:
+                    # Back of the line for the next slot
+                    queue[file] = waiters
+                return waiter
+        return None
+
+
+class Scheduler:
+    """Hands out the CPU and network slots to jobs, by class and file.
+
+    `rates` caps the bytes per second transferred by some classes.
+    """
+
+    def __init__(self, cpu=None, net=64, rates=None):
+        self._lock = threading.Lock()
+        self._resources = {'cpu': _Resource(cpu if cpu is not None else os.cpu_count()),
+                           'net': _Resource(net)}
+        self._rates = dict(rates) if rates else {}
+        self._buckets = {priority: [rate, time.monotonic()] for priority, rate in self._rates.items()}
+
+    def _throttle(self, priority, size):
+        rate = self._rates.get(priority)
+        if not rate or not size:
+            return
+        with self._lock:
+            bucket = self._buckets[priority]
+            now = time.monotonic()
+            # Up to a second worth of bytes can be sent at once
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate) - size
+            bucket[1] = now
+            delay = -bucket[0] / rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def acquire(self, resource, size=0, owner=None):
+        """Waits for a slot of resource, for the (class, file) owner or the
+        current job. Returns the token to release it with."""
+        priority, file = owner if owner is not None else current()
+        self._throttle(priority, size)
+
+        res = self._resources[resource]
+        waiter = threading.Event()
+        start = time.monotonic()
+        with self._lock:
+            res.queues[priority].setdefault(file, deque()).append((waiter, priority))
+            res.waiting[priority] += 1
+            self._dispatch(resource, res)
+        waiter.wait()
+        with self._lock:
+            res.waited[priority] += time.monotonic() - start
+        return self, resource, priority
+
+    def release(self, token):
+        _, resource, priority = token
+        res = self._resources[resource]
+        with self._lock:
+            res.free += 1
+            res.running[priority] -= 1
+            self._dispatch(resource, res)
+
+    @contextmanager
+    def slot(self, resource, size=0):
+        token = self.acquire(resource, size)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def _dispatch(self, resource, res):
+        while res.free > 0:
+            item = res.next()
+            if item is None:
+                break
+            waiter, priority = item
+            res.free -= 1
+            res.waiting[priority] -= 1
+            res.running[priority] += 1
+            res.granted[priority] += 1
+            waiter.set()
+        if trace.enabled():
+            trace.counter(f'scheduler.{resource}', cat='scheduler',
+                          **{p.name.lower(): res.waiting[p] for p in Priority})
+
+    def stats(self):
+        """Returns the queue depth, running jobs, jobs done and seconds waited
+        of each class, for each resource."""
+        with self._lock:
+            return {
+                resource: {
+                    p.name.lower(): {
+                        'waiting': res.waiting[p],
+                        'running': res.running[p],
+                        'granted': res.granted[p],
+                        'waited': res.waited[p],
+                    } for p in Priority
+                } for resource, res in self._resources.items()
+            }
+
+
+# ------------------------------------------------------ Scheduler of the process
+
+_scheduler = None
+
+
+def install(scheduler):
+    global _scheduler
+    _scheduler = scheduler
+
+
+def installed():
+    return _scheduler
+
+
+def acquire(resource, size=0, owner=None):
+    """Like Scheduler.acquire(), with the installed scheduler, if any."""
+    return _scheduler.acquire(resource, size, owner) if _scheduler is not None else None
+
+
+def release(token):
+    if token is not None:
+        token[0].release(token)
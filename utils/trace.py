@@ -0,0 +1,159 @@
+import json
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+# Opt-in tracing in the Chrome trace-event format (readable by chrome://tracing
+# and https://ui.perfetto.dev). Events are appended as JSON lines to a part
+# file shared by every process (workers forked by multiprocessing inherit the
+# settings), and merged into a single JSON document by save().
+
+_filename = None
+_fd = None
+_fd_pid = None
+_named = set()
+_async_ids = itertools.count()
+
+
+def enable(filename):
+    global _filename, _fd, _fd_pid
+    _filename = str(filename)
+    _fd = os.open(_part_filename(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+    _fd_pid = os.getpid()
+    _named.clear()
+
+
+def enabled():
+    return _filename is not None
+
+
+def _part_filename():
+    return f'{_filename}.part'
+
+
+def _write(event):
+    global _fd, _fd_pid
+    if _fd is None or _fd_pid != os.getpid():
+        # O_APPEND keeps lines written by different processes from interleaving
+        _fd = os.open(_part_filename(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        _fd_pid = os.getpid()
+    os.write(_fd, (json.dumps(event) + '\n').encode('utf-8'))
+
+
+def _name_process_and_thread(pid, tid):
+    if pid not in _named:
+        _named.add(pid)
+        _write({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': multiprocessing.current_process().name}})
+    if (pid, tid) not in _named:
+        _named.add((pid, tid))
+        _write({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': threading.current_thread().name}})
+
+
+def _now():
+    # CLOCK_MONOTONIC is system-wide, so timestamps of different processes line up
+    return time.monotonic_ns() / 1000
+
+
+@contextmanager
+def span(name, cat='freyafs', **args):
+    """Records the time spent in the with block as a complete ('X') event."""
+    if _filename is None:
+        yield
+        return
+
+    start = _now()
+    try:
+        yield
+    finally:
+        end = _now()
+        pid = os.getpid()
+        tid = threading.get_native_id()
+        _name_process_and_thread(pid, tid)
+        _write({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start,
+            'dur': end - start,
+            'pid': pid,
+            'tid': tid,
+            'args': args,
+        })
+
+
+@contextmanager
+def async_span(name, cat='freyafs', **args):
+    """Like span(), but for work overlapping on one thread (e.g. coroutines).
+
+    Emitted as an async ('b'/'e') pair, which trace viewers draw on their own
+    track instead of trying to nest it in the thread's call stack.
+    """
+    if _filename is None:
+        yield
+        return
+
+    pid = os.getpid()
+    tid = threading.get_native_id()
+    _name_process_and_thread(pid, tid)
+    event_id = next(_async_ids)
+    common = {'name': name, 'cat': cat, 'id': event_id, 'pid': pid, 'tid': tid}
+    _write({**common, 'ph': 'b', 'ts': _now(), 'args': args})
+    try:
+        yield
+    finally:
+        _write({**common, 'ph': 'e', 'ts': _now()})
+
+
+def counter(name, cat='freyafs', **values):
+    """Records the current values of a counter ('C' event), e.g. a queue depth."""
+    if _filename is None:
+        return
+
+    pid = os.getpid()
+    tid = threading.get_native_id()
+    _name_process_and_thread(pid, tid)
+    _write({'name': name, 'cat': cat, 'ph': 'C', 'ts': _now(), 'pid': pid, 'tid': tid, 'args': values})
+
+
+def traced(name=None, cat='freyafs'):
+    """Decorator version of span()."""
+    def decorator(f):
+        span_name = name if name is not None else f.__name__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(span_name, cat=cat):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def save():
+    """Merges the recorded events into the Chrome trace JSON file."""
+    global _fd
+    if _filename is None:
+        return
+
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+
+    events = []
+    with open(_part_filename(), 'r') as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+
+    with open(_filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    os.remove(_part_filename())
@@ -42,6 +42,14 @@ class Trie:
     def to_dict(self):
         return self.root.to_dict()
 
+    def values(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.value is not None:
+                yield node.value
+            stack.extend(node.children.values())
+
     @staticmethod
     def from_dict(data, transform=None):
         return Trie(Node.from_dict(data, transform))